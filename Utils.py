@@ -7,7 +7,7 @@
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
 
-import os, sys, time,torch,pickle,trimesh,itertools,pdb,zipfile,datetime,imageio,gzip,logging,joblib,importlib,uuid,signal,multiprocessing,psutil,subprocess,tarfile,scipy,argparse
+import os, sys, time,torch,pickle,trimesh,itertools,pdb,zipfile,datetime,imageio,gzip,logging,joblib,importlib,uuid,signal,multiprocessing,psutil,subprocess,tarfile,scipy,argparse,hashlib
 from pytorch3d.transforms import so3_log_map,so3_exp_map,se3_exp_map,se3_log_map,matrix_to_axis_angle,matrix_to_euler_angles,euler_angles_to_matrix, rotation_6d_to_matrix
 from pytorch3d.renderer import FoVPerspectiveCameras, PerspectiveCameras, look_at_view_transform, look_at_rotation, RasterizationSettings, MeshRenderer, MeshRasterizer, BlendParams, SoftSilhouetteShader, HardPhongShader, PointLights, TexturesVertex
 from pytorch3d.renderer.mesh.rasterize_meshes import barycentric_coordinates
@@ -103,7 +103,82 @@ set_logging_format()
 
 
 
-def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
+def make_texture_pyramid(img, min_size=8):
+  '''
+  @img: (H,W,3) uint8
+  @return: list of uint8 images, each half the size of the previous one
+  '''
+  levels = [img]
+  while min(levels[-1].shape[:2])//2>=min_size:
+    levels.append(cv2.resize(levels[-1], dsize=(levels[-1].shape[1]//2, levels[-1].shape[0]//2), interpolation=cv2.INTER_AREA))
+  return levels
+
+
+def make_texture_tensors(img, uv, faces, vertices, device='cuda', tex_format=None):
+  '''
+  @img: (H,W,3) uint8 texture
+  @tex_format: None keeps one float32 texture in 'tex'. 'uint8' or 'half' stores a mip pyramid in 'tex_mip0', 'tex_mip1', ... and
+  'texel_per_meter', the texture resolution on the surface at level 0, so the renderer samples the level matching its output
+  '''
+  mesh_tensors = {}
+  if tex_format is None:
+    mesh_tensors['tex'] = torch.as_tensor(img, device=device, dtype=torch.float)[None]/255.0
+  else:
+    for i, level in enumerate(make_texture_pyramid(img)):
+      if tex_format=='uint8':
+        mesh_tensors[f'tex_mip{i}'] = torch.as_tensor(level, device=device)
+      elif tex_format=='half':
+        mesh_tensors[f'tex_mip{i}'] = (torch.as_tensor(level, device=device, dtype=torch.float)/255.0).half()
+      else:
+        raise NotImplementedError(f'tex_format {tex_format}')
+    uv_px = np.asarray(uv)[faces]*np.array([img.shape[1], img.shape[0]]).reshape(1,1,2)
+    uv_area = 0.5*np.abs(np.cross(uv_px[:,1]-uv_px[:,0], uv_px[:,2]-uv_px[:,0]))
+    tri = np.asarray(vertices)[faces]
+    area = 0.5*np.linalg.norm(np.cross(tri[:,1]-tri[:,0], tri[:,2]-tri[:,0]), axis=-1)
+    mesh_tensors['texel_per_meter'] = torch.tensor(np.sqrt(uv_area.sum()/max(area.sum(), 1e-12)), device=device, dtype=torch.float)
+  mesh_tensors['uv_idx'] = torch.as_tensor(faces, device=device, dtype=torch.int)
+  uv = torch.as_tensor(uv, device=device, dtype=torch.float)
+  uv[:,1] = 1 - uv[:,1]
+  mesh_tensors['uv'] = uv
+  return mesh_tensors
+
+
+def has_mesh_texture(mesh_tensors):
+  return 'tex' in mesh_tensors or 'tex_mip0' in mesh_tensors
+
+
+def get_mesh_texture(mesh_tensors, px_per_meter=None):
+  '''Float texture for rendering. With a mip pyramid, the coarsest level that still has a texel per output pixel
+  @px_per_meter: output pixels per meter on the object surface, None picks level 0
+  @return: (1,H,W,3) float32
+  '''
+  if 'tex' in mesh_tensors:
+    return mesh_tensors['tex']
+  n_levels = len([k for k in mesh_tensors if k.startswith('tex_mip')])
+  level = 0
+  if px_per_meter is not None:
+    level = int(np.clip(np.floor(np.log2(max(mesh_tensors['texel_per_meter'].item()/px_per_meter, 1))), 0, n_levels-1))
+  tex = mesh_tensors[f'tex_mip{level}']
+  if tex.dtype==torch.uint8:
+    return tex[None].float()/255.0
+  return tex[None].float()
+
+
+def get_render_px_per_meter(K, W, ob_in_cams, output_size=None, bbox2d=None):
+  '''Output pixels per meter at the closest object center of the batch
+  '''
+  scale = 1
+  if bbox2d is not None:
+    scale = (output_size[1]/(bbox2d[:,2]-bbox2d[:,0])).max().item()
+  elif output_size is not None:
+    scale = output_size[1]/W
+  return K[0,0]*scale/ob_in_cams[:,2,3].min().clamp(min=1e-3).item()
+
+
+def make_mesh_tensors(mesh, device='cuda', max_tex_size=None, tex_format=None):
+  '''
+  @tex_format: see make_texture_tensors
+  '''
   mesh_tensors = {}
   if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
     img = np.array(mesh.visual.material.image.convert('RGB'))
@@ -113,11 +188,7 @@ def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
       if max_size>max_tex_size:
         scale = 1/max_size * max_tex_size
         img = cv2.resize(img, fx=scale, fy=scale, dsize=None)
-    mesh_tensors['tex'] = torch.as_tensor(img, device=device, dtype=torch.float)[None]/255.0
-    mesh_tensors['uv_idx']  = torch.as_tensor(mesh.faces, device=device, dtype=torch.int)
-    uv = torch.as_tensor(mesh.visual.uv, device=device, dtype=torch.float)
-    uv[:,1] = 1 - uv[:,1]
-    mesh_tensors['uv']  = uv
+    mesh_tensors.update(make_texture_tensors(img, mesh.visual.uv, mesh.faces, mesh.vertices, device=device, tex_format=tex_format))
   else:
     if mesh.visual.vertex_colors is None:
       logging.info(f"WARN: mesh doesn't have vertex_colors, assigning a pure color")
@@ -132,6 +203,19 @@ def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
   return mesh_tensors
 
 
+def mesh_tensors_equal(a, b):
+  '''Whether two make_mesh_tensors outputs describe the same mesh, so they can be rendered in one call
+  '''
+  if a is b:
+    return True
+  if a.keys()!=b.keys():
+    return False
+  for k in a:
+    if a[k].shape!=b[k].shape or a[k].device!=b[k].device or not torch.equal(a[k], b[k]):
+      return False
+  return True
+
+
 def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
   '''Just plain rendering, not support any gradient
   @K: (3,3) np array
@@ -142,6 +226,9 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   @light_dir: in cam space
   @light_pos: in cam space
   '''
+  device = ob_in_cams.device
+  if device.type!='cuda':
+    raise NotImplementedError(f"nvdiffrast rasterization requires CUDA tensors, got ob_in_cams on {device}")
   if glctx is None:
     if context == 'gl':
       glctx = dr.RasterizeGLContext()
@@ -152,16 +239,16 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
     logging.info("created context")
 
   if mesh_tensors is None:
-    mesh_tensors = make_mesh_tensors(mesh)
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
   pos = mesh_tensors['pos']
   vnormals = mesh_tensors['vnormals']
   pos_idx = mesh_tensors['faces']
-  has_tex = 'tex' in mesh_tensors
+  has_tex = has_mesh_texture(mesh_tensors)
 
-  ob_in_glcams = torch.tensor(glcam_in_cvcam, device='cuda', dtype=torch.float)[None]@ob_in_cams
+  ob_in_glcams = torch.tensor(glcam_in_cvcam, device=device, dtype=torch.float)[None]@ob_in_cams
   if projection_mat is None:
     projection_mat = projection_matrix_from_intrinsics(K, height=H, width=W, znear=0.001, zfar=100)
-  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device='cuda', dtype=torch.float)
+  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device=device, dtype=torch.float)
   mtx = projection_mat@ob_in_glcams
 
   if output_size is None:
@@ -175,7 +262,7 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
     t = H-bbox2d[:,1]
     r = bbox2d[:,2]
     b = H-bbox2d[:,3]
-    tf = torch.eye(4, dtype=torch.float, device='cuda').reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
+    tf = torch.eye(4, dtype=torch.float, device=device).reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
     tf[:,0,0] = W/(r-l)
     tf[:,1,1] = H/(t-b)
     tf[:,3,0] = (W-r-l)/(r-l)
@@ -186,7 +273,8 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   depth = xyz_map[...,2]
   if has_tex:
     texc, _ = dr.interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
-    color = dr.texture(mesh_tensors['tex'], texc, filter_mode='linear')
+    tex = get_mesh_texture(mesh_tensors, get_render_px_per_meter(K, W, ob_in_cams, output_size, bbox2d))
+    color = dr.texture(tex, texc, filter_mode='linear')
   else:
     color, _ = dr.interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
 
@@ -202,15 +290,15 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
 
   if use_light:
     if light_dir is not None:
-      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device='cuda')
+      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device=device)
     else:
-      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device='cuda').reshape(1,1,3) - pts_cam
+      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device=device).reshape(1,1,3) - pts_cam
     diffuse_intensity = (F.normalize(vnormals_cam, dim=-1) * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
     diffuse_intensity_map, _ = dr.interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
     if light_color is None:
       light_color = color
     else:
-      light_color = torch.as_tensor(light_color, device='cuda', dtype=torch.float)
+      light_color = torch.as_tensor(light_color, device=device, dtype=torch.float)
     color = color*w_ambient + diffuse_intensity_map*light_color*w_diffuse
 
   color = color.clip(0,1)
@@ -221,6 +309,20 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   return color, depth, normal_map
 
 
+def hash_arrays(*arrays, n_decimal=6):
+  '''Content hash of numpy arrays. Floats are rounded so that numerical noise does not change the key
+  '''
+  h = hashlib.sha1()
+  for arr in arrays:
+    arr = np.asarray(arr)
+    if np.issubdtype(arr.dtype, np.floating):
+      arr = arr.astype(np.float64).round(n_decimal)+0.0   # +0.0 maps -0.0 to 0.0
+    arr = np.ascontiguousarray(arr)
+    h.update(f'{arr.shape}{arr.dtype}'.encode())
+    h.update(arr.tobytes())
+  return h.hexdigest()
+
+
 def set_seed(random_seed):
   import torch,random
   np.random.seed(random_seed)
@@ -344,7 +446,7 @@ if wp is not None:
     if sum_weight>0 and num_valid>0:
       out[h,w] = sum/sum_weight
 
-  def bilateral_filter_depth(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
+  def bilateral_filter_depth_warp(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
     if isinstance(depth, np.ndarray):
       depth_wp = wp.array(depth, dtype=float, device=device)
     else:
@@ -386,7 +488,7 @@ if wp is not None:
       out[h,w] = d_ori
 
 
-  def erode_depth(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
+  def erode_depth_warp(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
     depth_wp = wp.from_torch(torch.as_tensor(depth, dtype=torch.float, device=device))
     out_wp = wp.zeros(depth.shape, dtype=float, device=device)
     wp.launch(kernel=erode_depth_kernel, device=device, dim=[depth.shape[0], depth.shape[1]], inputs=[depth_wp, out_wp, radius, depth_diff_thres, ratio_thres, zfar],)
@@ -398,13 +500,182 @@ if wp is not None:
 
 
 
+def window_offsets(depth, radius):
+  '''Strided views of the (2*radius+1)^2 neighbors of every pixel, one offset at a time so memory stays O(HW)
+  @depth: (H,W) tensor
+  @return: iterator of (du, dv, neighbor, inside), neighbor[h,w] = depth[h+dv,w+du] and inside marks the offsets within the image
+  '''
+  H,W = depth.shape
+  padded = F.pad(depth[None,None], (radius,radius,radius,radius))[0,0]
+  inside = F.pad(torch.ones((1,1,H,W), dtype=torch.float, device=depth.device), (radius,radius,radius,radius))[0,0]>0
+  for du in range(-radius, radius+1):
+    for dv in range(-radius, radius+1):
+      yield du, dv, padded[radius+dv:radius+dv+H, radius+du:radius+du+W], inside[radius+dv:radius+dv+H, radius+du:radius+du+W]
+
+
+def bilateral_filter_depth_torch(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cpu'):
+  '''Same as bilateral_filter_depth_kernel with vectorized ops over the window offsets
+  '''
+  depth_t = torch.as_tensor(depth, dtype=torch.float, device=device)
+  num_valid = torch.zeros(depth_t.shape, dtype=torch.float, device=device)
+  mean_depth = torch.zeros(depth_t.shape, dtype=torch.float, device=device)
+  for _, _, cur, inside in window_offsets(depth_t, radius):
+    valid = inside & (cur>=0.001) & (cur<zfar)
+    num_valid += valid
+    mean_depth += torch.where(valid, cur, 0)
+  mean_depth /= num_valid.clamp(min=1)
+
+  sum_weight = torch.zeros(depth_t.shape, dtype=torch.float, device=device)
+  total = torch.zeros(depth_t.shape, dtype=torch.float, device=device)
+  for du, dv, cur, inside in window_offsets(depth_t, radius):
+    valid = inside & (cur>=0.001) & (cur<zfar) & ((cur-mean_depth).abs()<0.01)
+    weight = torch.exp(-float(du*du+dv*dv)/(2.0*sigmaD*sigmaD) - (depth_t-cur)**2/(2.0*sigmaR*sigmaR))
+    weight = torch.where(valid, weight, 0)
+    sum_weight += weight
+    total += weight*cur
+  depth_out = torch.where((sum_weight>0) & (num_valid>0), total/sum_weight.clamp(min=1e-30), 0)
+  if isinstance(depth, np.ndarray):
+    depth_out = depth_out.data.cpu().numpy()
+  return depth_out
+
+
+def erode_depth_torch(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cpu'):
+  '''Same as erode_depth_kernel with vectorized ops over the window offsets
+  '''
+  depth_t = torch.as_tensor(depth, dtype=torch.float, device=device)
+  bad_cnt = torch.zeros(depth_t.shape, dtype=torch.float, device=device)
+  total = torch.zeros(depth_t.shape, dtype=torch.float, device=device)
+  for _, _, cur, inside in window_offsets(depth_t, radius):
+    total += inside
+    bad_cnt += inside & ((cur<0.001) | (cur>=zfar) | ((cur-depth_t).abs()>depth_diff_thres))
+  depth_out = torch.where(bad_cnt/total>ratio_thres, 0, depth_t)
+  if isinstance(depth, np.ndarray):
+    depth_out = depth_out.data.cpu().numpy()
+  return depth_out
+
+
+def get_depth_filter_backend(device, backend=None):
+  '''
+  @backend: warp/torch. None picks warp on CUDA devices when it is installed, and the vectorized torch ops otherwise
+  '''
+  if backend is None:
+    backend = 'warp' if wp is not None and torch.device(device).type=='cuda' else 'torch'
+  if backend=='warp' and wp is None:
+    raise RuntimeError('warp is not installed')
+  return backend
+
+
+def bilateral_filter_depth(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda', backend=None):
+  if get_depth_filter_backend(device, backend)=='warp':
+    return bilateral_filter_depth_warp(depth, radius=radius, zfar=zfar, sigmaD=sigmaD, sigmaR=sigmaR, device=device)
+  return bilateral_filter_depth_torch(depth, radius=radius, zfar=zfar, sigmaD=sigmaD, sigmaR=sigmaR, device=device)
+
+
+def erode_depth(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda', backend=None):
+  if get_depth_filter_backend(device, backend)=='warp':
+    return erode_depth_warp(depth, radius=radius, depth_diff_thres=depth_diff_thres, ratio_thres=ratio_thres, zfar=zfar, device=device)
+  return erode_depth_torch(depth, radius=radius, depth_diff_thres=depth_diff_thres, ratio_thres=ratio_thres, zfar=zfar, device=device)
+
+
+
+def mask_roi(mask, pad=0.25):
+  '''Bounding box of the mask, grown by pad times its size on every side
+  @return: (x0,y0,x1,y1) int with x1,y1 exclusive and clipped to the image, None if the mask is empty
+  '''
+  H,W = mask.shape[:2]
+  vs,us = np.where(np.asarray(mask)>0)
+  if len(us)==0:
+    return None
+  x0, x1, y0, y1 = us.min(), us.max()+1, vs.min(), vs.max()+1
+  dx = pad*(x1-x0)
+  dy = pad*(y1-y0)
+  return (int(max(np.floor(x0-dx),0)), int(max(np.floor(y0-dy),0)), int(min(np.ceil(x1+dx),W)), int(min(np.ceil(y1+dy),H)))
+
+
+def crop_windows_roi(tf_to_crops, out_size, H, W, pad=0.25):
+  '''Bounding box of the union of crop windows in the original image, each window grown by pad times its size on every side
+  @tf_to_crops: (B,3,3) original pixel -> crop pixel, from compute_crop_window_tf_batch
+  @out_size: (w,h) passed to compute_crop_window_tf_batch
+  @return: (x0,y0,x1,y1) int with x1,y1 exclusive and clipped to the image
+  '''
+  w,h = out_size
+  crop_to_oris = tf_to_crops.inverse()
+  corners = torch.tensor([[0,0],[w,h]], dtype=torch.float, device=tf_to_crops.device)
+  uvs = corners@crop_to_oris[:,:2,:2].permute(0,2,1) + crop_to_oris[:,None,:2,2]   #(B,2,2)
+  size = uvs[:,1]-uvs[:,0]
+  lo = (uvs[:,0]-pad*size).min(dim=0)[0].data.cpu().numpy()
+  hi = (uvs[:,1]+pad*size).max(dim=0)[0].data.cpu().numpy()
+  return (int(np.clip(np.floor(lo[0]),0,W)), int(np.clip(np.floor(lo[1]),0,H)), int(np.clip(np.ceil(hi[0]),0,W)), int(np.clip(np.ceil(hi[1]),0,H)))
+
+
+def roi_union(*rois):
+  rois = [roi for roi in rois if roi is not None]
+  if len(rois)==0:
+    return None
+  rois = np.array(rois)
+  return (int(rois[:,0].min()), int(rois[:,1].min()), int(rois[:,2].max()), int(rois[:,3].max()))
+
+
+def preprocess_depth_roi(depth, K, roi=None, radius=2, device='cuda'):
+  '''erode_depth, bilateral_filter_depth and the xyz map, computed inside roi only. The 2*radius pixels around it are read, so inside roi the result equals full frame filtering
+  @roi: (x0,y0,x1,y1) with x1,y1 exclusive, None for the full frame
+  @return: depth (H,W) and xyz_map (H,W,3), zero outside roi. np arrays if depth is one, tensors on device otherwise
+  '''
+  is_np = isinstance(depth, np.ndarray)
+  depth = torch.as_tensor(depth, dtype=torch.float, device=device)
+  H,W = depth.shape[:2]
+  x0,y0,x1,y1 = (0,0,W,H) if roi is None else roi
+  m = 2*radius
+  cx0, cy0, cx1, cy1 = max(x0-m,0), max(y0-m,0), min(x1+m,W), min(y1+m,H)
+  sub = depth[cy0:cy1, cx0:cx1].contiguous()
+  sub = erode_depth(sub, radius=radius, device=device)
+  sub = bilateral_filter_depth(sub, radius=radius, device=device)
+  sub = sub[y0-cy0:y1-cy0, x0-cx0:x1-cx0]
+  depth_out = torch.zeros((H,W), dtype=torch.float, device=device)
+  depth_out[y0:y1, x0:x1] = sub
+  xyz_map = torch.zeros((H,W,3), dtype=torch.float, device=device)
+  xyz_map[y0:y1, x0:x1] = sub[...,None]*get_ray_table(K, H, W, device=device)[y0:y1, x0:x1]
+  xyz_map[y0:y1, x0:x1][sub<0.001] = 0
+  if is_np:
+    return depth_out.data.cpu().numpy(), xyz_map.data.cpu().numpy()
+  return depth_out, xyz_map
+
+
+RAY_TABLE_CACHE_SIZE = 8
+_RAY_TABLES = OrderedDict()
+
+
+def get_ray_table(K, H, W, device=None, dtype=None):
+  '''Per-pixel back-projection rays ((u-cx)/fx, (v-cy)/fy, 1), so that xyz = depth*ray. The latest RAY_TABLE_CACHE_SIZE tables are kept
+  @device: None for a np array, otherwise a tensor on device
+  @return: (H,W,3) float32 unless dtype is given
+  '''
+  K = np.asarray(K, dtype=np.float64).reshape(3,3)
+  dtype = (np.float32 if device is None else torch.float) if dtype is None else dtype
+  key = (K.tobytes(), H, W, None if device is None else str(torch.device(device)), str(dtype))
+  if key in _RAY_TABLES:
+    _RAY_TABLES.move_to_end(key)
+    return _RAY_TABLES[key]
+  rays = np.ones((H,W,3), dtype=np.float64)
+  rays[...,0] = (np.arange(W).reshape(1,W)-K[0,2])/K[0,0]
+  rays[...,1] = (np.arange(H).reshape(H,1)-K[1,2])/K[1,1]
+  if device is None:
+    rays = rays.astype(dtype)
+  else:
+    rays = torch.as_tensor(rays, dtype=dtype, device=device)
+  _RAY_TABLES[key] = rays
+  while len(_RAY_TABLES)>RAY_TABLE_CACHE_SIZE:
+    _RAY_TABLES.popitem(last=False)
+  return rays
+
+
 def depth2xyzmap(depth, K, uvs=None):
   invalid_mask = (depth<0.001)
   H,W = depth.shape[:2]
   if uvs is None:
-    vs,us = np.meshgrid(np.arange(0,H),np.arange(0,W), sparse=False, indexing='ij')
-    vs = vs.reshape(-1)
-    us = us.reshape(-1)
+    xyz_map = depth[...,None].astype(np.float32)*get_ray_table(K, H, W)
+    xyz_map[invalid_mask] = 0
+    return xyz_map
   else:
     uvs = uvs.round().astype(int)
     us = uvs[:,0]
@@ -427,15 +698,12 @@ def depth2xyzmap_batch(depths, Ks, zfar):
   bs = depths.shape[0]
   invalid_mask = (depths<0.001) | (depths>zfar)
   H,W = depths.shape[-2:]
-  vs,us = torch.meshgrid(torch.arange(0,H),torch.arange(0,W), indexing='ij')
-  vs = vs.reshape(-1).float().cuda()[None].expand(bs,-1)
-  us = us.reshape(-1).float().cuda()[None].expand(bs,-1)
-  zs = depths.reshape(bs,-1)
-  Ks = Ks[:,None].expand(bs,zs.shape[-1],3,3)
-  xs = (us-Ks[...,0,2])*zs/Ks[...,0,0]  #(B,N)
-  ys = (vs-Ks[...,1,2])*zs/Ks[...,1,1]
-  pts = torch.stack([xs,ys,zs], dim=-1)  #(B,N,3)
-  xyz_maps = pts.reshape(bs,H,W,3)
+  Ks = torch.as_tensor(Ks).reshape(-1,3,3).data.cpu().numpy()
+  if len(Ks)==1 or (Ks==Ks[:1]).all():
+    rays = get_ray_table(Ks[0], H, W, device=depths.device)[None]
+  else:
+    rays = torch.stack([get_ray_table(K, H, W, device=depths.device) for K in Ks], dim=0)
+  xyz_maps = depths[...,None].float()*rays   #(B,H,W,3)
   xyz_maps[invalid_mask] = 0
   return xyz_maps
 
@@ -537,6 +805,87 @@ def sample_views_near_identity(n_views, max_angle_degrees=20):
   return cam_in_obs
 
 
+def match_poses_numpy(Rqs, qqs, tqs, Rcs, qcs, tcs, dist_diff, radian_thres, max_elements=2**22):
+  '''Same test as mycpp cluster_poses, in float32. Pairs are first gated by the squared translation distance and the quaternion dot product as
+  matrix products, rotations closer than radian_thres have |<q1,q2>| > cos(radian_thres/2). The exact test only runs on the pairs passing both gates
+  @Rqs: (B,S,3,3) query rotations already multiplied by every symmetry, qqs: (B,S,4) their quaternions
+  @tqs: (B,3)
+  @Rcs: (M,3,3), qcs: (M,4), tcs: (M,3) cluster poses
+  @return: (B,M) bool, translation closer than dist_diff and some symmetry closer than radian_thres
+  '''
+  B, S = Rqs.shape[:2]
+  matches = np.zeros((B,len(Rcs)), dtype=bool)
+  if B==0 or len(Rcs)==0:
+    return matches
+  dot_thres = np.cos(min(radian_thres, np.pi)/2)-1e-3
+  tqs64 = tqs.astype(np.float64)
+  tcs64 = tcs.astype(np.float64)
+  chunk = max(1, max_elements//(B*S))
+  for m in range(0,len(Rcs),chunk):
+    dists2 = (tqs64**2).sum(axis=1)[:,None] + (tcs64[m:m+chunk]**2).sum(axis=1)[None] - 2*tqs64@tcs64[m:m+chunk].T
+    close = dists2 < float(dist_diff)**2*(1+1e-3)+1e-9
+    gate = (np.abs(qqs@qcs[m:m+chunk].T)>dot_thres) & close[:,None]   # (B,S,chunk)
+    qs, ss, cs = np.nonzero(gate)
+    cs += m
+    keep = np.linalg.norm(tqs[qs]-tcs[cs], axis=-1)<dist_diff
+    qs, ss, cs = qs[keep], ss[keep], cs[keep]
+    traces = np.einsum('pij,pij->p', Rqs[qs,ss], Rcs[cs])   # trace(R_q R_c^T)
+    rot_diffs = np.arccos(np.clip((traces-1)/np.float32(2), -1, 1))
+    ok = rot_diffs<radian_thres
+    matches[qs[ok], cs[ok]] = True
+  return matches
+
+
+def cluster_poses_numpy(angle_diff, dist_diff, poses_in, symmetry_tfs, block_size=256):
+  '''Vectorized fallback of mycpp cluster_poses with the same output. A pose starts a new cluster unless an earlier cluster is within dist_diff
+  and, after one of the symmetry_tfs, within angle_diff. Each block of poses is matched against the clusters at once, then the new clusters
+  of the block are resolved in order against each other
+  @angle_diff: degree
+  @dist_diff: meter
+  @return: (M,4,4) float32 cluster poses, in input order
+  '''
+  poses = np.asarray(poses_in, dtype=np.float32).reshape(-1,4,4)
+  if len(poses)==0:
+    return poses
+  sym_Rs = np.asarray(symmetry_tfs, dtype=np.float32).reshape(-1,4,4)[:,:3,:3]
+  radian_thres = np.float32(angle_diff/180.0*np.pi)
+  Rs = poses[:,:3,:3]
+  ts = poses[:,:3,3]
+  qs = R.from_matrix(Rs).as_quat()
+  cluster_ids = [0]
+  for b in range(1,len(poses),block_size):
+    ids = np.arange(b, min(b+block_size,len(poses)))
+    Rqs = np.einsum('bij,sjk->bsik', Rs[ids], sym_Rs)
+    qqs = R.from_matrix(Rqs.reshape(-1,3,3)).as_quat().reshape(len(ids),len(sym_Rs),4)
+    old = np.asarray(cluster_ids)
+    matched = match_poses_numpy(Rqs, qqs, ts[ids], Rs[old], qs[old], ts[old], dist_diff, radian_thres).any(axis=1)
+    cand = np.nonzero(~matched)[0]
+    if len(cand)==0:
+      continue
+    new_ids = ids[cand]
+    inner = match_poses_numpy(Rqs[cand], qqs[cand], ts[new_ids], Rs[new_ids], qs[new_ids], ts[new_ids], dist_diff, radian_thres)
+    new = []
+    for i in range(len(cand)):
+      if not inner[i,new].any():
+        new.append(i)
+    cluster_ids += new_ids[new].tolist()
+  return poses[cluster_ids]
+
+
+def cluster_poses(angle_diff, dist_diff, poses_in, symmetry_tfs):
+  '''
+  @angle_diff: degree
+  @dist_diff: meter
+  @return: (M,4,4) cluster poses, by mycpp when it is built, else by cluster_poses_numpy
+  '''
+  if mycpp is not None:
+    return np.asarray(mycpp.cluster_poses(angle_diff, dist_diff, poses_in, symmetry_tfs))
+  logging.info(f"num original candidates = {len(poses_in)}")
+  poses = cluster_poses_numpy(angle_diff, dist_diff, poses_in, symmetry_tfs)
+  logging.info(f"num of pose after clustering: {len(poses)}")
+  return poses
+
+
 
 def to_homo(pts):
   '''
@@ -586,7 +935,71 @@ def random_direction():
 
 
 
-def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000):
+def max_pairwise_dist(pts, block_size=2048):
+  '''Largest distance between two of the points, over block_size x block_size tiles so memory stays bounded
+  @pts: (N,3) np array
+  '''
+  pts = np.asarray(pts, dtype=np.float64)
+  pts = pts-pts.mean(axis=0, keepdims=True)   # less cancellation in |a|^2+|b|^2-2ab
+  sq = (pts**2).sum(axis=1)
+  best = 0.0
+  for i in range(0, len(pts), block_size):
+    for j in range(i, len(pts), block_size):
+      d2 = sq[i:i+block_size,None] + sq[None,j:j+block_size] - 2*pts[i:i+block_size]@pts[j:j+block_size].T
+      best = max(best, float(d2.max()))
+  return float(np.sqrt(max(best, 0.0)))
+
+
+def hull_vertices(pts):
+  '''Convex hull vertices, the diameter is attained between two of them. All points if the hull is degenerate
+  '''
+  pts = np.asarray(pts, dtype=np.float64)
+  try:
+    return pts[scipy.spatial.ConvexHull(pts).vertices]
+  except Exception:
+    return pts
+
+
+def compute_diameter_approx(pts, n_grid=16, block_size=16384):
+  '''Lower bound of the diameter from the extreme points along 3*n_grid^2 directions, a grid on three cube faces
+  Every unit vector is within sqrt(2)/n_grid rad of a direction, so the true diameter is at most diameter/cos(sqrt(2)/n_grid)
+  @return: diameter, max relative error
+  '''
+  ticks = (np.arange(n_grid)+0.5)/n_grid*2-1
+  a, b = [x.reshape(-1) for x in np.meshgrid(ticks, ticks, indexing='ij')]
+  ones = np.ones_like(a)
+  dirs = np.concatenate([np.stack([a,b,ones], axis=-1), np.stack([a,ones,b], axis=-1), np.stack([ones,a,b], axis=-1)], axis=0)
+  dirs /= np.linalg.norm(dirs, axis=-1, keepdims=True)
+  pts = np.asarray(pts, dtype=np.float64)
+  hi = np.full(len(dirs), -np.inf)
+  lo = np.full(len(dirs), np.inf)
+  hi_ids = np.zeros(len(dirs), dtype=int)
+  lo_ids = np.zeros(len(dirs), dtype=int)
+  rows = np.arange(len(dirs))
+  for i in range(0, len(pts), block_size):
+    proj = dirs@pts[i:i+block_size].T   #(n_dirs,block_size)
+    ids = proj.argmax(axis=1)
+    vals = proj[rows, ids]
+    better = vals>hi
+    hi[better] = vals[better]
+    hi_ids[better] = ids[better]+i
+    ids = proj.argmin(axis=1)
+    vals = proj[rows, ids]
+    better = vals<lo
+    lo[better] = vals[better]
+    lo_ids[better] = ids[better]+i
+  candidates = pts[np.unique(np.concatenate([hi_ids, lo_ids]))]
+  diameter = max_pairwise_dist(candidates)
+  max_rel_err = 1/np.cos(np.sqrt(2)/n_grid)-1
+  return diameter, float(max_rel_err)
+
+
+def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000, method='sample', max_hull_pts=20000):
+  '''
+  @method: sample: largest distance among n_sample random points (all if None), a lower bound.
+  exact: largest distance among the convex hull vertices, quadratic in their number which is large for dense round scans.
+  approx: compute_diameter_approx, within 0.4%, linear in the number of points. auto: exact unless the hull has more than max_hull_pts vertices, approx otherwise
+  '''
   from sklearn.decomposition import TruncatedSVD
   if mesh is not None:
     u, s, vh = scipy.linalg.svd(mesh.vertices, full_matrices=False)
@@ -594,13 +1007,25 @@ def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000):
     diameter = np.linalg.norm(pts.max(axis=0)-pts.min(axis=0))
     return float(diameter)
 
+  if method in ['exact', 'auto']:
+    hull_pts = hull_vertices(model_pts)
+    if method=='exact' or len(hull_pts)<=max_hull_pts:
+      return max_pairwise_dist(hull_pts)
+    logging.info(f'{len(hull_pts)} hull vertices, approximating the diameter')
+    method = 'approx'
+  if method=='approx':
+    diameter, max_rel_err = compute_diameter_approx(model_pts)
+    logging.info(f'approximate diameter:{diameter}, true diameter at most {100*max_rel_err:.2f}% larger')
+    return diameter
+  if method!='sample':
+    raise RuntimeError(f'unknown diameter method {method}')
+
   if n_sample is None:
     pts = model_pts
   else:
     ids = np.random.choice(len(model_pts), size=min(n_sample, len(model_pts)), replace=False)
     pts = model_pts[ids]
-  dists = np.linalg.norm(pts[None]-pts[:,None], axis=-1)
-  diameter = dists.max()
+  diameter = max_pairwise_dist(pts)
   return diameter
 
 
@@ -610,6 +1035,7 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
   @poses: (B,4,4) tensor
   @min_box: min_box/min_circle
   @scale: scale to apply to the tightly enclosing roi
+  @mesh_diameter: float, or (B) per pose for box_3d
   '''
   def compute_tf_batch(left, right, top, bottom):
     B = len(left)
@@ -618,26 +1044,27 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
     top = top.round()
     bottom = bottom.round()
 
-    tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    tf = torch.eye(3, device=device)[None].expand(B,-1,-1).contiguous()
     tf[:,0,2] = -left
     tf[:,1,2] = -top
-    new_tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    new_tf = torch.eye(3, device=device)[None].expand(B,-1,-1).contiguous()
     new_tf[:,0,0] = out_size[0]/(right-left)
     new_tf[:,1,1] = out_size[1]/(bottom-top)
     tf = new_tf@tf
     return tf
 
   B = len(poses)
-  torch.set_default_tensor_type('torch.cuda.FloatTensor')
+  poses = torch.as_tensor(poses, dtype=torch.float)
+  device = poses.device
   if method=='box_3d':
-    radius = mesh_diameter*crop_ratio/2
+    radius = torch.as_tensor(mesh_diameter, dtype=torch.float, device=device).reshape(-1,1,1)*crop_ratio/2   # scalar or per pose
     offsets = torch.tensor([0,0,0,
-                        radius,0,0,
-                        -radius,0,0,
-                        0,radius,0,
-                        0,-radius,0]).reshape(-1,3)
-    pts = poses[:,:3,3].reshape(-1,1,3)+offsets.reshape(1,-1,3)
-    K = torch.as_tensor(K)
+                        1,0,0,
+                        -1,0,0,
+                        0,1,0,
+                        0,-1,0], dtype=torch.float, device=device).reshape(1,-1,3)*radius
+    pts = poses[:,:3,3].reshape(-1,1,3)+offsets
+    K = torch.as_tensor(K, dtype=torch.float, device=device)
     projected = (K@pts.reshape(-1,3).T).T
     uvs = projected[:,:2]/projected[:,2:3]
     uvs = uvs.reshape(B, -1, 2)
@@ -657,6 +1084,111 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
 
 
 
+def warp_crop_batch(img, tf_to_crops, dsize, mode='bilinear'):
+  '''Sample the crop window of every hypothesis from one full frame, reading only the pixels the crops touch.
+  Same sampling as kornia warp_perspective(img.expand(B,...), tf_to_crops, dsize, align_corners=False) with zero padding, without materializing B full frames
+  @img: (H,W) or (H,W,C) tensor or np array of any dtype, e.g. uint8 rgb
+  @tf_to_crops: (B,3,3) original pixel -> crop pixel
+  @dsize: (h,w)
+  @mode: bilinear/nearest
+  @return: (B,C,h,w) float tensor
+  '''
+  device = tf_to_crops.device
+  img = torch.as_tensor(img, device=device)
+  H,W = img.shape[:2]
+  img = img.reshape(H*W, -1)
+  C = img.shape[1]
+  B = len(tf_to_crops)
+  h,w = dsize
+  vs,us = torch.meshgrid(torch.arange(h, device=device, dtype=torch.float), torch.arange(w, device=device, dtype=torch.float), indexing='ij')
+  uvs = torch.stack([us.reshape(-1), vs.reshape(-1), torch.ones((h*w), device=device)], dim=0)  #(3,h*w)
+  src = tf_to_crops.float().inverse()@uvs[None]
+  src = src[:,:2]/src[:,2:3]
+  # kornia normalizes pixels by (W-1) and grid_sample unnormalizes by W with align_corners=False
+  xs = src[:,0]*W/(W-1)-0.5
+  ys = src[:,1]*H/(H-1)-0.5
+
+  if mode=='nearest':
+    xs = xs.round().long()
+    ys = ys.round().long()
+    valid = (xs>=0) & (xs<W) & (ys>=0) & (ys<H)
+    out = img[(ys.clamp(0,H-1)*W+xs.clamp(0,W-1)).reshape(-1)].reshape(B,h*w,C).float()
+    out = out*valid[...,None]
+  elif mode=='bilinear':
+    x0 = xs.floor()
+    y0 = ys.floor()
+    wx = xs-x0
+    wy = ys-y0
+    x0 = x0.long()
+    y0 = y0.long()
+    out = torch.zeros((B,h*w,C), dtype=torch.float, device=device)
+    for dy in [0,1]:
+      for dx in [0,1]:
+        xi = x0+dx
+        yi = y0+dy
+        weight = (wx if dx else 1-wx)*(wy if dy else 1-wy)
+        weight = weight*((xi>=0) & (xi<W) & (yi>=0) & (yi<H))
+        out += img[(yi.clamp(0,H-1)*W+xi.clamp(0,W-1)).reshape(-1)].reshape(B,h*w,C).float()*weight[...,None]
+  else:
+    raise RuntimeError(f'mode {mode} not supported')
+
+  return out.permute(0,2,1).reshape(B,C,h,w)
+
+
+
+def reproject_render_crops(rgbAs, xyz_mapAs, poses_ref, poses, K, tf_to_crops):
+  '''Forward warp rendered crops from poses_ref to nearby poses with the rendered xyz, z-buffered splatting and 3x3 hole filling.
+  Shading is not updated, so only meant for small pose changes
+  @rgbAs: (B,3,h,w) rendered at poses_ref
+  @xyz_mapAs: (B,3,h,w) camera frame, z<0.001 where there is no object
+  @poses_ref, poses: (B,4,4)
+  @tf_to_crops: (B,3,3) crop windows of poses
+  @return: rgbAs, xyz_mapAs at poses (B,3,h,w), hole_ratio (B) fraction of the silhouette filled instead of splatted
+  '''
+  B,_,h,w = rgbAs.shape
+  device = rgbAs.device
+  K = torch.as_tensor(K, dtype=torch.float, device=device)
+  tf = poses@poses_ref.inverse()
+  pts = xyz_mapAs.permute(0,2,3,1).reshape(B,h*w,3)
+  valid = pts[...,2]>=0.001
+  pts = pts@tf[:,:3,:3].permute(0,2,1) + tf[:,None,:3,3]
+  uvs = pts@K.T
+  uvs = uvs[...,:2]/uvs[...,2:3].clamp(min=1e-6)
+  uvs = uvs@tf_to_crops[:,:2,:2].permute(0,2,1) + tf_to_crops[:,None,:2,2]
+  us = uvs[...,0].round().long()
+  vs = uvs[...,1].round().long()
+  valid = valid & (pts[...,2]>=0.001) & (us>=0) & (us<w) & (vs>=0) & (vs<h)
+
+  ids = torch.arange(B, device=device).reshape(B,1)*h*w + vs.clamp(0,h-1)*w + us.clamp(0,w-1)
+  ids = ids[valid]
+  zs = pts[...,2][valid]
+  zbuf = torch.full((B*h*w,), np.inf, dtype=torch.float, device=device)
+  zbuf.scatter_reduce_(0, ids, zs, reduce='amin')
+  front = zs==zbuf[ids]
+  ids = ids[front]
+  rgb_out = torch.zeros((B*h*w,3), dtype=torch.float, device=device)
+  rgb_out[ids] = rgbAs.permute(0,2,3,1).reshape(B,h*w,3)[valid][front].float()
+  xyz_out = torch.zeros((B*h*w,3), dtype=torch.float, device=device)
+  xyz_out[ids] = pts[valid][front]
+  hit = torch.zeros((B*h*w), dtype=torch.float, device=device)
+  hit[ids] = 1
+  rgb_out = rgb_out.reshape(B,h,w,3).permute(0,3,1,2)
+  xyz_out = xyz_out.reshape(B,h,w,3).permute(0,3,1,2)
+  hit = hit.reshape(B,1,h,w)
+
+  # Holes are pixels inside the morphological closing of the splatted silhouette
+  closed = 1-F.max_pool2d(1-F.max_pool2d(hit, 3, stride=1, padding=1), 3, stride=1, padding=1)
+  holes = (closed>0) & (hit==0)
+  n_hit = F.avg_pool2d(hit, 3, stride=1, padding=1).clamp(min=1e-6)
+  rgb_fill = F.avg_pool2d(rgb_out, 3, stride=1, padding=1)/n_hit
+  xyz_fill = F.avg_pool2d(xyz_out, 3, stride=1, padding=1)/n_hit
+  rgb_out = torch.where(holes, rgb_fill, rgb_out)
+  xyz_out = torch.where(holes, xyz_fill, xyz_out)
+  hole_ratio = holes.reshape(B,-1).sum(dim=-1).float()/(closed>0).reshape(B,-1).sum(dim=-1).clamp(min=1).float()
+  return rgb_out, xyz_out, hole_ratio
+
+
+
 def cv_draw_text(img,text,uv_top_left,color=(255, 255, 255),fontScale=0.5,thickness=1,fontFace=cv2.FONT_HERSHEY_SIMPLEX,outline_color=None,line_spacing=1.5):
   H,W = img.shape[:2]
   uv_top_left = np.array(uv_top_left, dtype=float)
@@ -0,0 +1,73 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Cross-check and time mycpp cluster_poses against cluster_poses_numpy
+
+Random poses are clustered by both, the script exits with an error if the clusters differ.
+Usage: python benchmark_cluster_poses.py --n_poses 252 5000 --n_symmetries 1 36
+'''
+
+from Utils import *
+import argparse
+
+
+def make_poses(n_poses, translation_range, seed=0):
+  rng = np.random.default_rng(seed)
+  poses = np.tile(np.eye(4), (n_poses,1,1))
+  poses[:,:3,:3] = R.random(n_poses, random_state=seed).as_matrix()
+  poses[:,:3,3] = rng.random((n_poses,3))*translation_range
+  return poses.astype(np.float32)
+
+
+def make_symmetry_tfs(n_symmetries):
+  '''Rotations around z, as symmetry_tfs_from_info makes for a continuous symmetry
+  '''
+  tfs = np.tile(np.eye(4), (n_symmetries,1,1))
+  tfs[:,:3,:3] = R.from_euler('z', (np.arange(n_symmetries)*2*np.pi/n_symmetries)[:,None]).as_matrix()
+  return tfs.astype(np.float32)
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--n_poses', type=int, nargs='+', default=[252, 5000])
+  parser.add_argument('--n_symmetries', type=int, nargs='+', default=[1, 36])
+  parser.add_argument('--angle_diff', type=float, default=30, help='degree')
+  parser.add_argument('--dist_diff', type=float, nargs='+', default=[99999, 0.05], help='meter')
+  parser.add_argument('--translation_range', type=float, default=0.2)
+  args = parser.parse_args()
+
+  set_logging_format()
+  rows = []
+  n_mismatch = 0
+  for n_poses in args.n_poses:
+    poses = make_poses(n_poses, args.translation_range)
+    for n_symmetries in args.n_symmetries:
+      symmetry_tfs = make_symmetry_tfs(n_symmetries)
+      for dist_diff in args.dist_diff:
+        begin = time.time()
+        out_numpy = cluster_poses_numpy(args.angle_diff, dist_diff, poses, symmetry_tfs)
+        rows.append((n_poses, n_symmetries, dist_diff, 'numpy', len(out_numpy), time.time()-begin))
+        if mycpp is None:
+          continue
+        begin = time.time()
+        out_cpp = np.asarray(mycpp.cluster_poses(args.angle_diff, dist_diff, poses, symmetry_tfs))
+        rows.append((n_poses, n_symmetries, dist_diff, 'mycpp', len(out_cpp), time.time()-begin))
+        if out_cpp.shape!=out_numpy.shape or not np.array_equal(out_cpp, out_numpy):
+          n_mismatch += 1
+          logging.info(f'n_poses:{n_poses} n_symmetries:{n_symmetries} dist_diff:{dist_diff}, mycpp gives {len(out_cpp)} clusters, numpy {len(out_numpy)}')
+
+  print(f'angle_diff:{args.angle_diff}')
+  print('n_poses  n_sym  dist_diff  engine  n_clusters  time(ms)')
+  for n_poses, n_symmetries, dist_diff, engine, n_clusters, t in rows:
+    print(f'{n_poses:7d}  {n_symmetries:5d}  {dist_diff:9g}  {engine:6s}  {n_clusters:10d}  {t*1000:8.2f}')
+  if mycpp is None:
+    print('mycpp is not built, only the numpy engine was timed and nothing was cross-checked')
+  if n_mismatch>0:
+    raise RuntimeError(f'{n_mismatch} settings give different clusters')
+  print('all engines agree')
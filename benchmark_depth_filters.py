@@ -0,0 +1,92 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Cross-check and time the warp and vectorized torch backends of erode_depth and bilateral_filter_depth
+
+The torch backend on every device is compared against warp on the same device (or on cpu), the script exits with an error on a mismatch.
+Usage: python benchmark_depth_filters.py --sizes 640x480 1280x720 --devices cpu cuda
+'''
+
+from Utils import *
+import argparse
+
+
+def make_depth(H, W, seed=0):
+  '''Two slanted planes with sensor noise, missing pixels and far outliers
+  '''
+  rng = np.random.default_rng(seed)
+  vs, us = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
+  depth = 0.6+0.2*us/W+0.1*vs/H
+  depth[:, W//2:] -= 0.15
+  depth += 0.0005*rng.standard_normal((H,W))
+  depth[rng.random((H,W))<0.05] = 0
+  depth[rng.random((H,W))<0.005] = 150
+  return depth.astype(np.float32)
+
+
+def time_fn(fn, device, repeat):
+  fn()   # warm up, also compiles the warp kernels
+  times = []
+  for _ in range(repeat):
+    if torch.device(device).type=='cuda':
+      torch.cuda.synchronize(device)
+    begin = time.time()
+    out = fn()
+    if torch.device(device).type=='cuda':
+      torch.cuda.synchronize(device)
+    times.append(time.time()-begin)
+  return np.median(times), torch.as_tensor(out).data.cpu().numpy()
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', type=str, nargs='+', default=['640x480', '1280x720'], help='WxH')
+  parser.add_argument('--devices', type=str, nargs='+', default=['cpu', 'cuda'])
+  parser.add_argument('--radius', type=int, default=2)
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--atol', type=float, default=1e-5)
+  args = parser.parse_args()
+
+  set_logging_format()
+  devices = [d for d in args.devices if torch.device(d).type!='cuda' or torch.cuda.is_available()]
+  backends = ['torch'] + (['warp'] if wp is not None else [])
+  filters = {
+    'erode': lambda depth, device, backend: erode_depth(depth, radius=args.radius, device=device, backend=backend),
+    'bilateral': lambda depth, device, backend: bilateral_filter_depth(depth, radius=args.radius, device=device, backend=backend),
+  }
+
+  rows = []
+  n_mismatch = 0
+  for size in args.sizes:
+    W, H = [int(x) for x in size.split('x')]
+    depth = make_depth(H, W)
+    for name, fn in filters.items():
+      outs = {}
+      for device in devices:
+        depth_device = torch.as_tensor(depth, device=device)
+        for backend in backends:
+          t, out = time_fn(lambda: fn(depth_device, device, backend), device, args.repeat)
+          outs[(device, backend)] = out
+          rows.append((size, name, device, backend, t))
+      reference = outs[('cpu', 'warp')] if ('cpu', 'warp') in outs else next(iter(outs.values()))
+      for (device, backend), out in outs.items():
+        err = np.abs(out-reference).max()
+        if err>args.atol:
+          n_mismatch += 1
+          logging.info(f'{size} {name} {device}:{backend} differs from the reference by {err}')
+
+  print(f'radius:{args.radius}, backends:{backends}')
+  print('size        filter     device  backend  time(ms)')
+  for size, name, device, backend, t in rows:
+    print(f'{size:10s}  {name:9s}  {device:6s}  {backend:7s}  {t*1000:8.2f}')
+  if wp is None:
+    print('warp is not installed, only the torch backend was timed and nothing was cross-checked')
+  if n_mismatch>0:
+    raise RuntimeError(f'{n_mismatch} backend outputs differ by more than {args.atol}')
+  print('all backends agree')
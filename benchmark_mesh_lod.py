@@ -0,0 +1,86 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Render time and crop fidelity of each mesh level against the full mesh, on hypothesis crops as the refiner renders them
+
+Usage: python benchmark_mesh_lod.py --mesh_file demo_data/mustard0/mesh/textured_simple.obj --n_poses 252
+'''
+
+from mesh_lod import *
+from render_backend import *
+import argparse
+
+
+def render_crops(backend, mesh_tensors, poses, K, H, W, bbox2d, render_size, repeat):
+  device = poses.device
+  times = []
+  for _ in range(repeat+1):
+    if device.type=='cuda':
+      torch.cuda.synchronize(device)
+    begin = time.time()
+    extra = {}
+    color, depth, _ = backend.render(K=K, H=H, W=W, ob_in_cams=poses, mesh_tensors=mesh_tensors, output_size=(render_size,render_size), bbox2d=bbox2d, use_light=True, extra=extra)
+    if device.type=='cuda':
+      torch.cuda.synchronize(device)
+    times.append(time.time()-begin)
+  return np.median(times[1:]), color, depth
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  code_dir = os.path.dirname(os.path.realpath(__file__))
+  parser.add_argument('--mesh_file', type=str, default=f'{code_dir}/demo_data/mustard0/mesh/textured_simple.obj')
+  parser.add_argument('--backend', type=str, default='nvdiffrast')
+  parser.add_argument('--device', type=str, default='cuda')
+  parser.add_argument('--n_poses', type=int, default=252)
+  parser.add_argument('--render_size', type=int, default=160)
+  parser.add_argument('--crop_ratio', type=float, default=1.2)
+  parser.add_argument('--max_edge_px', type=float, default=2.0)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  set_logging_format()
+  set_seed(0)
+  mesh = trimesh.load(args.mesh_file)
+  mesh.vertices = mesh.vertices - mesh.bounds.mean(axis=0).reshape(1,3)
+  diameter = compute_mesh_diameter(model_pts=mesh.vertices, method='auto')
+  begin = time.time()
+  lod = MeshLOD(mesh)
+  build_time = time.time()-begin
+
+  H, W = 480, 640
+  K = np.array([[600,0,W/2],[0,600,H/2],[0,0,1]])
+  poses = torch.eye(4, dtype=torch.float, device=args.device)[None].repeat(args.n_poses,1,1)
+  poses[:,:3,:3] = torch.as_tensor(R.random(args.n_poses, random_state=0).as_matrix(), dtype=torch.float, device=args.device)
+  poses[:,2,3] = diameter*3
+  # Same footprint as compute_crop_window_tf_batch: a crop_ratio*diameter wide window around the object center
+  radius = K[0,0]*diameter*args.crop_ratio/2/(diameter*3)
+  bbox2d = torch.as_tensor([W/2-radius, H/2-radius, W/2+radius, H/2+radius], dtype=torch.float, device=args.device).reshape(1,4).expand(args.n_poses,4)
+  px_per_meter = args.render_size/(args.crop_ratio*diameter)
+  selected = lod.select(px_per_meter, max_edge_px=args.max_edge_px)
+
+  backend = make_render_backend(args.backend, device=args.device)
+  rows = []
+  for level in range(len(lod.meshes)):
+    mesh_tensors = lod.get_mesh_tensors(level, device=args.device)
+    t, color, depth = render_crops(backend, mesh_tensors, poses, K, H, W, bbox2d, args.render_size, args.repeat)
+    if level==0:
+      t_full, color_full, depth_full = t, color, depth
+    mask = depth>0
+    mask_full = depth_full>0
+    iou = ((mask&mask_full).sum()/(mask|mask_full).sum().clamp(min=1)).item()
+    both = mask&mask_full
+    rgb_err = ((color-color_full).abs()[both].mean()*255).item() if both.any() else 0
+    depth_err = ((depth-depth_full).abs()[both].median()*1000).item() if both.any() else 0
+    rows.append((level, len(lod.meshes[level].faces), lod.edge_lengths[level]*px_per_meter, t, t_full/t, iou, rgb_err, depth_err))
+
+  print(f'faces:{len(mesh.faces)}, diameter:{diameter:.3f}, crop px per meter:{px_per_meter:.1f}, lod build time:{build_time:.2f}s, selected level at max_edge_px {args.max_edge_px}: {selected}')
+  print('level  faces    edge(px)  time(s)  speedup  silhouette_iou  rgb_err(0-255)  depth_err(mm)')
+  for level, n_faces, edge_px, t, speedup, iou, rgb_err, depth_err in rows:
+    print(f"{level:5d}{'*' if level==selected else ' '} {n_faces:7d}  {edge_px:8.2f}  {t:7.4f}  {speedup:7.2f}  {iou:14.4f}  {rgb_err:14.2f}  {depth_err:13.3f}")
@@ -0,0 +1,83 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Compare the all-hypotheses register path against the successive-halving schedule on wall time and the best score reached
+
+Usage: python benchmark_register_schedule.py --test_scene_dir demo_data/mustard0 --cam_number 0 --prompt mustard --keep_ratio 0.5
+'''
+
+from estimater import *
+from datareader import *
+import argparse
+
+
+def time_register(est, reader, frame, mask, iteration, keep_ratio=None, rounds=None):
+  color = reader.get_color(frame)
+  depth = reader.get_depth(frame)
+  if est.device.type=='cuda':
+    torch.cuda.synchronize(est.device)
+  begin = time.time()
+  pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=iteration, keep_ratio=keep_ratio, rounds=rounds)
+  if est.device.type=='cuda':
+    torch.cuda.synchronize(est.device)
+  return pose, time.time()-begin
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  code_dir = os.path.dirname(os.path.realpath(__file__))
+  parser.add_argument('--mesh_file', type=str, default=f'{code_dir}/demo_data/mustard0/mesh/textured_simple.obj')
+  parser.add_argument('--test_scene_dir', type=str, default=f'{code_dir}/demo_data/mustard0')
+  parser.add_argument('--cam_number', type=int)
+  parser.add_argument('--prompt', type=str, required=True, help='mask dir suffix, masks are read from _masks_<prompt>')
+  parser.add_argument('--frames', type=int, nargs='+', default=[0])
+  parser.add_argument('--iteration', type=int, default=5)
+  parser.add_argument('--keep_ratio', type=float, default=0.5)
+  parser.add_argument('--rounds', type=int, default=None)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--device', type=str, default='cuda')
+  args = parser.parse_args()
+
+  set_logging_format()
+  set_seed(0)
+  mesh = trimesh.load(args.mesh_file)
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, debug=0, device=args.device)
+  reader = YcbineoatReader(video_dir=args.test_scene_dir, cam_num=args.cam_number, shorter_side=None, zfar=np.inf)
+
+  rows = []
+  for frame in args.frames:
+    mask = reader.get_mask(frame, dirname="_masks_"+args.prompt).astype(bool)
+    time_register(est, reader, frame, mask, args.iteration)   # warm up
+
+    times = {'full':[], 'halving':[]}
+    for _ in range(args.repeat):
+      _, t = time_register(est, reader, frame, mask, args.iteration)
+      times['full'].append(t)
+    pose_full = est.pose_last.clone()
+    n_full = len(est.poses)
+    best_score_full = est.logits[0].item()
+    for _ in range(args.repeat):
+      _, t = time_register(est, reader, frame, mask, args.iteration, keep_ratio=args.keep_ratio, rounds=args.rounds)
+      times['halving'].append(t)
+    pose_halving = est.pose_last.clone()
+    best_score_halving = est.logits[0].item()
+
+    # Scores are relative to the hypotheses scored together, so rank the two winners head to head
+    depth = bilateral_filter_depth(erode_depth(reader.get_depth(frame), radius=2, device=str(est.device)), radius=2, device=str(est.device))
+    est.scorer.predict(mesh=est.mesh, rgb=reader.get_color(frame), depth=depth, K=reader.K, ob_in_cams=torch.stack([pose_full, pose_halving], dim=0).data.cpu().numpy(), mesh_tensors=est.mesh_tensors, glctx=est.glctx, mesh_diameter=est.diameter)
+    R_diff = pose_full[:3,:3].data.cpu().numpy().T@pose_halving[:3,:3].data.cpu().numpy()
+    rot_diff = np.rad2deg(np.arccos(np.clip((np.trace(R_diff)-1)/2, -1, 1)))
+    trans_diff = torch.norm(pose_full[:3,3]-pose_halving[:3,3]).item()
+    logits = est.scorer.last_logits
+    rows.append((frame, n_full, np.median(times['full']), np.median(times['halving']), logits[0].item(), logits[1].item(), best_score_full, best_score_halving, rot_diff, trans_diff))
+
+  print(f"keep_ratio:{args.keep_ratio}, rounds:{args.rounds}, iteration:{args.iteration}, halving alive per round:{est.halving_stats['n_alive']}")
+  print('frame  n_hypo  full_time(s)  halving_time(s)  speedup  head2head_full  head2head_halving  full_best  halving_best  rot_diff(deg)  trans_diff(m)')
+  for frame, n, t_full, t_halving, s_full, s_halving, s_best_full, s_best, rot_diff, trans_diff in rows:
+    print(f'{frame:5d}  {n:6d}  {t_full:12.3f}  {t_halving:15.3f}  {t_full/t_halving:7.2f}  {s_full:14.3f}  {s_halving:17.3f}  {s_best_full:9.3f}  {s_best:12.3f}  {rot_diff:13.2f}  {trans_diff:13.4f}')
@@ -0,0 +1,85 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Rendering throughput of each RenderBackend on the ROI crops the refiner and scorer render
+
+Usage: python benchmark_render_backend.py --mesh_file demo_data/mustard0/mesh/textured_simple.obj --backends nvdiffrast:cuda torch:cpu
+'''
+
+from render_backend import *
+import argparse
+
+
+def make_poses(n, distance, device):
+  rots = torch.as_tensor(R.random(n, random_state=0).as_matrix(), dtype=torch.float, device=device)
+  poses = torch.eye(4, dtype=torch.float, device=device)[None].repeat(n,1,1)
+  poses[:,:3,:3] = rots
+  poses[:,2,3] = distance
+  return poses
+
+
+def time_backend(backend, K, H, W, poses, mesh_tensors, output_size, bbox2d, repeat):
+  device = poses.device
+  backend.render(K=K, H=H, W=W, ob_in_cams=poses, mesh_tensors=mesh_tensors, output_size=output_size, bbox2d=bbox2d, use_light=True, extra={})   # warm up
+  times = []
+  for _ in range(repeat):
+    if device.type=='cuda':
+      torch.cuda.synchronize(device)
+    begin = time.time()
+    extra = {}
+    color, depth, _ = backend.render(K=K, H=H, W=W, ob_in_cams=poses, mesh_tensors=mesh_tensors, output_size=output_size, bbox2d=bbox2d, use_light=True, extra=extra)
+    if device.type=='cuda':
+      torch.cuda.synchronize(device)
+    times.append(time.time()-begin)
+  return np.median(times), color, depth
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  code_dir = os.path.dirname(os.path.realpath(__file__))
+  parser.add_argument('--mesh_file', type=str, default=f'{code_dir}/demo_data/mustard0/mesh/textured_simple.obj')
+  parser.add_argument('--backends', type=str, nargs='+', default=['nvdiffrast:cuda', 'torch:cpu'], help='name:device pairs')
+  parser.add_argument('--n_poses', type=int, nargs='+', default=[1, 32, 252])
+  parser.add_argument('--render_size', type=int, default=160)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  set_logging_format()
+  set_seed(0)
+  mesh = trimesh.load(args.mesh_file)
+  mesh.vertices = mesh.vertices - mesh.bounds.mean(axis=0).reshape(1,3)
+  diameter = compute_mesh_diameter(model_pts=mesh.vertices, method='auto')
+  H, W = 480, 640
+  K = np.array([[600,0,W/2],[0,600,H/2],[0,0,1]])
+  output_size = (args.render_size, args.render_size)
+
+  rows = []
+  reference = {}
+  for spec in args.backends:
+    name, device = spec.split(':')
+    backend = make_render_backend(name, device=device)
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+    for n in args.n_poses:
+      poses = make_poses(n, distance=diameter*3, device=device)
+      radius = 600*diameter*0.6/(diameter*3)
+      bbox2d = torch.as_tensor([W/2-radius, H/2-radius, W/2+radius, H/2+radius], dtype=torch.float, device=device).reshape(1,4).expand(n,4)
+      t, color, depth = time_backend(backend, K, H, W, poses, mesh_tensors, output_size, bbox2d, args.repeat)
+      # Agreement with the first backend on the same poses
+      depth = depth.data.cpu()
+      if n not in reference:
+        reference[n] = depth
+        mismatch = 0
+      else:
+        mismatch = ((depth>0)!=(reference[n]>0)).float().mean().item()
+      rows.append((spec, n, t, n/t, mismatch))
+
+  print(f'render size:{args.render_size}, faces:{len(mesh.faces)}')
+  print('backend            n_poses  time(s)  renders/s  silhouette_mismatch')
+  for spec, n, t, throughput, mismatch in rows:
+    print(f'{spec:17s}  {n:7d}  {t:7.3f}  {throughput:9.1f}  {mismatch:19.4f}')
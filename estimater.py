@@ -12,19 +12,50 @@ from datareader import *
 import itertools
 from learning.training.predict_score import *
 from learning.training.predict_pose_refine import *
+from hypothesis_prefilter import *
+from object_pack import *
+from render_backend import *
+from mesh_lod import *
+from template_bank import *
 import yaml
 
 
+ROT_GRID_CACHE_DIR = f"{os.environ.get('FOUNDATIONPOSE_CACHE_DIR', os.path.dirname(os.path.realpath(__file__))+'/cache')}/rot_grid"
+TEMPLATE_BANK_CACHE_DIR = f"{os.environ.get('FOUNDATIONPOSE_CACHE_DIR', os.path.dirname(os.path.realpath(__file__))+'/cache')}/template_bank"
+
+
 class FoundationPose:
-  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir=None):
+  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir=None, device='cuda', prefilter:HypothesisPrefilter=None, object_pack=None, mesh_lod_px=None, tex_format=None, template_bank_dir=None, depth_roi_pad=None):
+    '''
+    @depth_roi_pad: if set, register and track filter the depth and compute the xyz map only inside the object mask box and the crop windows of the hypotheses,
+    each grown by this fraction of its size to leave room for the refinement motion. Zero elsewhere. None processes the full frame
+    @template_bank_dir: if set, the crops of the rotation grid are rendered once into a TemplateBank cached in this dir, and the first refine iteration of register reprojects them instead of rendering, see template_bank.py
+    @object_pack: optional ObjectPack or pack path, used instead of computing the object assets from mesh
+    @tex_format: None uploads the texture as float32, 'uint8' or 'half' store a mip pyramid and render with the level matching the crop, see make_texture_tensors
+    @mesh_lod_px: if set, hypotheses are rendered with the coarsest decimated mesh whose mean edge spans at most this many crop pixels, see mesh_lod.py
+    @prefilter: optional HypothesisPrefilter ranking the rotation grid in register, only its top hypotheses are refined. If None, every other hypothesis is kept
+    '''
     self.gt_pose = None
+    self.device = torch.device(device)
+    self.prefilter = prefilter
+    self.prefilter_stats = {}
     self.ignore_normal_flip = True
     self.debug = debug
     self.debug_dir = debug_dir
+    self.mesh_lod_px = mesh_lod_px
+    self.tex_format = tex_format
+    self.template_bank_dir = template_bank_dir
+    self.depth_roi_pad = depth_roi_pad
+    self.template_bank = None
+    self.scorer = None
+    self.refiner = None
     if self.debug_dir is not None:
       os.makedirs(debug_dir, exist_ok=True)
 
-    self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
+    if object_pack is not None:
+      self.reset_object_from_pack(object_pack, symmetry_tfs=symmetry_tfs)
+    else:
+      self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
     self.make_rotation_grid(min_n_views=40, inplane_step=60)
 
     self.glctx = glctx
@@ -32,79 +63,158 @@ class FoundationPose:
     if scorer is not None:
       self.scorer = scorer
     else:
-      self.scorer = ScorePredictor()
+      self.scorer = ScorePredictor(device=self.device)
 
     if refiner is not None:
       self.refiner = refiner
     else:
-      self.refiner = PoseRefinePredictor()
+      self.refiner = PoseRefinePredictor(device=self.device)
+    self.select_mesh_lod()
+    self.update_template_bank()
 
     self.pose_last = None   # Used for tracking; per the centered mesh
 
 
   def reset_object(self, model_pts, model_normals, symmetry_tfs=None, mesh=None):
-    max_xyz = mesh.vertices.max(axis=0)
-    min_xyz = mesh.vertices.min(axis=0)
-    self.model_center = (min_xyz+max_xyz)/2
-    if mesh is not None:
-      self.mesh_ori = mesh.copy()
-      mesh = mesh.copy()
-      mesh.vertices = mesh.vertices - self.model_center.reshape(1,3)
-
-    model_pts = mesh.vertices
-    self.diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=10000)
-    self.vox_size = max(self.diameter/20.0, 0.003)
+    assets = make_object_assets(mesh, model_normals)
+    self.set_object_assets(assets, symmetry_tfs=symmetry_tfs)
+    self.mesh_path = f'/tmp/{uuid.uuid4()}.obj'
+    self.mesh.export(self.mesh_path)
+    self.mesh_tensors_full = make_mesh_tensors(self.mesh, device=self.device, tex_format=self.tex_format)
+    self.mesh_lod = None
+    self.select_mesh_lod()
+    self.update_template_bank()
+    logging.info("reset done")
+
+
+  def reset_object_from_pack(self, pack, symmetry_tfs=None):
+    '''Same as reset_object but hydrated from a precompiled object pack, skipping the diameter, downsampling and mesh export
+    @pack: ObjectPack or path written by make_object_pack
+    '''
+    if not isinstance(pack, ObjectPack):
+      pack = ObjectPack(pack)
+    mesh, mesh_ori = pack.make_mesh()
+    assets = {
+      'model_center': pack.model_center,
+      'mesh_ori': mesh_ori,
+      'mesh': mesh,
+      'diameter': pack.diameter,
+      'vox_size': pack.vox_size,
+      'pts': pack.arrays['pts'],
+      'normals': pack.arrays['normals'],
+    }
+    self.set_object_assets(assets, symmetry_tfs=symmetry_tfs)
+    self.mesh_path = pack.path
+    self.mesh_tensors_full = pack.make_mesh_tensors(device=self.device, tex_format=self.tex_format)
+    self.mesh_lod = None
+    self.select_mesh_lod()
+    self.update_template_bank()
+    logging.info("reset from pack done")
+
+
+  def select_mesh_lod(self):
+    '''Set self.mesh_tensors, the mesh used to render hypotheses, to the full mesh or to a decimated level per self.mesh_lod_px
+    '''
+    self.mesh_tensors = self.mesh_tensors_full
+    self.mesh_lod_level = 0
+    if self.mesh_lod_px is None or (self.refiner is None and self.scorer is None):
+      return
+    if self.mesh_lod is None:
+      self.mesh_lod = MeshLOD(self.mesh)
+    px_per_meter = crop_px_per_meter(self.diameter, [self.refiner, self.scorer])
+    self.mesh_lod_level = self.mesh_lod.select(px_per_meter, max_edge_px=self.mesh_lod_px)
+    if self.mesh_lod_level>0:
+      self.mesh_tensors = self.mesh_lod.get_mesh_tensors(self.mesh_lod_level, device=self.device)
+    logging.info(f'mesh lod level:{self.mesh_lod_level}, faces:{len(self.mesh_lod.meshes[self.mesh_lod_level].faces)}/{len(self.mesh.faces)}, crop px per meter:{px_per_meter:.1f}')
+
+
+  def update_template_bank(self):
+    '''Load or render the TemplateBank of the current mesh, rotation grid and refiner crop, if self.template_bank_dir is set
+    '''
+    self.template_bank = None
+    if self.template_bank_dir is None or self.refiner is None or not hasattr(self, 'rot_grid'):
+      return
+    key = template_bank_key(self.mesh, self.rot_grid.data.cpu().numpy(), self.refiner.cfg, extra_key=f'lod{self.mesh_lod_level}_tex{self.tex_format}')
+    self.template_bank = load_or_make_template_bank(key, self.rot_grid, self.mesh_tensors, self.diameter, self.refiner.cfg, out_dir=self.template_bank_dir, glctx=self.glctx, device=self.device)
+
+
+  def set_object_assets(self, assets, symmetry_tfs=None):
+    '''
+    @assets: dict from make_object_assets
+    '''
+    self.model_center = assets['model_center']
+    self.mesh_ori = assets['mesh_ori']
+    self.mesh = assets['mesh']
+    self.diameter = assets['diameter']
+    self.vox_size = assets['vox_size']
     logging.info(f'self.diameter:{self.diameter}, vox_size:{self.vox_size}')
     self.dist_bin = self.vox_size/2
     self.angle_bin = 20  # Deg
-    pcd = toOpen3dCloud(model_pts, normals=model_normals)
-    pcd = pcd.voxel_down_sample(self.vox_size)
-    self.max_xyz = np.asarray(pcd.points).max(axis=0)
-    self.min_xyz = np.asarray(pcd.points).min(axis=0)
-    self.pts = torch.tensor(np.asarray(pcd.points), dtype=torch.float32, device='cuda')
-    self.normals = F.normalize(torch.tensor(np.asarray(pcd.normals), dtype=torch.float32, device='cuda'), dim=-1)
+    pts = np.asarray(assets['pts'])
+    self.max_xyz = pts.max(axis=0)
+    self.min_xyz = pts.min(axis=0)
+    self.pts = torch.tensor(pts, dtype=torch.float32, device=self.device)
+    self.normals = F.normalize(torch.tensor(np.asarray(assets['normals']), dtype=torch.float32, device=self.device), dim=-1)
     logging.info(f'self.pts:{self.pts.shape}')
-    self.mesh_path = None
-    self.mesh = mesh
-    if self.mesh is not None:
-      self.mesh_path = f'/tmp/{uuid.uuid4()}.obj'
-      self.mesh.export(self.mesh_path)
-    self.mesh_tensors = make_mesh_tensors(self.mesh)
 
     if symmetry_tfs is None:
-      self.symmetry_tfs = torch.eye(4).float().cuda()[None]
+      self.symmetry_tfs = torch.eye(4, dtype=torch.float, device=self.device)[None]
     else:
-      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device='cuda', dtype=torch.float)
-
-    logging.info("reset done")
+      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device=self.device, dtype=torch.float)
 
 
 
   def get_tf_to_centered_mesh(self):
-    tf_to_center = torch.eye(4, dtype=torch.float, device='cuda')
-    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device='cuda', dtype=torch.float)
+    tf_to_center = torch.eye(4, dtype=torch.float, device=self.device)
+    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device=self.device, dtype=torch.float)
     return tf_to_center
 
 
   def to_device(self, s='cuda:0'):
+    self.device = torch.device(s)
     for k in self.__dict__:
       self.__dict__[k] = self.__dict__[k]
       if torch.is_tensor(self.__dict__[k]) or isinstance(self.__dict__[k], nn.Module):
         logging.info(f"Moving {k} to device {s}")
         self.__dict__[k] = self.__dict__[k].to(s)
-    for k in self.mesh_tensors:
+    for k in self.mesh_tensors_full:
       logging.info(f"Moving {k} to device {s}")
-      self.mesh_tensors[k] = self.mesh_tensors[k].to(s)
+      self.mesh_tensors_full[k] = self.mesh_tensors_full[k].to(s)
     if self.refiner is not None:
       self.refiner.model.to(s)
+      self.refiner.device = self.device
+      self.refiner.dataset.device = self.device
     if self.scorer is not None:
       self.scorer.model.to(s)
-    if self.glctx is not None:
-      self.glctx = dr.RasterizeCudaContext(s)
+      self.scorer.device = self.device
+      self.scorer.dataset.device = self.device
+    self.select_mesh_lod()
+    if isinstance(self.glctx, RenderBackend):
+      self.glctx = self.glctx.to(s)
+    elif self.glctx is not None:
+      self.glctx = dr.RasterizeCudaContext(s) if self.device.type=='cuda' else None
+    if self.template_bank is not None:
+      self.template_bank.to(s)
 
 
 
-  def make_rotation_grid(self, min_n_views=40, inplane_step=60):
+  def make_rotation_grid(self, min_n_views=40, inplane_step=60, cache_dir=ROT_GRID_CACHE_DIR):
+    '''
+    @cache_dir: clustered grids are stored here as .npy keyed by (min_n_views, inplane_step, symmetry_tfs) and memory-mapped on reuse. None disables the cache
+    '''
+    angle_diff = 30
+    dist_diff = 99999
+    symmetry_tfs = self.symmetry_tfs.data.cpu().numpy()
+    cache_file = None
+    if cache_dir is not None:
+      key = hash_arrays(np.array([min_n_views, inplane_step, angle_diff, dist_diff]), symmetry_tfs)
+      cache_file = f'{cache_dir}/views{min_n_views}_inplane{inplane_step}_{key[:16]}.npy'
+      if os.path.exists(cache_file):
+        rot_grid = np.load(cache_file, mmap_mode='r')
+        self.rot_grid = torch.as_tensor(np.array(rot_grid), device=self.device, dtype=torch.float)
+        logging.info(f"self.rot_grid: {self.rot_grid.shape} loaded from {cache_file}")
+        return
+
     cam_in_obs = sample_views_icosphere(n_views=min_n_views)
     logging.info(f'cam_in_obs:{cam_in_obs.shape}')
     rot_grid = []
@@ -118,10 +228,14 @@ class FoundationPose:
 
     rot_grid = np.asarray(rot_grid)
     logging.info(f"rot_grid:{rot_grid.shape}")
-    rot_grid = mycpp.cluster_poses(30, 99999, rot_grid, self.symmetry_tfs.data.cpu().numpy())
-    rot_grid = np.asarray(rot_grid)
+    rot_grid = cluster_poses(angle_diff, dist_diff, rot_grid, symmetry_tfs)
     logging.info(f"after cluster, rot_grid:{rot_grid.shape}")
-    self.rot_grid = torch.as_tensor(rot_grid, device='cuda', dtype=torch.float)
+    if cache_file is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+      tmp_file = f'{cache_file}.{uuid.uuid4()}.tmp.npy'
+      np.save(tmp_file, rot_grid.astype(np.float32))
+      os.replace(tmp_file, cache_file)   # atomic, concurrent workers never see a partial file
+    self.rot_grid = torch.as_tensor(rot_grid, device=self.device, dtype=torch.float)
     # self.rot_grid = torch.tensor(sample_views_near_identity(200, max_angle_degrees=15), device='cuda', dtype=torch.float)
     logging.info(f"self.rot_grid: {self.rot_grid.shape}")
 
@@ -132,7 +246,7 @@ class FoundationPose:
     '''
     ob_in_cams = self.rot_grid.clone()
     center = self.guess_translation(depth=depth, mask=mask, K=K)
-    ob_in_cams[:,:3,3] = torch.tensor(center, device='cuda', dtype=torch.float).reshape(1,3)
+    ob_in_cams[:,:3,3] = torch.tensor(center, device=self.device, dtype=torch.float).reshape(1,3)
     return ob_in_cams
 
 
@@ -158,22 +272,168 @@ class FoundationPose:
     return center.reshape(3)
 
 
-  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5, init_rot_guess=None):
+  def make_register_hypotheses(self, K, rgb, depth, ob_mask, ob_id=None, init_rot_guess=None):
+    '''Pose hypotheses (wrt. the centered mesh) to be refined and scored by register
+    @depth: filtered depth
+    '''
+    self.H, self.W = depth.shape[:2]
+    self.K = K
+    self.ob_id = ob_id
+    self.ob_mask = ob_mask
+
+    poses = self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None)
+    # if self.pose_last is not None:
+    if False:
+      poses[:, :3, :3] = self.pose_last[:3,:3].reshape(1,3,3)
+      poses = poses[0:2]  # all of the pose vectors are identical
+    elif init_rot_guess is not None:
+      # poses[:, :3, :3] = torch.eye(3, device='cuda')
+      poses[:, :3, :3] = torch.tensor(init_rot_guess, device=self.device, dtype=torch.float).reshape(1,3,3)
+      # # TODO integrate this more correctly
+      poses = poses[0:2]  # all of the pose vectors are identical
+    elif self.prefilter is None:
+      # only keep every other pose guess to save memory
+      poses = poses[::2]
+
+    poses = poses.data.cpu().numpy()
+    logging.info(f'poses:{poses.shape}')
+    center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
+
+    poses = torch.as_tensor(poses, device=self.device, dtype=torch.float)
+    poses[:,:3,3] = torch.as_tensor(center.reshape(1,3), device=self.device)
+
+    self.prefilter_stats = {}
+    if self.prefilter is not None and init_rot_guess is None:
+      begin = time.time()
+      n_in = len(poses)
+      poses, _, _ = self.prefilter.select(self, poses, K=K, depth=depth, ob_mask=ob_mask)
+      self.prefilter_stats = {'n_in':n_in, 'n_kept':len(poses), 'prefilter_time':time.time()-begin}
+      logging.info(f'prefilter kept {len(poses)}/{n_in} hypotheses')
+
+    add_errs = self.compute_add_err_to_gt_pose(poses)
+    logging.info(f"after viewpoint, add_errs min:{add_errs.min()}")
+    return poses
+
+
+  def select_best_pose(self, poses, scores, logits):
+    '''Sort the scored hypotheses, keep them for tracking and return the best pose wrt. the original mesh
+    @scores: ranking scores, e.g. tournament scores of ScorePredictor.predict
+    @logits: raw scorer logits of the same hypotheses, kept in self.logits
+    '''
+    ids = torch.as_tensor(scores).argsort(descending=True)
+    logging.info(f'sort ids:{ids}')
+    scores = scores[ids]
+    logits = logits[ids]
+    poses = poses[ids]
+
+    logging.info(f'sorted scores:{scores}')
+
+    best_pose = poses[0]@self.get_tf_to_centered_mesh()
+    self.pose_last = poses[0]
+    self.best_id = ids[0]
+
+    self.poses = poses
+    self.scores = scores
+    self.logits = logits
+
+    return best_pose.data.cpu().numpy()
+
+
+  def update_prefilter_stats(self, refine_time, n_refined):
+    '''Estimate the refiner time saved by the prefilter from the measured per-hypothesis refine time
+    '''
+    if len(self.prefilter_stats)==0:
+      return
+    n_dropped = self.prefilter_stats['n_in']-self.prefilter_stats['n_kept']
+    self.prefilter_stats['refine_time'] = refine_time
+    self.prefilter_stats['refine_time_saved'] = refine_time/max(n_refined,1)*n_dropped
+    logging.info(f'prefilter stats: {self.prefilter_stats}')
+
+
+  def scorer_reuses_refiner_crops(self):
+    '''Whether the scorer takes the crops of refiner.predict(get_pose_data=True) instead of rendering its own, i.e. both crop the same way
+    '''
+    scorer_cfg = self.scorer.cfg
+    refiner_cfg = self.refiner.cfg
+    return scorer_cfg['crop_ratio']==refiner_cfg['crop_ratio'] and tuple(scorer_cfg['input_resize'])==tuple(refiner_cfg['input_resize']) and (refiner_cfg['use_normal'] or not scorer_cfg['use_normal'])
+
+
+  def refine_and_score_halving(self, K, rgb, depth, xyz_map, poses, iteration=5, keep_ratio=0.5, rounds=None):
+    '''Successive halving: refine the survivors for a share of the iteration budget, score them and keep the best keep_ratio, until the rounds are used up
+    @poses: (N,4,4) tensor wrt. the centered mesh
+    @rounds: defaults to iteration, i.e. one refine iteration per round
+    @return: poses (N,4,4), scores (N), logits (N). Hypotheses dropped in an earlier round rank below every later survivor, logits are the raw scorer logits of the last round each hypothesis was scored in
+    '''
+    rounds = iteration if rounds is None else int(np.clip(rounds, 1, iteration))
+    iters = np.full(rounds, iteration//rounds)
+    iters[:iteration%rounds] += 1
+    poses = torch.as_tensor(poses, device=self.device, dtype=torch.float).clone()
+    scores = torch.zeros((len(poses)), dtype=torch.float, device=self.device)
+    logits = torch.zeros((len(poses)), dtype=torch.float, device=self.device)
+    alive = torch.arange(len(poses), device=self.device)
+    self.halving_stats = {'n_alive':[]}
+    pose_data = None
+    for r in range(rounds):
+      self.halving_stats['n_alive'].append(len(alive))
+      # The renders of the refined poses are shared by the scorer and the next round's first refine iteration
+      get_pose_data = r<rounds-1 or self.scorer_reuses_refiner_crops()
+      poses[alive] = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses[alive].data.cpu().numpy(), normal_map=None, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=int(iters[r]), pose_data=pose_data, get_pose_data=get_pose_data, template_bank=self.template_bank)[0].reshape(-1,4,4)
+      scores_cur = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses[alive].data.cpu().numpy(), normal_map=None, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, pose_data=self.refiner.last_pose_data)[0]
+      pose_data = self.refiner.last_pose_data
+      self.refiner.last_pose_data = None
+      logits[alive] = self.scorer.last_logits
+      self.halving_stats['best_score'] = self.scorer.last_logits[scores_cur.argmax()].item()
+      if r>0:
+        # Shift above every earlier score so the sorting keeps the elimination order
+        scores_cur = scores_cur - scores_cur.min() + scores.max() + 1
+      scores[alive] = scores_cur
+      if r==rounds-1:
+        break
+      n_keep = int(np.clip(np.ceil(len(alive)*keep_ratio), 1, len(alive)))
+      keep = scores_cur.argsort(descending=True)[:n_keep]
+      alive = alive[keep]
+      pose_data = pose_data.select_by_indices(keep)
+    logging.info(f'halving stats: {self.halving_stats}')
+    return poses, scores, logits
+
+
+  def crop_roi(self, K, poses, H, W):
+    '''Union of the refiner and scorer crop windows of poses, grown by self.depth_roi_pad, see crop_windows_roi
+    '''
+    poses = torch.as_tensor(poses, dtype=torch.float, device=self.device).reshape(-1,4,4)
+    rois = []
+    for predictor in [self.refiner, self.scorer]:
+      out_size = (predictor.cfg['input_resize'][1], predictor.cfg['input_resize'][0])
+      tf_to_crops = compute_crop_window_tf_batch(H=H, W=W, poses=poses, K=K, crop_ratio=predictor.cfg['crop_ratio'], out_size=out_size, method='box_3d', mesh_diameter=self.diameter)
+      rois.append(crop_windows_roi(tf_to_crops, out_size, H, W, pad=self.depth_roi_pad))
+    return roi_union(*rois)
+
+
+  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5, init_rot_guess=None, keep_ratio=None, rounds=None):
     '''Copmute pose from given pts to self.pcd
     @pts: (N,3) np array, downsampled scene points
+    @keep_ratio: if set, interleave refinement and scoring with refine_and_score_halving instead of refining all hypotheses for the full iteration budget
+    @rounds: number of halving rounds, see refine_and_score_halving
     '''
     set_seed(0)
     logging.info('Welcome')
 
     if self.glctx is None:
-      if glctx is None:
-        self.glctx = dr.RasterizeCudaContext()
-        # self.glctx = dr.RasterizeGLContext()
-      else:
+      if glctx is not None:
         self.glctx = glctx
+      elif self.device.type=='cuda':
+        self.glctx = dr.RasterizeCudaContext(self.device)
+        # self.glctx = dr.RasterizeGLContext()
 
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
+    depth_raw = depth
+    roi = None
+    if self.depth_roi_pad is not None:
+      roi = mask_roi(ob_mask, pad=self.depth_roi_pad)
+    if roi is None:
+      depth = erode_depth(depth, radius=2, device=str(self.device))
+      depth = bilateral_filter_depth(depth, radius=2, device=str(self.device))
+    else:
+      depth, _ = preprocess_depth_roi(depth_raw, K, roi, radius=2, device=str(self.device))
 
     if self.debug>=2 and self.debug_dir is not None:
       xyz_map = depth2xyzmap(depth, K)
@@ -197,70 +457,44 @@ class FoundationPose:
       pcd = toOpen3dCloud(xyz_map[valid], rgb[valid])
       o3d.io.write_point_cloud(f'{self.debug_dir}/scene_complete.ply',pcd)
 
-    self.H, self.W = depth.shape[:2]
-    self.K = K
-    self.ob_id = ob_id
-    self.ob_mask = ob_mask
+    poses = self.make_register_hypotheses(K=K, rgb=rgb, depth=depth, ob_mask=ob_mask, ob_id=ob_id, init_rot_guess=init_rot_guess)
 
-    poses = self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None)
-    # if self.pose_last is not None:
-    if False:
-      poses[:, :3, :3] = self.pose_last[:3,:3].reshape(1,3,3)
-      poses = poses[0:2]  # all of the pose vectors are identical
-    elif init_rot_guess is not None:
-      # poses[:, :3, :3] = torch.eye(3, device='cuda')
-      poses[:, :3, :3] = torch.tensor(init_rot_guess, device='cuda', dtype=torch.float).reshape(1,3,3)
-      # # TODO integrate this more correctly
-      poses = poses[0:2]  # all of the pose vectors are identical
+    if roi is None:
+      xyz_map = depth2xyzmap(depth, K)
     else:
-      # only keep every other pose guess to save memory
-      poses = poses[::2]
-
-    poses = poses.data.cpu().numpy()
-    logging.info(f'poses:{poses.shape}')
-    center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
-
-    poses = torch.as_tensor(poses, device='cuda', dtype=torch.float)
-    poses[:,:3,3] = torch.as_tensor(center.reshape(1,3), device='cuda')
-
-    add_errs = self.compute_add_err_to_gt_pose(poses)
-    logging.info(f"after viewpoint, add_errs min:{add_errs.min()}")
-
-    xyz_map = depth2xyzmap(depth, K)
-    poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2)
+      roi = roi_union(roi, self.crop_roi(K, poses, depth.shape[0], depth.shape[1]))
+      depth, xyz_map = preprocess_depth_roi(depth_raw, K, roi, radius=2, device=str(self.device))
+      logging.info(f'depth roi:{roi}')
+    if keep_ratio is not None:
+      poses, scores, logits = self.refine_and_score_halving(K=K, rgb=rgb, depth=depth, xyz_map=xyz_map, poses=poses, iteration=iteration, keep_ratio=keep_ratio, rounds=rounds)
+      return self.select_best_pose(poses, scores, logits)
+
+    begin = time.time()
+    poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2, get_pose_data=self.scorer_reuses_refiner_crops(), template_bank=self.template_bank)
+    if len(self.prefilter_stats)>0:
+      if self.device.type=='cuda':
+        torch.cuda.synchronize(self.device)
+      self.update_prefilter_stats(refine_time=time.time()-begin, n_refined=len(poses))
     if vis is not None and self.debug_dir is not None:
       imageio.imwrite(f'{self.debug_dir}/vis_refiner.png', vis)
 
-    # this next line is the memory bottleneck. I suspect memory is quatratic in the number of poses
-    scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2)
+    # Memory is quadratic in the number of poses scored jointly, bound it with ScorePredictor(group_size=..., max_mem_mb=...)
+    scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2, pose_data=self.refiner.last_pose_data)
+    self.refiner.last_pose_data = None
     if vis is not None and self.debug_dir is not None:
       imageio.imwrite(f'{self.debug_dir}/vis_score.png', vis)
 
     add_errs = self.compute_add_err_to_gt_pose(poses)
     logging.info(f"final, add_errs min:{add_errs.min()}")
 
-    ids = torch.as_tensor(scores).argsort(descending=True)
-    logging.info(f'sort ids:{ids}')
-    scores = scores[ids]
-    poses = poses[ids]
-
-    logging.info(f'sorted scores:{scores}')
-
-    best_pose = poses[0]@self.get_tf_to_centered_mesh()
-    self.pose_last = poses[0]
-    self.best_id = ids[0]
-
-    self.poses = poses
-    self.scores = scores
-
-    return best_pose.data.cpu().numpy()
+    return self.select_best_pose(poses, scores, self.scorer.last_logits)
 
 
   def compute_add_err_to_gt_pose(self, poses):
     '''
     @poses: wrt. the centered mesh
     '''
-    return -torch.ones(len(poses), device='cuda', dtype=torch.float)
+    return -torch.ones(len(poses), device=self.device, dtype=torch.float)
 
 
   def track_one(self, rgb, depth, K, iteration, extra={}):
@@ -269,13 +503,15 @@ class FoundationPose:
       raise RuntimeError
     logging.info("Welcome")
 
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    if self.depth_roi_pad is not None:
+      depth, xyz_map = preprocess_depth_roi(depth, K, self.crop_roi(K, self.pose_last, depth.shape[0], depth.shape[1]), radius=2, device=str(self.device))
+    else:
+      depth = erode_depth(depth, radius=2, device=str(self.device))
+      depth = bilateral_filter_depth(depth, radius=2, device=str(self.device))
+      xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device=self.device)[None], zfar=np.inf)[0]
     logging.info("depth processing done")
 
-    xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device='cuda')[None], zfar=np.inf)[0]
-
     pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4).data.cpu().numpy(), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2)
     logging.info("pose done")
     if self.debug>=2:
@@ -284,3 +520,154 @@ class FoundationPose:
     return (pose@self.get_tf_to_centered_mesh()).data.cpu().numpy().reshape(4,4)
 
 
+  def track_multi_hypo(self, rgb, depth, K, iteration, ob_mask=None, topk=5, score_interval=5, score_thres=None, trans_thres=None, rot_thres=None, register_iteration=5, extra={}):
+    '''Track the topk hypotheses of the last register as one batch, and re-register when tracking looks lost
+    @depth: raw depth, filtered here and again in register
+    @ob_mask: (H,W) mask or a callable returning it (or None), only fetched when re-registering. If not available, tracking continues and extra['lost'] is set
+    @score_interval: score the hypotheses every this many frames and reorder them, the best one is reported
+    @score_thres: lost if the raw scorer logit of the best hypothesis (self.track_scores) is below this at a scoring frame
+    @trans_thres: meter, @rot_thres: degree. Lost if the refiner update of the best hypothesis exceeds them
+    '''
+    if self.pose_last is None:
+      logging.info("Please init pose by register first")
+      raise RuntimeError
+    if getattr(self, 'track_poses', None) is None or self.track_src is not self.poses:
+      self.track_poses = self.poses[:topk].reshape(-1,4,4)
+      self.track_scores = self.logits[:topk]
+      self.track_src = self.poses
+      self.n_since_score = 0
+
+    depth_raw = depth
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    if self.depth_roi_pad is not None:
+      depth, xyz_map = preprocess_depth_roi(depth, K, self.crop_roi(K, self.track_poses, depth.shape[0], depth.shape[1]), radius=2, device=str(self.device))
+    else:
+      depth = erode_depth(depth, radius=2, device=str(self.device))
+      depth = bilateral_filter_depth(depth, radius=2, device=str(self.device))
+      xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device=self.device)[None], zfar=np.inf)[0]
+
+    poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.track_poses.data.cpu().numpy(), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2)
+    if self.debug>=2:
+      extra['vis'] = vis
+    self.track_poses = poses.reshape(-1,4,4)
+
+    trans_update = self.refiner.last_trans_update[0].norm().item()
+    cos = ((self.refiner.last_rot_update[0].trace()-1)/2).clip(-1,1)
+    rot_update = np.rad2deg(torch.acos(cos).item())
+    lost = (trans_thres is not None and trans_update>trans_thres) or (rot_thres is not None and rot_update>rot_thres)
+
+    self.n_since_score += 1
+    if self.n_since_score>=score_interval:
+      self.n_since_score = 0
+      # Rank by the tournament scores, max_mem_mb may still split the hypotheses into several groups
+      scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=self.track_poses.data.cpu().numpy(), mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, group_size=len(self.track_poses))
+      ids = scores.argsort(descending=True)
+      self.track_poses = self.track_poses[ids]
+      self.track_scores = self.scorer.last_logits[ids]
+      lost = lost or (score_thres is not None and self.track_scores[0].item()<score_thres)
+    logging.info(f'trans_update:{trans_update:.4f}, rot_update:{rot_update:.2f}, best score:{self.track_scores[0].item():.3f}, lost:{lost}')
+
+    extra['lost'] = lost
+    extra['registered'] = False
+    if lost:
+      mask = ob_mask() if callable(ob_mask) else ob_mask
+      if mask is not None:
+        logging.info("tracking lost, re-register")
+        pose = self.register(K=K, rgb=rgb, depth=depth_raw, ob_mask=mask, iteration=register_iteration)
+        self.track_poses = None
+        extra['lost'] = False
+        extra['registered'] = True
+        return pose
+
+    self.pose_last = self.track_poses[0]
+    return (self.pose_last@self.get_tf_to_centered_mesh()).data.cpu().numpy().reshape(4,4)
+
+
+
+def make_mesh_pack(ests):
+  '''MeshPack of the distinct meshes of the estimators, for register_many
+  @ests: list of FoundationPose
+  '''
+  mesh_tensors_list = []
+  for est in ests:
+    if not any(mesh_tensors_equal(other, est.mesh_tensors) for other in mesh_tensors_list):
+      mesh_tensors_list.append(est.mesh_tensors)
+  return MeshPack(mesh_tensors_list)
+
+
+
+def register_many(ests, K, rgb, depth, ob_masks, ob_ids=None, glctx=None, iteration=5, init_rot_guess=None, mesh_pack:MeshPack=None):
+  '''Register several objects in the same frame, sharing the render and network batches
+  All estimators use the refiner and scorer of ests[0]. Estimators whose meshes are identical share one render call
+  @ests: list of FoundationPose
+  @ob_masks: list of (H,W) masks, one per estimator. With ests[0].depth_roi_pad set, the depth is processed inside the union of their rois only
+  @mesh_pack: MeshPack from make_mesh_pack holding the meshes of ests, the hypotheses of all objects are then rendered in one call
+  @return: list of (4,4) np array poses, same order as ests
+  '''
+  set_seed(0)
+  est0 = ests[0]
+  if ob_ids is None:
+    ob_ids = [None]*len(ests)
+  if glctx is None:
+    glctx = est0.glctx
+  if glctx is None and est0.device.type=='cuda':
+    glctx = dr.RasterizeCudaContext(est0.device)
+  for est in ests:
+    if est.glctx is None:
+      est.glctx = glctx
+
+  depth_raw = depth
+  roi = None
+  if est0.depth_roi_pad is not None:
+    roi = roi_union(*[mask_roi(ob_mask, pad=est0.depth_roi_pad) for ob_mask in ob_masks])
+  if roi is None:
+    depth = erode_depth(depth, radius=2, device=str(est0.device))
+    depth = bilateral_filter_depth(depth, radius=2, device=str(est0.device))
+    xyz_map = depth2xyzmap(depth, K)
+  else:
+    depth, _ = preprocess_depth_roi(depth_raw, K, roi, radius=2, device=str(est0.device))
+
+  out = [None]*len(ests)
+  active = []
+  hypos = []
+  for i, est in enumerate(ests):
+    valid = (depth>=0.001) & (ob_masks[i]>0)
+    if valid.sum()<4:
+      logging.info(f'object {i}: valid too small')
+      pose = np.eye(4)
+      pose[:3,3] = est.guess_translation(depth=depth, mask=ob_masks[i], K=K)
+      out[i] = pose
+      continue
+    active.append(i)
+    hypos.append(est.make_register_hypotheses(K=K, rgb=rgb, depth=depth, ob_mask=ob_masks[i], ob_id=ob_ids[i], init_rot_guess=init_rot_guess))
+  if len(active)==0:
+    return out
+  if roi is not None:
+    roi = roi_union(roi, *[ests[i].crop_roi(K, poses, depth.shape[0], depth.shape[1]) for i, poses in zip(active, hypos)])
+    depth, xyz_map = preprocess_depth_roi(depth_raw, K, roi, radius=2, device=str(est0.device))
+    logging.info(f'depth roi:{roi}')
+
+  mesh_tensors_list = []
+  for i in active:
+    mesh_tensors = ests[i].mesh_tensors
+    for other in mesh_tensors_list:
+      if other is not mesh_tensors and mesh_tensors_equal(other, mesh_tensors):
+        mesh_tensors = other
+        break
+    mesh_tensors_list.append(mesh_tensors)
+  meshes = [ests[i].mesh for i in active]
+  diameters = [ests[i].diameter for i in active]
+
+  begin = time.time()
+  poses_list = est0.refiner.predict_many(rgb=rgb, depth=depth, K=K, ob_in_cams_list=hypos, xyz_map=xyz_map, meshes=meshes, mesh_tensors_list=mesh_tensors_list, mesh_diameters=diameters, glctx=glctx, iteration=iteration, mesh_pack=mesh_pack)
+  if est0.device.type=='cuda':
+    torch.cuda.synchronize(est0.device)
+  refine_time = time.time()-begin
+  n_refined = sum(len(poses) for poses in poses_list)
+  for i in active:
+    ests[i].update_prefilter_stats(refine_time=refine_time, n_refined=n_refined)
+  scores_list = est0.scorer.predict_many(rgb=rgb, depth=depth, K=K, ob_in_cams_list=poses_list, meshes=meshes, mesh_tensors_list=mesh_tensors_list, mesh_diameters=diameters, glctx=glctx, mesh_pack=mesh_pack)
+
+  for i, poses, scores, logits in zip(active, poses_list, scores_list, est0.scorer.last_logits_list):
+    out[i] = ests[i].select_best_pose(poses, scores, logits)
+  return out
@@ -0,0 +1,148 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Staged frame processing with bounded queues, so frame decoding and output writing overlap with pose estimation
+'''
+
+import threading,queue,time,logging
+import numpy as np
+
+
+_STOP = object()
+
+
+class StageStats:
+  def __init__(self, name):
+    self.name = name
+    self.n = 0
+    self.busy_time = 0
+    self.queue_depths = []
+    self.begin = time.time()
+
+
+  def add(self, busy_time, queue_depth=None):
+    self.n += 1
+    self.busy_time += busy_time
+    if queue_depth is not None:
+      self.queue_depths.append(queue_depth)
+
+
+  def summary(self):
+    wall = time.time()-self.begin
+    msg = f'{self.name}: items:{self.n}, busy:{self.busy_time:.2f}s, {self.n/max(self.busy_time,1e-6):.1f} items/s busy, {self.n/max(wall,1e-6):.1f} items/s wall'
+    if len(self.queue_depths)>0:
+      msg += f', queue depth mean:{np.mean(self.queue_depths):.1f} max:{np.max(self.queue_depths)}'
+    return msg
+
+
+
+class Prefetcher:
+  '''Produce fn(i) for i in ids in a background thread, at most maxsize items ahead of the consumer.
+  maxsize=0 runs fn inline when iterating.
+  '''
+  def __init__(self, name, fn, ids, maxsize=4):
+    self.fn = fn
+    self.ids = list(ids)
+    self.maxsize = maxsize
+    self.stats = StageStats(name)
+    self.error = None
+    if self.maxsize>0:
+      self.queue = queue.Queue(maxsize=maxsize)
+      self.thread = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+
+
+  def run(self):
+    try:
+      for i in self.ids:
+        begin = time.time()
+        out = self.fn(i)
+        self.stats.add(time.time()-begin)
+        self.queue.put(out)
+    except Exception as e:
+      self.error = e
+    self.queue.put(_STOP)
+
+
+  def __iter__(self):
+    if self.maxsize==0:
+      for i in self.ids:
+        begin = time.time()
+        out = self.fn(i)
+        self.stats.add(time.time()-begin)
+        yield out
+      return
+    while 1:
+      self.stats.queue_depths.append(self.queue.qsize())
+      out = self.queue.get()
+      if out is _STOP:
+        if self.error is not None:
+          raise self.error
+        return
+      yield out
+
+
+
+class AsyncWorker:
+  '''Consume items with fn in a background thread fed through a bounded queue, put() blocks when the queue is full.
+  maxsize=0 runs fn inline in put().
+  '''
+  def __init__(self, name, fn, maxsize=4):
+    self.fn = fn
+    self.maxsize = maxsize
+    self.stats = StageStats(name)
+    self.error = None
+    if self.maxsize>0:
+      self.queue = queue.Queue(maxsize=maxsize)
+      self.thread = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+
+
+  def run(self):
+    while 1:
+      item = self.queue.get()
+      if item is _STOP:
+        return
+      if self.error is not None:
+        continue
+      try:
+        begin = time.time()
+        self.fn(item)
+        self.stats.add(time.time()-begin)
+      except Exception as e:
+        self.error = e
+
+
+  def put(self, item):
+    if self.error is not None:
+      raise self.error
+    if self.maxsize==0:
+      begin = time.time()
+      self.fn(item)
+      self.stats.add(time.time()-begin)
+      return
+    self.stats.queue_depths.append(self.queue.qsize())
+    self.queue.put(item)
+
+
+  def close(self):
+    if self.maxsize>0:
+      self.queue.put(_STOP)
+      self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+
+
+def log_pipeline_stats(stages):
+  for stage in stages:
+    if isinstance(stage, StageStats):
+      logging.info(stage.summary())
+    else:
+      logging.info(stage.stats.summary())
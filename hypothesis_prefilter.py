@@ -0,0 +1,127 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+from Utils import *
+
+
+def project_model_pts(pts, poses, K):
+  '''
+  @pts: (N,3) torch tensor, model points wrt. the centered mesh
+  @poses: (B,4,4) torch tensor
+  @K: (3,3)
+  @return: pts_cam (B,N,3), uvs (B,N,2)
+  '''
+  K = torch.as_tensor(K, dtype=torch.float, device=poses.device)
+  pts_cam = (poses[:,None,:3,:3]@pts[None,...,None])[...,0] + poses[:,None,:3,3]
+  projected = pts_cam@K.T
+  uvs = projected[...,:2]/projected[...,2:3].clamp(min=1e-6)
+  return pts_cam, uvs
+
+
+
+class HypothesisPrefilter:
+  '''Rank the pose hypotheses of register with an inexpensive test so only the top ones go through the refiner.
+  Subclasses implement score(), higher is better.
+  '''
+  def __init__(self, topk=None, keep_ratio=0.5):
+    '''
+    @topk: number of hypotheses to keep, takes precedence over keep_ratio
+    @keep_ratio: fraction of hypotheses to keep
+    '''
+    self.topk = topk
+    self.keep_ratio = keep_ratio
+
+
+  def score(self, est, poses, K, depth, ob_mask):
+    '''
+    @est: FoundationPose, provides the downsampled model points and normals
+    @poses: (B,4,4) torch tensor wrt. the centered mesh
+    @depth: (H,W) filtered depth
+    @ob_mask: (H,W)
+    @return: (B) torch tensor
+    '''
+    raise NotImplementedError
+
+
+  def select(self, est, poses, K, depth, ob_mask):
+    '''
+    @return: kept poses (K,4,4), their ids into poses, scores of all poses (B)
+    '''
+    if self.topk is not None:
+      n_keep = self.topk
+    else:
+      n_keep = int(np.ceil(len(poses)*self.keep_ratio))
+    n_keep = int(np.clip(n_keep, 1, len(poses)))
+    scores = self.score(est, poses, K, depth, ob_mask)
+    ids = scores.argsort(descending=True)[:n_keep]
+    return poses[ids], ids, scores
+
+
+
+class DepthResidualPrefilter(HypothesisPrefilter):
+  '''Fraction of camera-facing model points that project inside the mask and agree with the observed depth.
+  Register places every hypothesis at the median observed depth, so the residuals are compared after removing the median offset of each
+  hypothesis, i.e. after sliding it along z onto the observed surface. Only the shape of the visible surface is ranked
+  '''
+  def __init__(self, topk=None, keep_ratio=0.5, residual_thres=None):
+    '''
+    @residual_thres: max |z-depth| in meter for a point to count as an inlier, defaults to the voxel size of the downsampled model
+    '''
+    super().__init__(topk=topk, keep_ratio=keep_ratio)
+    self.residual_thres = residual_thres
+
+
+  def score(self, est, poses, K, depth, ob_mask):
+    depth = torch.as_tensor(depth, dtype=torch.float, device=poses.device)
+    ob_mask = torch.as_tensor(ob_mask, device=poses.device)>0
+    H,W = depth.shape[:2]
+    residual_thres = self.residual_thres if self.residual_thres is not None else est.vox_size
+
+    pts_cam, uvs = project_model_pts(est.pts, poses, K)
+    normals_cam = (poses[:,None,:3,:3]@est.normals[None,...,None])[...,0]
+    front = (normals_cam*pts_cam).sum(dim=-1)<0
+    us = uvs[...,0].round().long()
+    vs = uvs[...,1].round().long()
+    inside = (us>=0) & (us<W) & (vs>=0) & (vs<H) & (pts_cam[...,2]>=0.001)
+    us = us.clamp(0, W-1)
+    vs = vs.clamp(0, H-1)
+    zs = depth[vs,us]
+    valid = front & inside & ob_mask[vs,us] & (zs>=0.001)
+    residuals = pts_cam[...,2]-zs
+    offsets = torch.where(valid, residuals, torch.full_like(residuals, np.nan)).nanmedian(dim=-1).values.nan_to_num(0)
+    inlier = valid & ((residuals-offsets[:,None]).abs()<residual_thres)
+    return inlier.sum(dim=-1).float()/front.sum(dim=-1).clamp(min=1).float()
+
+
+
+class SilhouetteIoUPrefilter(HypothesisPrefilter):
+  '''IoU between the splatted silhouette of the model points and ob_mask, on a grid whose cell matches the projected voxel size
+  '''
+  def score(self, est, poses, K, depth, ob_mask):
+    ob_mask = torch.as_tensor(ob_mask, device=poses.device)>0
+    H,W = ob_mask.shape[:2]
+    z = poses[:,2,3].clamp(min=0.001).min().item()
+    cell = int(max(1, np.floor(min(K[0,0], K[1,1])*est.vox_size/z)))
+    h = int(np.ceil(H/cell))
+    w = int(np.ceil(W/cell))
+
+    mask_grid = F.max_pool2d(ob_mask[None,None].float(), kernel_size=cell, stride=cell, ceil_mode=True)[0,0]>0   #(h,w)
+
+    pts_cam, uvs = project_model_pts(est.pts, poses, K)
+    us = (uvs[...,0]/cell).floor().long()
+    vs = (uvs[...,1]/cell).floor().long()
+    inside = (us>=0) & (us<w) & (vs>=0) & (vs<h) & (pts_cam[...,2]>=0.001)
+    ids = torch.where(inside, vs*w+us, torch.full_like(us, h*w))
+    sil = torch.zeros((len(poses), h*w+1), dtype=torch.bool, device=poses.device)
+    sil.scatter_(1, ids, True)
+    sil = sil[:,:h*w]
+    mask_grid = mask_grid.reshape(1,-1)
+    inter = (sil & mask_grid).sum(dim=-1).float()
+    union = (sil | mask_grid).sum(dim=-1).float()
+    return inter/union.clamp(min=1)
@@ -18,10 +18,13 @@ from learning.datasets.pose_dataset import *
 
 
 class PairH5Dataset(torch.utils.data.Dataset):
-  def __init__(self, cfg, h5_file, mode='train', max_num_key=None, cache_data=None):
+  xyz_invalid_thres = 0.001
+
+  def __init__(self, cfg, h5_file, mode='train', max_num_key=None, cache_data=None, device='cuda'):
     self.cfg = cfg
     self.h5_file = h5_file
     self.mode = mode
+    self.device = torch.device(device)
 
     logging.info(f"self.h5_file:{self.h5_file}")
     self.n_perturb = None
@@ -76,35 +79,57 @@ class PairH5Dataset(torch.utils.data.Dataset):
 
 
 
-  def transform_depth_to_xyzmap(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+  def normalize_observation(self, rgbBs, xyz_mapBs, poseA, mesh_diameters):
+    '''The rgb and xyz normalization of transform_batch for observed crops from warp_crop_batch, in one pass over the crops.
+    Pass observed_done=True to transform_batch afterwards
+    @rgbBs: (B,3,h,w) 0-255
+    @xyz_mapBs: (B,3,h,w) in the camera frame
+    @return: rgbBs in [0,1], xyz_mapBs relative to the poseA translations
+    '''
+    bs = len(poseA)
+    rgbBs = rgbBs/255.0
+    invalid = xyz_mapBs[:,2:3]<self.xyz_invalid_thres
+    xyz_mapBs = xyz_mapBs-poseA[:,:3,3].reshape(bs,3,1,1)
+    if self.cfg['normalize_xyz']:
+      mesh_radius = mesh_diameters/2
+      xyz_mapBs *= 1/mesh_radius.reshape(bs,1,1,1)
+      invalid = invalid.expand(bs,3,-1,-1) | (torch.abs(xyz_mapBs)>=2)
+      xyz_mapBs[invalid] = 0
+    return rgbBs, xyz_mapBs
+
+
+  def transform_depth_to_xyzmap(self, batch:BatchPoseData, H_ori, W_ori, bound=1, observed_done=False):
     bs = len(batch.rgbAs)
     H,W = batch.rgbAs.shape[-2:]
-    mesh_radius = batch.mesh_diameters.cuda()/2
-    tf_to_crops = batch.tf_to_crops.cuda()
-    crop_to_oris = batch.tf_to_crops.inverse().cuda()  #(B,3,3)
-    batch.poseA = batch.poseA.cuda()
-    batch.Ks = batch.Ks.cuda()
+    mesh_radius = batch.mesh_diameters.to(self.device)/2
+    tf_to_crops = batch.tf_to_crops.to(self.device)
+    crop_to_oris = batch.tf_to_crops.inverse().to(self.device)  #(B,3,3)
+    batch.poseA = batch.poseA.to(self.device)
+    batch.Ks = batch.Ks.to(self.device)
 
     if batch.xyz_mapAs is None:
-      depthAs_ori = kornia.geometry.transform.warp_perspective(batch.depthAs.cuda().expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
+      depthAs_ori = kornia.geometry.transform.warp_perspective(batch.depthAs.to(self.device).expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
       batch.xyz_mapAs = depth2xyzmap_batch(depthAs_ori[:,0], batch.Ks, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
       batch.xyz_mapAs = kornia.geometry.transform.warp_perspective(batch.xyz_mapAs, tf_to_crops, dsize=(H,W), mode='nearest', align_corners=False)
-    batch.xyz_mapAs = batch.xyz_mapAs.cuda()
+    batch.xyz_mapAs = batch.xyz_mapAs.to(self.device)
     if self.cfg['normalize_xyz']:
-      invalid = batch.xyz_mapAs[:,2:3]<0.001
+      invalid = batch.xyz_mapAs[:,2:3]<self.xyz_invalid_thres
     batch.xyz_mapAs = batch.xyz_mapAs-batch.poseA[:,:3,3].reshape(bs,3,1,1)
     if self.cfg['normalize_xyz']:
       batch.xyz_mapAs *= 1/mesh_radius.reshape(bs,1,1,1)
       invalid = invalid.expand(bs,3,-1,-1) | (torch.abs(batch.xyz_mapAs)>=2)
       batch.xyz_mapAs[invalid.expand(bs,3,-1,-1)] = 0
 
+    if observed_done:
+      return batch
+
     if batch.xyz_mapBs is None:
-      depthBs_ori = kornia.geometry.transform.warp_perspective(batch.depthBs.cuda().expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
+      depthBs_ori = kornia.geometry.transform.warp_perspective(batch.depthBs.to(self.device).expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
       batch.xyz_mapBs = depth2xyzmap_batch(depthBs_ori[:,0], batch.Ks, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
       batch.xyz_mapBs = kornia.geometry.transform.warp_perspective(batch.xyz_mapBs, tf_to_crops, dsize=(H,W), mode='nearest', align_corners=False)
-    batch.xyz_mapBs = batch.xyz_mapBs.cuda()
+    batch.xyz_mapBs = batch.xyz_mapBs.to(self.device)
     if self.cfg['normalize_xyz']:
-      invalid = batch.xyz_mapBs[:,2:3]<0.001
+      invalid = batch.xyz_mapBs[:,2:3]<self.xyz_invalid_thres
     batch.xyz_mapBs = batch.xyz_mapBs-batch.poseA[:,:3,3].reshape(bs,3,1,1)
     if self.cfg['normalize_xyz']:
       batch.xyz_mapBs *= 1/mesh_radius.reshape(bs,1,1,1)
@@ -115,52 +140,58 @@ class PairH5Dataset(torch.utils.data.Dataset):
 
 
 
-  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1, observed_done=False):
     '''Transform the batch before feeding to the network
     !NOTE the H_ori, W_ori could be different at test time from the training data, and needs to be set
     '''
     bs = len(batch.rgbAs)
-    batch.rgbAs = batch.rgbAs.cuda().float()/255.0
-    batch.rgbBs = batch.rgbBs.cuda().float()/255.0
+    batch.rgbAs = batch.rgbAs.to(self.device).float()/255.0
+    if not observed_done:
+      batch.rgbBs = batch.rgbBs.to(self.device).float()/255.0
 
-    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound)
+    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound, observed_done=observed_done)
     return batch
 
 
 
 
 class TripletH5Dataset(PairH5Dataset):
-  def __init__(self, cfg, h5_file, mode, max_num_key=None, cache_data=None):
-    super().__init__(cfg, h5_file, mode, max_num_key, cache_data=cache_data)
+  xyz_invalid_thres = 0.1
 
+  def __init__(self, cfg, h5_file, mode, max_num_key=None, cache_data=None, device='cuda'):
+    super().__init__(cfg, h5_file, mode, max_num_key, cache_data=cache_data, device=device)
 
-  def transform_depth_to_xyzmap(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+
+  def transform_depth_to_xyzmap(self, batch:BatchPoseData, H_ori, W_ori, bound=1, observed_done=False):
     bs = len(batch.rgbAs)
     H,W = batch.rgbAs.shape[-2:]
-    mesh_radius = batch.mesh_diameters.cuda()/2
-    tf_to_crops = batch.tf_to_crops.cuda()
-    crop_to_oris = batch.tf_to_crops.inverse().cuda()  #(B,3,3)
-    batch.poseA = batch.poseA.cuda()
-    batch.Ks = batch.Ks.cuda()
+    mesh_radius = batch.mesh_diameters.to(self.device)/2
+    tf_to_crops = batch.tf_to_crops.to(self.device)
+    crop_to_oris = batch.tf_to_crops.inverse().to(self.device)  #(B,3,3)
+    batch.poseA = batch.poseA.to(self.device)
+    batch.Ks = batch.Ks.to(self.device)
 
     if batch.xyz_mapAs is None:
-      depthAs_ori = kornia.geometry.transform.warp_perspective(batch.depthAs.cuda().expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
+      depthAs_ori = kornia.geometry.transform.warp_perspective(batch.depthAs.to(self.device).expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
       batch.xyz_mapAs = depth2xyzmap_batch(depthAs_ori[:,0], batch.Ks, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
       batch.xyz_mapAs = kornia.geometry.transform.warp_perspective(batch.xyz_mapAs, tf_to_crops, dsize=(H,W), mode='nearest', align_corners=False)
-    batch.xyz_mapAs = batch.xyz_mapAs.cuda()
-    invalid = batch.xyz_mapAs[:,2:3]<0.1
+    batch.xyz_mapAs = batch.xyz_mapAs.to(self.device)
+    invalid = batch.xyz_mapAs[:,2:3]<self.xyz_invalid_thres
     batch.xyz_mapAs = (batch.xyz_mapAs-batch.poseA[:,:3,3].reshape(bs,3,1,1))
     if self.cfg['normalize_xyz']:
       batch.xyz_mapAs *= 1/mesh_radius.reshape(bs,1,1,1)
       invalid = invalid.expand(bs,3,-1,-1) | (torch.abs(batch.xyz_mapAs)>=2)
       batch.xyz_mapAs[invalid.expand(bs,3,-1,-1)] = 0
 
+    if observed_done:
+      return batch
+
     if batch.xyz_mapBs is None:
-      depthBs_ori = kornia.geometry.transform.warp_perspective(batch.depthBs.cuda().expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
+      depthBs_ori = kornia.geometry.transform.warp_perspective(batch.depthBs.to(self.device).expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
       batch.xyz_mapBs = depth2xyzmap_batch(depthBs_ori[:,0], batch.Ks, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
       batch.xyz_mapBs = kornia.geometry.transform.warp_perspective(batch.xyz_mapBs, tf_to_crops, dsize=(H,W), mode='nearest', align_corners=False)
-    batch.xyz_mapBs = batch.xyz_mapBs.cuda()
-    invalid = batch.xyz_mapBs[:,2:3]<0.1
+    batch.xyz_mapBs = batch.xyz_mapBs.to(self.device)
+    invalid = batch.xyz_mapBs[:,2:3]<self.xyz_invalid_thres
     batch.xyz_mapBs = (batch.xyz_mapBs-batch.poseA[:,:3,3].reshape(bs,3,1,1))
     if self.cfg['normalize_xyz']:
       batch.xyz_mapBs *= 1/mesh_radius.reshape(bs,1,1,1)
@@ -170,26 +201,27 @@ class TripletH5Dataset(PairH5Dataset):
     return batch
 
 
-  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1, observed_done=False):
     bs = len(batch.rgbAs)
-    batch.rgbAs = batch.rgbAs.cuda().float()/255.0
-    batch.rgbBs = batch.rgbBs.cuda().float()/255.0
+    batch.rgbAs = batch.rgbAs.to(self.device).float()/255.0
+    if not observed_done:
+      batch.rgbBs = batch.rgbBs.to(self.device).float()/255.0
 
-    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound)
+    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound, observed_done=observed_done)
     return batch
 
 
 
 class ScoreMultiPairH5Dataset(TripletH5Dataset):
-  def __init__(self, cfg, h5_file, mode, max_num_key=None, cache_data=None):
-    super().__init__(cfg, h5_file, mode, max_num_key, cache_data=cache_data)
+  def __init__(self, cfg, h5_file, mode, max_num_key=None, cache_data=None, device='cuda'):
+    super().__init__(cfg, h5_file, mode, max_num_key, cache_data=cache_data, device=device)
     if mode in ['train', 'val']:
       self.cfg['train_num_pair'] = self.n_perturb
 
 
 class PoseRefinePairH5Dataset(PairH5Dataset):
-  def __init__(self, cfg, h5_file, mode='train', max_num_key=None, cache_data=None):
-    super().__init__(cfg=cfg, h5_file=h5_file, mode=mode, max_num_key=max_num_key, cache_data=cache_data)
+  def __init__(self, cfg, h5_file, mode='train', max_num_key=None, cache_data=None, device='cuda'):
+    super().__init__(cfg=cfg, h5_file=h5_file, mode=mode, max_num_key=max_num_key, cache_data=cache_data, device=device)
 
     if mode!='test':
       with h5py.File(h5_file, 'r', libver='latest') as hf:
@@ -207,14 +239,15 @@ class PoseRefinePairH5Dataset(PairH5Dataset):
           break
 
 
-  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1, observed_done=False):
     '''Transform the batch before feeding to the network
     !NOTE the H_ori, W_ori could be different at test time from the training data, and needs to be set
     '''
     bs = len(batch.rgbAs)
-    batch.rgbAs = batch.rgbAs.cuda().float()/255.0
-    batch.rgbBs = batch.rgbBs.cuda().float()/255.0
+    batch.rgbAs = batch.rgbAs.to(self.device).float()/255.0
+    if not observed_done:
+      batch.rgbBs = batch.rgbBs.to(self.device).float()/255.0
 
-    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound)
+    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound, observed_done=observed_done)
     return batch
 
@@ -133,3 +133,21 @@ class BatchPoseData:
           out.__dict__[k] = self.__dict__[k][ids.to(self.__dict__[k].device)]
       return out
 
+    @staticmethod
+    def cat(batches):
+      '''Concatenate several BatchPoseData along the batch dim, fields missing in any of them are dropped
+      '''
+      out = BatchPoseData()
+      for k in batches[0].__dict__:
+        if all(batch.__dict__.get(k) is not None for batch in batches):
+          out.__dict__[k] = torch.cat([batch.__dict__[k] for batch in batches], dim=0)
+      return out
+
+
+
+def raw_crop_data_matches(raw, poses, tf_to_crops):
+  '''Whether untransformed crops from make_crop_data_batch(raw_out=...) were made for these poses and crop windows
+  '''
+  if raw is None or len(raw.poseA)!=len(poses):
+    return False
+  return torch.equal(raw.poseA, poses) and torch.allclose(raw.tf_to_crops, tf_to_crops)
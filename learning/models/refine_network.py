@@ -70,17 +70,22 @@ class RefineNet(nn.Module):
     )
 
 
-  def forward(self, A, B):
+  def forward(self, A, B, featA=None):
     """
     @A: (B,C,H,W)
+    @featA: optional encodeA(A) computed beforehand, e.g. from a RefineFeatureCache. A is then not encoded and may be None
     """
-    bs = len(A)
+    bs = len(B)
     output = {}
 
-    x = torch.cat([A,B], dim=0)
-    x = self.encodeA(x)
-    a = x[:bs]
-    b = x[bs:]
+    if featA is None:
+      x = torch.cat([A,B], dim=0)
+      x = self.encodeA(x)
+      a = x[:bs]
+      b = x[bs:]
+    else:
+      b = self.encodeA(B)
+      a = featA.to(b.dtype)
 
     ab = torch.cat((a,b),1).contiguous()
     ab = self.encodeAB(ab)  #(B,C,H,W)
@@ -18,35 +18,32 @@ from omegaconf import OmegaConf
 from learning.models.refine_network import RefineNet
 from learning.datasets.h5_dataset import *
 from Utils import *
+from render_backend import *
 from datareader import *
+from object_pack import write_pack_file, read_pack_file
 
 
 
 @torch.inference_mode()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None):
-  logging.info("Welcome make_crop_data_batch")
-  H,W = depth.shape[:2]
-  args = []
-  method = 'box_3d'
-  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
-
-  logging.info("make tf_to_crops done")
-
-  B = len(ob_in_cams)
-  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
-
+def render_crop_data_batch(render_size, poseA, tf_to_crops, rgb, K, xyz_map, H, W, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, device='cuda'):
+  '''Render poseA and crop the rendering and the observation with tf_to_crops
+  @glctx: nvdiffrast context or RenderBackend
+  @return: untransformed BatchPoseData, see make_crop_data_batch
+  '''
+  B = len(poseA)
   bs = 512
   rgb_rs = []
   depth_rs = []
   normal_rs = []
   xyz_map_rs = []
 
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
   bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
 
+  render_backend = get_render_backend(glctx, device)
   for b in range(0,len(poseA),bs):
     extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
+    rgb_r, depth_r, normal_r = render_backend.render(K=K, H=H, W=W, ob_in_cams=poseA[b:b+bs], get_normal=cfg['use_normal'], mesh_tensors=slice_mesh_tensors(mesh_tensors, b, b+bs), output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
     rgb_rs.append(rgb_r)
     depth_rs.append(depth_r[...,None])
     normal_rs.append(normal_r)
@@ -54,13 +51,14 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
   rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
   depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)  #(B,1,H,W)
   xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-  Ks = torch.as_tensor(K, device='cuda', dtype=torch.float).reshape(1,3,3)
+  Ks = torch.as_tensor(K, device=device, dtype=torch.float).reshape(1,3,3).expand(B,3,3)
   if cfg['use_normal']:
     normal_rs = torch.cat(normal_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
 
   logging.info("render done")
 
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+  rgbBs = warp_crop_batch(rgb, tf_to_crops, render_size, mode='bilinear')
+  xyz_mapBs = warp_crop_batch(xyz_map, tf_to_crops, render_size, mode='nearest')
   if rgb_rs.shape[-2:]!=cfg['input_resize']:
     rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
   else:
@@ -69,20 +67,49 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
     xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
   else:
     xyz_mapAs = xyz_map_rs
-  xyz_mapBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(xyz_map, device='cuda', dtype=torch.float).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)  #(B,3,H,W)
 
   if cfg['use_normal']:
     normalAs = kornia.geometry.transform.warp_perspective(normal_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-    normalBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(normal_map, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    normalBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(normal_map, dtype=torch.float, device=device).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
   else:
     normalAs = None
     normalBs = None
 
   logging.info("warp done")
 
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
-  pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1)
+  mesh_diameters = torch.ones((B), dtype=torch.float, device=device)*mesh_diameter
+  return BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+
+
+
+@torch.inference_mode()
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None, device='cuda', raw=None, raw_out=None):
+  '''
+  @raw: untransformed BatchPoseData from raw_out of an earlier call on the same frame, e.g. by the scorer. Reused instead of rendering and cropping if made for the same poses and crop windows
+  @raw_out: list, the untransformed BatchPoseData is appended for reuse
+  '''
+  logging.info("Welcome make_crop_data_batch")
+  H,W = depth.shape[:2]
+  args = []
+  method = 'box_3d'
+  ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
+
+  logging.info("make tf_to_crops done")
+
+  B = len(ob_in_cams)
+  poseA = ob_in_cams
+
+  if raw_crop_data_matches(raw, poseA, tf_to_crops) and (raw.normalAs is not None or not cfg['use_normal']):
+    logging.info("reuse rendered crops")
+  else:
+    raw = render_crop_data_batch(render_size, poseA, tf_to_crops, rgb, K, xyz_map, H, W, normal_map=normal_map, mesh_diameter=mesh_diameter, cfg=cfg, glctx=glctx, mesh_tensors=mesh_tensors, device=device)
+
+  if raw_out is not None:
+    raw_out.append(raw)
+  pose_data = copy.copy(raw)
+  pose_data.rgbBs, pose_data.xyz_mapBs = dataset.normalize_observation(raw.rgbBs, raw.xyz_mapBs, poseA=poseA, mesh_diameters=raw.mesh_diameters)
+  pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1, observed_done=True)
 
   logging.info("pose batch data done")
 
@@ -90,10 +117,143 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
 
 
 
+@torch.inference_mode()
+def make_observed_crop_data_batch(render_size, ob_in_cams, rgb, K, crop_ratio, xyz_map, H, W, mesh_diameter, dataset:PoseRefinePairH5Dataset=None, device='cuda'):
+  '''Observed side of make_crop_data_batch only, for when the rendered side is encoded already
+  @return: transformed BatchPoseData without rgbAs and xyz_mapAs
+  '''
+  ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  B = len(ob_in_cams)
+  tf_to_crops = compute_crop_window_tf_batch(H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method='box_3d', mesh_diameter=mesh_diameter)
+  rgbBs = warp_crop_batch(rgb, tf_to_crops, render_size, mode='bilinear')
+  xyz_mapBs = warp_crop_batch(xyz_map, tf_to_crops, render_size, mode='nearest')
+  Ks = torch.as_tensor(K, device=device, dtype=torch.float).reshape(1,3,3).expand(B,3,3)
+  mesh_diameters = torch.ones((B), dtype=torch.float, device=device)*mesh_diameter
+  rgbBs, xyz_mapBs = dataset.normalize_observation(rgbBs, xyz_mapBs, poseA=ob_in_cams, mesh_diameters=mesh_diameters)
+  return BatchPoseData(rgbBs=rgbBs, xyz_mapBs=xyz_mapBs, poseA=ob_in_cams, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+
+
+
+def count_conv_flops(module, x):
+  '''2x multiply-adds of the Conv2d layers of module on input x
+  '''
+  flops = []
+  def hook(m, inputs, out):
+    flops.append(2*out.numel()*m.in_channels//m.groups*m.kernel_size[0]*m.kernel_size[1])
+  handles = [m.register_forward_hook(hook) for m in module.modules() if isinstance(m, nn.Conv2d)]
+  with torch.inference_mode():
+    module(x)
+  for handle in handles:
+    handle.remove()
+  return sum(flops)
+
+
+
+class RefineFeatureCache:
+  '''RefineNet encodeA features of the TemplateBank crops, so the first register iteration only encodes the observed crops.
+  The features of the canonical template stand in for the rendered crop of the hypothesis, which only differs by the perspective of the off-axis translation.
+  The features of the max_banks most recently used banks stay on the device, (N,128,h/4,w/4) half each. If cache_dir is set they are also saved there
+  '''
+  def __init__(self, max_banks=4, cache_dir=None):
+    self.max_banks = max_banks
+    self.cache_dir = cache_dir
+    self.feats = OrderedDict()
+    self.flops_per_crop = None
+    self.stats = {'queries':0, 'hits':0, 'loads':0, 'computes':0, 'flops_saved':0}
+
+
+  def make_key(self, predictor, template_bank, mesh_diameter):
+    return hash_arrays(np.array([template_bank.key, predictor.run_name]), np.array([mesh_diameter]))
+
+
+  def compute(self, predictor, template_bank, mesh_diameter, bs=256):
+    N = len(template_bank.poses)
+    h,w = template_bank.input_resize
+    feats = []
+    for b in range(0,N,bs):
+      ids = torch.arange(b, min(b+bs,N), device=template_bank.device)
+      rgbAs, xyz_mapAs, poses = template_bank.get(ids)
+      n = len(ids)
+      eye = torch.eye(3, dtype=torch.float, device=predictor.device)[None].expand(n,3,3)
+      batch = BatchPoseData(rgbAs=rgbAs.to(predictor.device), xyz_mapAs=xyz_mapAs.to(predictor.device), poseA=poses.to(predictor.device), tf_to_crops=eye, Ks=eye, mesh_diameters=torch.ones((n), dtype=torch.float, device=predictor.device)*mesh_diameter)
+      batch = predictor.dataset.transform_batch(batch, H_ori=h, W_ori=w, bound=1, observed_done=True)
+      A = torch.cat([batch.rgbAs, batch.xyz_mapAs], dim=1).float()
+      with torch.cuda.amp.autocast(enabled=predictor.amp):
+        feats.append(predictor.model.encodeA(A).half())
+    return torch.cat(feats, dim=0)
+
+
+  def get(self, predictor, template_bank, mesh_diameter):
+    '''
+    @return: (N,C,h,w) half features of every bank crop, loaded or computed on a miss
+    '''
+    key = self.make_key(predictor, template_bank, mesh_diameter)
+    if key in self.feats:
+      self.feats.move_to_end(key)
+      return self.feats[key]
+    path = None if self.cache_dir is None else f'{self.cache_dir}/{key[:16]}.fpfeat'
+    if path is not None and os.path.exists(path):
+      meta, arrays = read_pack_file(path)
+      feats = torch.as_tensor(np.array(arrays['feats']), device=predictor.device)
+      self.stats['loads'] += 1
+    else:
+      begin = time.time()
+      feats = self.compute(predictor, template_bank, mesh_diameter)
+      self.stats['computes'] += 1
+      logging.info(f'encoded {len(feats)} templates in {time.time()-begin:.2f}s')
+      if path is not None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        write_pack_file(path, {'feats': feats.data.cpu().numpy()}, {'key': key})
+    self.feats[key] = feats
+    while len(self.feats)>self.max_banks:
+      self.feats.popitem(last=False)
+    return feats
+
+
+  @torch.inference_mode()
+  def lookup(self, predictor, template_bank, poses, mesh_diameter):
+    '''
+    @poses: (B,4,4) tensor
+    @return: (B,C,h,w) features of the bank rotations of poses, None unless all of them are in the bank
+    '''
+    bank_ids = template_bank.lookup(poses)
+    n_hits = int((bank_ids>=0).sum())
+    self.stats['queries'] += len(poses)
+    if n_hits<len(poses) or tuple(predictor.cfg.input_resize)!=template_bank.input_resize:
+      logging.info(f'feature cache miss, {n_hits}/{len(poses)} hypotheses in the template bank')
+      return None
+    feats = self.get(predictor, template_bank, mesh_diameter)
+    if self.flops_per_crop is None:
+      h,w = template_bank.input_resize
+      self.flops_per_crop = count_conv_flops(predictor.model.encodeA, torch.zeros((1,predictor.cfg['c_in'],h,w), dtype=torch.float, device=predictor.device))
+    self.stats['hits'] += n_hits
+    self.stats['flops_saved'] += n_hits*self.flops_per_crop
+    logging.info(f"feature cache hits:{self.stats['hits']}/{self.stats['queries']}, GFLOPs saved:{self.stats['flops_saved']/1e9:.1f}")
+    return feats[bank_ids.to(feats.device)]
+
+
+
 class PoseRefinePredictor:
-  def __init__(self,):
+  def __init__(self, device='cuda', trans_tol=None, rot_tol=None, reproj_trans_thres=None, reproj_rot_thres=None, reproj_hole_thres=0.05, feature_cache:RefineFeatureCache=None):
+    '''
+    @trans_tol: meter, @rot_tol: degree. If set, a hypothesis whose last update is below both is frozen and skipped in later iterations
+    @reproj_trans_thres: meter, @reproj_rot_thres: degree. If set, a hypothesis within both of the pose of its last rendering is not rendered again,
+    the earlier rendering is reprojected to the new pose instead, unless more than reproj_hole_thres of the reprojected silhouette are holes
+    @feature_cache: optional RefineFeatureCache. With a template bank, the first iteration then takes the rendered side features from it instead of rendering and encoding
+    '''
     logging.info("welcome")
-    self.amp = True
+    self.device = torch.device(device)
+    self.trans_tol = trans_tol
+    self.rot_tol = rot_tol
+    self.active_counts = []
+    self.reproj_trans_thres = reproj_trans_thres
+    self.reproj_rot_thres = reproj_rot_thres
+    self.reproj_hole_thres = reproj_hole_thres
+    self.feature_cache = feature_cache
+    self.render_refs = None
+    self.n_renders_avoided = 0
+    self.last_renders_avoided = 0
+    self.amp = self.device.type=='cuda'
     self.run_name = "2023-10-28-18-33-37"
     model_name = 'model_best.pth'
     code_dir = os.path.dirname(os.path.realpath(__file__))
@@ -131,28 +291,218 @@ class PoseRefinePredictor:
       self.cfg['normal_uint8'] = False
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
-    self.dataset = PoseRefinePairH5Dataset(cfg=self.cfg, h5_file='', mode='test')
-    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.dataset = PoseRefinePairH5Dataset(cfg=self.cfg, h5_file='', mode='test', device=self.device)
+    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
+    ckpt = torch.load(ckpt_dir, map_location=self.device)
     if 'model' in ckpt:
       ckpt = ckpt['model']
     self.model.load_state_dict(ckpt)
 
-    self.model.cuda().eval()
+    self.model.to(self.device).eval()
     logging.info("init done")
     self.last_trans_update = None
     self.last_rot_update = None
+    self.last_pose_data = None
+
+
+  def get_trans_normalizer(self):
+    trans_normalizer = self.cfg['trans_normalizer']
+    if not isinstance(trans_normalizer, float):
+      trans_normalizer = torch.as_tensor(list(trans_normalizer), device=self.device, dtype=torch.float).reshape(1,3)
+    return trans_normalizer
+
+
+  def update_poses(self, pose_data:BatchPoseData, trans_normalizer, bs=1024, featA=None):
+    '''Run the refiner network on cropped pairs and apply the predicted deltas
+    @pose_data: BatchPoseData from make_crop_data_batch, may mix several objects since mesh_diameters is per pair
+    @featA: optional (B,C,h,w) encodeA features of the rendered side, pose_data then only needs the observed side
+    @return: refined poses (B,4,4), trans_delta (B,3), rot_mat_delta (B,3,3)
+    '''
+    B_in_cams = []
+    trans_deltas = []
+    rot_mat_deltas = []
+    for b in range(0, len(pose_data.poseA), bs):
+      A = None
+      if featA is None:
+        A = torch.cat([pose_data.rgbAs[b:b+bs], pose_data.xyz_mapAs[b:b+bs]], dim=1).float()
+      B = torch.cat([pose_data.rgbBs[b:b+bs], pose_data.xyz_mapBs[b:b+bs]], dim=1).float()
+      logging.info("forward start")
+      with torch.cuda.amp.autocast(enabled=self.amp):
+        output = self.model(A, B, featA=None if featA is None else featA[b:b+bs])
+      for k in output:
+        output[k] = output[k].float()
+      logging.info("forward done")
+      if self.cfg['trans_rep']=='tracknet':
+        if not self.cfg['normalize_xyz']:
+          trans_delta = torch.tanh(output["trans"])*trans_normalizer
+        else:
+          trans_delta = output["trans"]
+
+      elif self.cfg['trans_rep']=='deepim':
+        def project_and_transform_to_crop(centers):
+          uvs = (pose_data.Ks[b:b+bs]@centers.reshape(-1,3,1)).reshape(-1,3)
+          uvs = uvs/uvs[:,2:3]
+          uvs = (pose_data.tf_to_crops[b:b+bs]@uvs.reshape(-1,3,1)).reshape(-1,3)
+          return uvs[:,:2]
+
+        rot_delta = output["rot"]
+        z_pred = output['trans'][:,2]*pose_data.poseA[b:b+bs][...,2,3]
+        uvA_crop = project_and_transform_to_crop(pose_data.poseA[b:b+bs][...,:3,3])
+        uv_pred_crop = uvA_crop + output['trans'][:,:2]*self.cfg['input_resize'][0]
+        uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse())
+        center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device=self.device)], dim=-1)
+        center_pred = (pose_data.Ks[b:b+bs].inverse()@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
+        trans_delta = center_pred-pose_data.poseA[b:b+bs][...,:3,3]
+
+      else:
+        trans_delta = output["trans"]
+
+      if self.cfg['rot_rep']=='axis_angle':
+        rot_mat_delta = torch.tanh(output["rot"])*self.cfg['rot_normalizer']
+        rot_mat_delta = so3_exp_map(rot_mat_delta).permute(0,2,1)
+      elif self.cfg['rot_rep']=='6d':
+        rot_mat_delta = rotation_6d_to_matrix(output['rot']).permute(0,2,1)
+      else:
+        raise RuntimeError
+
+      if self.cfg['normalize_xyz']:
+        trans_delta *= (pose_data.mesh_diameters[b:b+bs].reshape(-1,1)/2)
+
+      B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA[b:b+bs], trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
+      B_in_cams.append(B_in_cam)
+      trans_deltas.append(trans_delta)
+      rot_mat_deltas.append(rot_mat_delta)
+
+    return torch.cat(B_in_cams, dim=0), torch.cat(trans_deltas, dim=0), torch.cat(rot_mat_deltas, dim=0)
+
+
+  def get_moving(self, trans_delta, rot_mat_delta, trans_tol, rot_tol):
+    '''
+    @return: (B) bool, hypotheses whose update is not below the tolerances
+    '''
+    if trans_tol is None and rot_tol is None:
+      return torch.ones((len(trans_delta)), dtype=torch.bool, device=trans_delta.device)
+    converged = torch.ones((len(trans_delta)), dtype=torch.bool, device=trans_delta.device)
+    if trans_tol is not None:
+      converged &= trans_delta.norm(dim=-1)<trans_tol
+    if rot_tol is not None:
+      cos = ((rot_mat_delta.diagonal(dim1=-2, dim2=-1).sum(dim=-1)-1)/2).clip(-1,1)
+      converged &= torch.rad2deg(torch.acos(cos))<rot_tol
+    return ~converged
+
+
+  def use_reprojection(self):
+    return (self.reproj_trans_thres is not None or self.reproj_rot_thres is not None) and not self.cfg['use_normal']
+
+
+  def update_render_refs(self, key, ids, raw):
+    '''Keep the latest true rendering of each hypothesis. They persist across predict calls with the same key, e.g. tracking frame to frame
+    @key: (mesh_tensors id, K, number of hypotheses)
+    @ids: hypotheses indices of the crops in raw
+    '''
+    refs = self.render_refs
+    if refs is None or refs['key']!=key:
+      N = key[-1]
+      refs = {
+        'key': key,
+        'valid': torch.zeros((N), dtype=torch.bool, device=self.device),
+        'poses': torch.eye(4, dtype=torch.float, device=self.device)[None].repeat(N,1,1),
+        'rgbAs': torch.zeros((N,)+raw.rgbAs.shape[1:], dtype=raw.rgbAs.dtype, device=self.device),
+        'xyz_mapAs': torch.zeros((N,)+raw.xyz_mapAs.shape[1:], dtype=raw.xyz_mapAs.dtype, device=self.device),
+      }
+      self.render_refs = refs
+    refs['valid'][ids] = True
+    refs['poses'][ids] = raw.poseA
+    refs['rgbAs'][ids] = raw.rgbAs
+    refs['xyz_mapAs'][ids] = raw.xyz_mapAs
+
+
+  def make_reprojected_crop_data(self, key, ids, poses, mesh, rgb, K, xyz_map, H, W, mesh_diameter, glctx, mesh_tensors):
+    '''Untransformed crop data of poses as make_crop_data_batch(raw_out=...) would produce, reprojecting the kept rendering where the pose is close enough to it
+    @ids: hypotheses indices of poses
+    @return: BatchPoseData, (B) bool whether the crop was truly rendered
+    '''
+    render_size = self.cfg.input_resize
+    B = len(poses)
+    tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=poses, K=K, crop_ratio=self.cfg['crop_ratio'], out_size=(render_size[1], render_size[0]), method='box_3d', mesh_diameter=mesh_diameter)
+    reuse = torch.zeros((B), dtype=torch.bool, device=self.device)
+    if self.render_refs is not None and self.render_refs['key']==key:
+      refs = self.render_refs
+      poses_ref = refs['poses'][ids]
+      trans_diff = poses[:,:3,3]-poses_ref[:,:3,3]
+      rot_diff = poses_ref[:,:3,:3].permute(0,2,1)@poses[:,:3,:3]
+      reuse = refs['valid'][ids] & ~self.get_moving(trans_diff, rot_diff, self.reproj_trans_thres, self.reproj_rot_thres)
+    get_ref = lambda sel: (self.render_refs['rgbAs'][ids[sel]], self.render_refs['xyz_mapAs'][ids[sel]], self.render_refs['poses'][ids[sel]])
+    return self.reproject_crop_data(poses, tf_to_crops, reuse, get_ref, rgb, K, xyz_map, H, W, mesh_diameter, glctx, mesh_tensors)
+
+
+  def make_template_crop_data(self, template_bank, poses, mesh, rgb, K, xyz_map, H, W, mesh_diameter, glctx, mesh_tensors):
+    '''Same as make_reprojected_crop_data, reprojecting the crops of a TemplateBank to the poses whose rotation is in the bank
+    '''
+    render_size = self.cfg.input_resize
+    tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=poses, K=K, crop_ratio=self.cfg['crop_ratio'], out_size=(render_size[1], render_size[0]), method='box_3d', mesh_diameter=mesh_diameter)
+    bank_ids = template_bank.lookup(poses)
+    reuse = bank_ids>=0
+    if tuple(render_size)!=template_bank.input_resize:
+      reuse[:] = False
+    get_ref = lambda sel: template_bank.get(bank_ids[sel])
+    return self.reproject_crop_data(poses, tf_to_crops, reuse, get_ref, rgb, K, xyz_map, H, W, mesh_diameter, glctx, mesh_tensors)
+
+
+  def reproject_crop_data(self, poses, tf_to_crops, reuse, get_ref, rgb, K, xyz_map, H, W, mesh_diameter, glctx, mesh_tensors):
+    '''Reproject reference renderings where reuse is set and the holes stay below self.reproj_hole_thres, render the others
+    @get_ref: function of the indices of poses, returns their reference rgbAs, xyz_mapAs and the poses they were rendered at
+    @return: BatchPoseData, (B) bool whether the crop was truly rendered
+    '''
+    render_size = self.cfg.input_resize
+    B = len(poses)
+    raws = []
+    order = []
+    if reuse.any():
+      sel = reuse.nonzero()[:,0]
+      rgbAs_ref, xyz_mapAs_ref, poses_ref = get_ref(sel)
+      rgbAs, xyz_mapAs, hole_ratio = reproject_render_crops(rgbAs_ref, xyz_mapAs_ref, poses_ref, poses[sel], K, tf_to_crops[sel])
+      ok = hole_ratio<self.reproj_hole_thres
+      reuse[sel[~ok]] = False
+      sel = sel[ok]
+      if len(sel)>0:
+        Ks = torch.as_tensor(K, device=self.device, dtype=torch.float).reshape(1,3,3).expand(len(sel),3,3)
+        rgbBs = warp_crop_batch(rgb, tf_to_crops[sel], render_size, mode='bilinear')
+        xyz_mapBs = warp_crop_batch(xyz_map, tf_to_crops[sel], render_size, mode='nearest')
+        mesh_diameters = torch.ones((len(sel)), dtype=torch.float, device=self.device)*mesh_diameter
+        raws.append(BatchPoseData(rgbAs=rgbAs[ok], rgbBs=rgbBs, xyz_mapAs=xyz_mapAs[ok], xyz_mapBs=xyz_mapBs, poseA=poses[sel], tf_to_crops=tf_to_crops[sel], Ks=Ks, mesh_diameters=mesh_diameters))
+        order.append(sel)
+    rendered = ~reuse
+    if rendered.any():
+      sel = rendered.nonzero()[:,0]
+      raws.append(render_crop_data_batch(render_size, poses[sel], tf_to_crops[sel], rgb, K, xyz_map, H, W, mesh_diameter=mesh_diameter, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, device=self.device))
+      order.append(sel)
+
+    n_avoided = int(reuse.sum())
+    self.last_renders_avoided += n_avoided
+    self.n_renders_avoided += n_avoided
+    if len(raws)==1:
+      return raws[0], rendered
+    order = torch.cat(order, dim=0)
+    inverse = torch.empty_like(order)
+    inverse[order] = torch.arange(B, device=self.device)
+    return BatchPoseData.cat(raws).select_by_indices(inverse), rendered
 
 
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5):
+  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5, trans_tol=None, rot_tol=None, pose_data=None, get_pose_data=False, template_bank=None):
     '''
     @rgb: np array (H,W,3)
     @ob_in_cams: np array (N,4,4)
+    @trans_tol, rot_tol: override self.trans_tol, self.rot_tol. Only the hypotheses still moving are rendered, cropped and refined in the next iteration
+    @pose_data: untransformed BatchPoseData of ob_in_cams on this frame, e.g. scorer.last_pose_data, reused by the first iteration when the crop windows match
+    @get_pose_data: crops of the refined poses into self.last_pose_data, so the scorer can skip its own pass. Only request them when the scorer
+    crops the same way, see FoundationPose.scorer_reuses_refiner_crops. With reprojection they are reprojected from the last iterations' renders where possible
+    @template_bank: TemplateBank of the rotation grid, the first iteration reprojects its crops to the hypotheses with a bank rotation instead of rendering them
+    With reprojection or a template bank, self.last_renders_avoided counts the hypotheses reprojected instead of rendered in this call
     '''
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
     logging.info(f'ob_in_cams:{ob_in_cams.shape}')
     tf_to_center = np.eye(4)
     ob_centered_in_cams = ob_in_cams
@@ -166,75 +516,76 @@ class PoseRefinePredictor:
     logging.info(f"trans_normalizer:{self.cfg['trans_normalizer']}, rot_normalizer:{self.cfg['rot_normalizer']}")
     bs = 1024
 
-    B_in_cams = torch.as_tensor(ob_centered_in_cams, device='cuda', dtype=torch.float)
-
+    B_in_cams = torch.as_tensor(ob_centered_in_cams, device=self.device, dtype=torch.float).clone()
+    trans_tol = trans_tol if trans_tol is not None else self.trans_tol
+    rot_tol = rot_tol if rot_tol is not None else self.rot_tol
 
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh_centered)
-
-    rgb_tensor = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth_tensor = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    xyz_map_tensor = torch.as_tensor(xyz_map, device='cuda', dtype=torch.float)
-    trans_normalizer = self.cfg['trans_normalizer']
-    if not isinstance(trans_normalizer, float):
-      trans_normalizer = torch.as_tensor(list(trans_normalizer), device='cuda', dtype=torch.float).reshape(1,3)
-
+      mesh_tensors = make_mesh_tensors(mesh_centered, device=self.device)
+
+    rgb_tensor = torch.as_tensor(rgb, device=self.device)
+    depth_tensor = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    xyz_map_tensor = torch.as_tensor(xyz_map, device=self.device, dtype=torch.float)
+    trans_normalizer = self.get_trans_normalizer()
+
+    active = torch.arange(len(B_in_cams), device=self.device)
+    trans_delta = torch.zeros((len(B_in_cams),3), dtype=torch.float, device=self.device)
+    rot_mat_delta = torch.eye(3, dtype=torch.float, device=self.device)[None].repeat(len(B_in_cams),1,1)
+    reproj = self.use_reprojection()
+    ref_key = (id(mesh_tensors), np.asarray(K, dtype=np.float32).tobytes(), len(B_in_cams))
+    H,W = depth_tensor.shape[:2]
+    self.last_renders_avoided = 0
+    self.active_counts = []
     for _ in range(iteration):
-      logging.info("making cropped data")
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
-      B_in_cams = []
-      for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
-        logging.info("forward start")
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A,B)
-        for k in output:
-          output[k] = output[k].float()
-        logging.info("forward done")
-        if self.cfg['trans_rep']=='tracknet':
-          if not self.cfg['normalize_xyz']:
-            trans_delta = torch.tanh(output["trans"])*trans_normalizer
-          else:
-            trans_delta = output["trans"]
-
-        elif self.cfg['trans_rep']=='deepim':
-          def project_and_transform_to_crop(centers):
-            uvs = (pose_data.Ks[b:b+bs]@centers.reshape(-1,3,1)).reshape(-1,3)
-            uvs = uvs/uvs[:,2:3]
-            uvs = (pose_data.tf_to_crops[b:b+bs]@uvs.reshape(-1,3,1)).reshape(-1,3)
-            return uvs[:,:2]
-
-          rot_delta = output["rot"]
-          z_pred = output['trans'][:,2]*pose_data.poseA[b:b+bs][...,2,3]
-          uvA_crop = project_and_transform_to_crop(pose_data.poseA[b:b+bs][...,:3,3])
-          uv_pred_crop = uvA_crop + output['trans'][:,:2]*self.cfg['input_resize'][0]
-          uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse().cuda())
-          center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device='cuda')], dim=-1)
-          center_pred = (pose_data.Ks[b:b+bs].inverse().cuda()@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
-          trans_delta = center_pred-pose_data.poseA[b:b+bs][...,:3,3]
-
-        else:
-          trans_delta = output["trans"]
-
-        if self.cfg['rot_rep']=='axis_angle':
-          rot_mat_delta = torch.tanh(output["rot"])*self.cfg['rot_normalizer']
-          rot_mat_delta = so3_exp_map(rot_mat_delta).permute(0,2,1)
-        elif self.cfg['rot_rep']=='6d':
-          rot_mat_delta = rotation_6d_to_matrix(output['rot']).permute(0,2,1)
-        else:
-          raise RuntimeError
-
-        if self.cfg['normalize_xyz']:
-          trans_delta *= (mesh_diameter/2)
-
-        B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA[b:b+bs], trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
-        B_in_cams.append(B_in_cam)
-
-      B_in_cams = torch.cat(B_in_cams, dim=0).reshape(len(ob_in_cams),4,4)
-
-    B_in_cams_out = B_in_cams@torch.tensor(tf_to_center[None], device='cuda', dtype=torch.float)
-    torch.cuda.empty_cache()
+      if len(active)==0:
+        break
+      self.active_counts.append(len(active))
+      logging.info(f"making cropped data, active:{len(active)}")
+      raw = pose_data if len(self.active_counts)==1 else None
+      rendered = None
+      use_bank = template_bank is not None and raw is None and len(self.active_counts)==1 and not self.cfg['use_normal']
+      featA = None
+      if use_bank and self.feature_cache is not None:
+        featA = self.feature_cache.lookup(self, template_bank, B_in_cams[active], mesh_diameter)
+      if featA is not None:
+        pose_data_cur = make_observed_crop_data_batch(self.cfg.input_resize, B_in_cams[active], rgb_tensor, K, crop_ratio, xyz_map_tensor, H, W, mesh_diameter, dataset=self.dataset, device=self.device)
+        self.last_renders_avoided += len(active)
+        self.n_renders_avoided += len(active)
+      else:
+        if use_bank:
+          raw, rendered = self.make_template_crop_data(template_bank, B_in_cams[active], mesh_centered, rgb_tensor, K, xyz_map_tensor, H, W, mesh_diameter, glctx, mesh_tensors)
+        elif reproj and raw is None:
+          raw, rendered = self.make_reprojected_crop_data(ref_key, active, B_in_cams[active], mesh_centered, rgb_tensor, K, xyz_map_tensor, H, W, mesh_diameter, glctx, mesh_tensors)
+        raw_out = []
+        pose_data_cur = make_crop_data_batch(self.cfg.input_resize, B_in_cams[active], mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device, raw=raw, raw_out=raw_out)
+        if reproj:
+          if rendered is None:
+            rendered = torch.ones((len(active)), dtype=torch.bool, device=self.device)
+          self.update_render_refs(ref_key, active[rendered], raw_out[0].select_by_indices(rendered.nonzero()[:,0]))
+      B_in_cams_cur, trans_delta_cur, rot_mat_delta_cur = self.update_poses(pose_data_cur, trans_normalizer, bs=bs, featA=featA)
+      B_in_cams[active] = B_in_cams_cur.reshape(-1,4,4)
+      trans_delta[active] = trans_delta_cur
+      rot_mat_delta[active] = rot_mat_delta_cur
+      active = active[self.get_moving(trans_delta_cur, rot_mat_delta_cur, trans_tol, rot_tol)]
+    logging.info(f'active_counts:{self.active_counts}')
+    if reproj or template_bank is not None:
+      logging.info(f'renders avoided:{self.last_renders_avoided}, total:{self.n_renders_avoided}')
+
+    self.last_pose_data = None
+    if get_pose_data:
+      if reproj:
+        # The crops of the last iterations are kept in self.render_refs, reproject them to the refined poses where they are close enough
+        ids = torch.arange(len(B_in_cams), device=self.device)
+        self.last_pose_data, rendered = self.make_reprojected_crop_data(ref_key, ids, B_in_cams, mesh_centered, rgb_tensor, K, xyz_map_tensor, H, W, mesh_diameter, glctx, mesh_tensors)
+        self.update_render_refs(ref_key, ids[rendered], self.last_pose_data.select_by_indices(rendered.nonzero()[:,0]))
+      else:
+        raw_out = []
+        make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device, raw_out=raw_out)
+        self.last_pose_data = raw_out[0]
+
+    B_in_cams_out = B_in_cams@torch.tensor(tf_to_center[None], device=self.device, dtype=torch.float)
+    if self.device.type=='cuda':
+      torch.cuda.empty_cache()
     self.last_trans_update = trans_delta
     self.last_rot_update = rot_mat_delta
 
@@ -242,7 +593,7 @@ class PoseRefinePredictor:
       logging.info("get_vis...")
       canvas = []
       padding = 2
-      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams, device=self.device, dtype=torch.float), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device)
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
         rgbB_vis = (pose_data.rgbBs[id]*255).permute(1,2,0).data.cpu().numpy()
@@ -266,7 +617,7 @@ class PoseRefinePredictor:
         canvas.append(row)
       canvas = make_grid_image(canvas, nrow=1, padding=padding, pad_value=255)
 
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device)
       canvas_refined = []
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
@@ -289,8 +640,72 @@ class PoseRefinePredictor:
 
       canvas_refined = make_grid_image(canvas_refined, nrow=1, padding=padding, pad_value=255)
       canvas = make_grid_image([canvas, canvas_refined], nrow=2, padding=padding, pad_value=255)
-      torch.cuda.empty_cache()
+      if self.device.type=='cuda':
+        torch.cuda.empty_cache()
       return B_in_cams_out, canvas
 
     return B_in_cams_out, None
 
+
+  @torch.inference_mode()
+  def predict_many(self, rgb, depth, K, ob_in_cams_list, xyz_map, meshes, mesh_tensors_list, mesh_diameters, normal_map=None, glctx=None, iteration=5, trans_tol=None, rot_tol=None, mesh_pack:MeshPack=None):
+    '''Refine the hypotheses of several objects in shared batches
+    @ob_in_cams_list: list of (N_i,4,4) np array or tensor, one entry per object
+    @meshes, mesh_tensors_list, mesh_diameters: per object. Objects passing the same mesh_tensors dict are rendered in one call
+    @mesh_pack: MeshPack holding every mesh_tensors of mesh_tensors_list, all objects are then rendered in one call
+    @trans_tol, rot_tol: same as in predict, self.active_counts sums over objects
+    @return: list of refined (N_i,4,4) tensors
+    '''
+    if not self.cfg.use_normal:
+      normal_map = None
+    crop_ratio = self.cfg['crop_ratio']
+    bs = 1024
+
+    B_in_cams_list = [torch.as_tensor(ob_in_cams, device=self.device, dtype=torch.float).reshape(-1,4,4).clone() for ob_in_cams in ob_in_cams_list]
+    actives = [torch.arange(len(B_in_cams), device=self.device) for B_in_cams in B_in_cams_list]
+    trans_tol = trans_tol if trans_tol is not None else self.trans_tol
+    rot_tol = rot_tol if rot_tol is not None else self.rot_tol
+    groups = OrderedDict()
+    for i in range(len(B_in_cams_list)):
+      groups.setdefault(id(mesh_tensors_list[i]) if mesh_pack is None else 0, []).append(i)
+    logging.info(f'objects:{len(B_in_cams_list)}, hypotheses:{[len(B_in_cams) for B_in_cams in B_in_cams_list]}, render groups:{len(groups)}')
+
+    rgb_tensor = torch.as_tensor(rgb, device=self.device)
+    depth_tensor = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    xyz_map_tensor = torch.as_tensor(xyz_map, device=self.device, dtype=torch.float)
+    trans_normalizer = self.get_trans_normalizer()
+
+    self.active_counts = []
+    for _ in range(iteration):
+      counts = [len(active) for active in actives]
+      if sum(counts)==0:
+        break
+      self.active_counts.append(sum(counts))
+      pose_datas = []
+      order = []
+      for ids in groups.values():
+        ids = [j for j in ids if counts[j]>0]
+        if len(ids)==0:
+          continue
+        i = ids[0]
+        poses = torch.cat([B_in_cams_list[j][actives[j]] for j in ids], dim=0)
+        mesh_tensors = mesh_tensors_list[i]
+        mesh_diameter = mesh_diameters[i]
+        if mesh_pack is not None:
+          mesh_tensors = mesh_pack.instances(np.concatenate([[mesh_pack.index(mesh_tensors_list[j])]*counts[j] for j in ids]))
+          mesh_diameter = torch.as_tensor(np.concatenate([[mesh_diameters[j]]*counts[j] for j in ids]), dtype=torch.float, device=self.device)
+        pose_data = make_crop_data_batch(self.cfg.input_resize, poses, meshes[i], rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device)
+        pose_datas.append(pose_data)
+        order += ids
+      pose_data = BatchPoseData.cat(pose_datas)
+      B_in_cams, trans_delta, rot_mat_delta = self.update_poses(pose_data, trans_normalizer, bs=bs)
+      moving = self.get_moving(trans_delta, rot_mat_delta, trans_tol, rot_tol)
+      B_in_cams = torch.split(B_in_cams, [counts[i] for i in order], dim=0)
+      moving = torch.split(moving, [counts[i] for i in order], dim=0)
+      for i, B_in_cam, moving_cur in zip(order, B_in_cams, moving):
+        B_in_cams_list[i][actives[i]] = B_in_cam
+        actives[i] = actives[i][moving_cur]
+
+    if self.device.type=='cuda':
+      torch.cuda.empty_cache()
+    return B_in_cams_list
@@ -21,6 +21,7 @@ from learning.datasets.h5_dataset import *
 from learning.models.score_network import *
 from learning.datasets.pose_dataset import *
 from Utils import *
+from render_backend import *
 from datareader import *
 
 
@@ -54,60 +55,78 @@ def vis_batch_data_scores(pose_data, ids, scores, pad_margin=5):
 
 
 @torch.no_grad()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None):
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None, device='cuda', raw=None, raw_out=None):
+  '''
+  @raw: untransformed BatchPoseData from raw_out of an earlier call on the same frame, e.g. the refiner's final poses. Reused instead of rendering and cropping if made for the same poses and crop windows
+  @raw_out: list, the untransformed BatchPoseData is appended for reuse
+  '''
   logging.info("Welcome make_crop_data_batch")
   H,W = depth.shape[:2]
 
   args = []
   method = 'box_3d'
+  ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
   tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
   logging.info("make tf_to_crops done")
 
   B = len(ob_in_cams)
-  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
-
-  bs = 512
-  rgb_rs = []
-  depth_rs = []
-  xyz_map_rs = []
-
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
-  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
-
-  for b in range(0,len(ob_in_cams),bs):
-    extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
-    rgb_rs.append(rgb_r)
-    depth_rs.append(depth_r[...,None])
-    xyz_map_rs.append(extra['xyz_map'])
-
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-  logging.info("render done")
-
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  depthBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(depth, dtype=torch.float, device='cuda')[None,None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  if rgb_rs.shape[-2:]!=cfg['input_resize']:
-    rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-    depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    rgbAs = rgb_rs
-    depthAs = depth_rs
+  poseAs = ob_in_cams
 
-  if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
-    xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+  if raw_crop_data_matches(raw, poseAs, tf_to_crops):
+    logging.info("reuse rendered crops")
   else:
-    xyz_mapAs = xyz_map_rs
+    bs = 512
+    rgb_rs = []
+    depth_rs = []
+    xyz_map_rs = []
+
+    bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
+    bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
+
+    render_backend = get_render_backend(glctx, device)
+    for b in range(0,len(ob_in_cams),bs):
+      extra = {}
+      rgb_r, depth_r, normal_r = render_backend.render(K=K, H=H, W=W, ob_in_cams=poseAs[b:b+bs], get_normal=cfg['use_normal'], mesh_tensors=slice_mesh_tensors(mesh_tensors, b, b+bs), output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
+      rgb_rs.append(rgb_r)
+      depth_rs.append(depth_r[...,None])
+      xyz_map_rs.append(extra['xyz_map'])
+
+    rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
+    depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)
+    xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
+    logging.info("render done")
+
+    Ks = torch.as_tensor(K, dtype=torch.float, device=device).reshape(1,3,3).expand(B,3,3)
+    depth = torch.as_tensor(depth, dtype=torch.float, device=device)
+    xyz_map = depth2xyzmap_batch(depth[None], Ks[:1], zfar=np.inf)[0]
+    rgbBs = warp_crop_batch(rgb, tf_to_crops, render_size, mode='bilinear')
+    xyz_mapBs = warp_crop_batch(xyz_map, tf_to_crops, render_size, mode='nearest')
+    depthBs = warp_crop_batch(depth, tf_to_crops, render_size, mode='nearest')   # Only for visualization
+    if rgb_rs.shape[-2:]!=cfg['input_resize']:
+      rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+      depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      rgbAs = rgb_rs
+      depthAs = depth_rs
+
+    if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
+      xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      xyz_mapAs = xyz_map_rs
 
-  normalAs = None
-  normalBs = None
+    normalAs = None
+    normalBs = None
 
-  Ks = torch.as_tensor(K, dtype=torch.float).reshape(1,3,3).expand(len(rgbAs),3,3)
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
+    mesh_diameters = torch.ones((B), dtype=torch.float, device=device)*mesh_diameter
+    raw = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
 
-  pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1)
+  if raw_out is not None:
+    raw_out.append(raw)
+  pose_data = copy.copy(raw)
+  pose_data.normalAs = None
+  pose_data.normalBs = None
+  pose_data.rgbBs, pose_data.xyz_mapBs = dataset.normalize_observation(raw.rgbBs, raw.xyz_mapBs, poseA=poseAs, mesh_diameters=raw.mesh_diameters)
+  pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1, observed_done=True)
 
   logging.info("pose batch data done")
 
@@ -115,8 +134,24 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
 
 
 class ScorePredictor:
-  def __init__(self, amp=True):
-    self.amp = amp
+  def __init__(self, amp=True, device='cuda', group_size=None, max_mem_mb=None):
+    '''
+    @group_size: max number of hypotheses rendered, cropped and attended over jointly. None scores all hypotheses in one group
+    @max_mem_mb: peak memory budget of predict on cuda, caps the group size using the per-hypothesis memory measured on the first group.
+    Other devices have no peak memory statistics to enforce it with, RuntimeError is raised instead of ignoring the bound, use group_size there
+    '''
+    self.device = torch.device(device)
+    self.group_size = group_size
+    self.max_mem_mb = max_mem_mb
+    self.check_max_mem_mb(max_mem_mb)
+    self.calib_size = 32
+    self.mem_per_hyp_mb = None
+    self.peak_mem_mb = None
+    self.last_pose_data = None
+    self.last_logits = None
+    self.last_rounds = None
+    self.last_logits_list = None
+    self.amp = amp and self.device.type=='cuda'
     self.run_name = "2024-01-11-20-02-45"
 
     model_name = 'model_best.pth'
@@ -144,84 +179,193 @@ class ScorePredictor:
 
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
-    self.dataset = ScoreMultiPairH5Dataset(cfg=self.cfg, mode='test', h5_file=None, max_num_key=1)
-    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.dataset = ScoreMultiPairH5Dataset(cfg=self.cfg, mode='test', h5_file=None, max_num_key=1, device=self.device)
+    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
+    ckpt = torch.load(ckpt_dir, map_location=self.device)
     if 'model' in ckpt:
       ckpt = ckpt['model']
     self.model.load_state_dict(ckpt)
 
-    self.model.cuda().eval()
+    self.model.to(self.device).eval()
     logging.info("init done")
 
 
-  @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None):
+  def score_pose_data(self, pose_data:BatchPoseData):
+    '''One network pass, all hypotheses in pose_data attend to each other
+    @return: (B) score logits
     '''
+    A = torch.cat([pose_data.rgbAs, pose_data.xyz_mapAs], dim=1).float()
+    B = torch.cat([pose_data.rgbBs, pose_data.xyz_mapBs], dim=1).float()
+    if pose_data.normalAs is not None:
+      A = torch.cat([A, pose_data.normalAs.float()], dim=1)
+      B = torch.cat([B, pose_data.normalBs.float()], dim=1)
+    with torch.cuda.amp.autocast(enabled=self.amp):
+      output = self.model(A, B, L=len(A))
+    return output["score_logit"].float().reshape(-1)
+
+
+  def check_max_mem_mb(self, max_mem_mb):
+    if max_mem_mb is not None and self.device.type!='cuda':
+      raise RuntimeError(f'max_mem_mb is only supported on cuda, the scorer runs on {self.device}. Bound the memory with group_size instead')
+
+
+  def get_group_size(self, n, group_size, max_mem_mb):
+    G = n if group_size is None else group_size
+    if max_mem_mb is not None and self.device.type=='cuda':
+      if self.mem_per_hyp_mb is None:
+        G = min(G, self.calib_size)
+      else:
+        G = min(G, int(max_mem_mb/self.mem_per_hyp_mb))
+    return int(np.clip(G, 2, max(n,2)))
+
+
+  @torch.inference_mode()
+  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, group_size=None, max_mem_mb=None, pose_data=None, get_pose_data=False):
+    '''Tournament over the hypotheses: each round renders, crops and scores groups of at most group_size hypotheses, the group winners advance to the next round.
+    Scores are the logits of the last round a hypothesis took part in, plus 100 per round reached, so the sorting follows the tournament.
+    With a single group this is the same as scoring all hypotheses at once. The raw logits and rounds reached are kept in self.last_logits, self.last_rounds
     @rgb: np array (H,W,3)
+    @group_size, max_mem_mb: override self.group_size, self.max_mem_mb
+    @pose_data: untransformed BatchPoseData of ob_in_cams on this frame, e.g. refiner.last_pose_data, reused instead of rendering and cropping when the crop windows match
+    @get_pose_data: keep the untransformed crops of all hypotheses in self.last_pose_data
     '''
     logging.info(f"ob_in_cams:{ob_in_cams.shape}")
-    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=self.device)
+    group_size = group_size if group_size is not None else self.group_size
+    max_mem_mb = max_mem_mb if max_mem_mb is not None else self.max_mem_mb
+    self.check_max_mem_mb(max_mem_mb)
 
     logging.info(f'self.cfg.use_normal:{self.cfg.use_normal}')
     if not self.cfg.use_normal:
       normal_map = None
 
-    logging.info("making cropped data")
-
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh)
-
-    rgb = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-
-    pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter)
-
-    def find_best_among_pairs(pose_data:BatchPoseData):
-      logging.info(f'pose_data.rgbAs.shape[0]: {pose_data.rgbAs.shape[0]}')
-      ids = []
-      scores = []
-      bs = pose_data.rgbAs.shape[0]
-      for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
-        if pose_data.normalAs is not None:
-          A = torch.cat([A, pose_data.normalAs.cuda().float()], dim=1)
-          B = torch.cat([B, pose_data.normalBs.cuda().float()], dim=1)
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A, B, L=len(A))
-        scores_cur = output["score_logit"].float().reshape(-1)
-        ids.append(scores_cur.argmax()+b)
-        scores.append(scores_cur)
-      ids = torch.stack(ids, dim=0).reshape(-1)
-      scores = torch.cat(scores, dim=0).reshape(-1)
-      return ids, scores
-
-    pose_data_iter = pose_data
-    global_ids = torch.arange(len(ob_in_cams), device='cuda', dtype=torch.long)
-    scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device='cuda')
+      mesh_tensors = make_mesh_tensors(mesh, device=self.device)
+
+    rgb = torch.as_tensor(rgb, device=self.device)
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+
+    if self.device.type=='cuda':
+      torch.cuda.reset_peak_memory_stats(self.device)
+      mem_base = torch.cuda.memory_allocated(self.device)
 
+    global_ids = torch.arange(len(ob_in_cams), device=self.device, dtype=torch.long)
+    scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device=self.device)
+    logits_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device=self.device)
+    rounds_global = torch.zeros((len(ob_in_cams)), dtype=torch.long, device=self.device)
+    n_round = 0
+    raws = []
     while 1:
-      ids, scores = find_best_among_pairs(pose_data_iter)
-      if len(ids)==1:
-        scores_global[global_ids] = scores + 100
+      n_round += 1
+      G = self.get_group_size(len(global_ids), group_size, max_mem_mb)
+      logging.info(f'round:{n_round}, hypotheses:{len(global_ids)}, group_size:{G}')
+      winners = []
+      for b in range(0, len(global_ids), G):
+        ids = global_ids[b:b+G]
+        raw = pose_data.select_by_indices(ids) if pose_data is not None else None
+        raw_out = [] if get_pose_data and n_round==1 else None
+        pose_data_cur = make_crop_data_batch(self.cfg.input_resize, ob_in_cams[ids], mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, device=self.device, raw=raw, raw_out=raw_out)
+        if raw_out is not None:
+          raws.append(raw_out[0])
+        scores_cur = self.score_pose_data(pose_data_cur)
+        scores_global[ids] = scores_cur + 100*n_round
+        logits_global[ids] = scores_cur
+        rounds_global[ids] = n_round
+        winners.append(ids[scores_cur.argmax()])
+        del pose_data_cur
+        if max_mem_mb is not None and self.device.type=='cuda' and self.mem_per_hyp_mb is None and len(ids)>1:
+          self.mem_per_hyp_mb = (torch.cuda.max_memory_allocated(self.device)-mem_base)/1e6/len(ids)
+          logging.info(f'mem_per_hyp_mb:{self.mem_per_hyp_mb:.2f}')
+          G = self.get_group_size(len(global_ids), group_size, max_mem_mb)
+      if len(winners)==1:
         break
-      global_ids = global_ids[ids]
-      pose_data_iter = pose_data.select_by_indices(global_ids)
+      global_ids = torch.stack(winners, dim=0).reshape(-1)
 
     scores = scores_global
-
-    logging.info(f'forward done')
-    torch.cuda.empty_cache()
+    self.last_logits = logits_global
+    self.last_rounds = rounds_global
+    self.last_pose_data = BatchPoseData.cat(raws) if get_pose_data else None
+
+    if self.device.type=='cuda':
+      self.peak_mem_mb = (torch.cuda.max_memory_allocated(self.device)-mem_base)/1e6
+      logging.info(f'forward done, rounds:{n_round}, peak_mem_mb:{self.peak_mem_mb:.1f}')
+      torch.cuda.empty_cache()
+    else:
+      logging.info(f'forward done, rounds:{n_round}')
 
     if get_vis:
       logging.info("get_vis...")
-      canvas = []
+      pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, device=self.device)
       ids = scores.argsort(descending=True)
       canvas = vis_batch_data_scores(pose_data, ids=ids, scores=scores)
       return scores, canvas
 
     return scores, None
 
+
+  @torch.inference_mode()
+  def predict_many(self, rgb, depth, K, ob_in_cams_list, meshes, mesh_tensors_list, mesh_diameters, normal_map=None, glctx=None, mesh_pack:MeshPack=None):
+    '''Score the hypotheses of several objects in shared batches
+    Hypotheses only compete against those of the same object, objects with the same number of hypotheses share one network pass
+    @ob_in_cams_list: list of (N_i,4,4) np array or tensor, one entry per object
+    @meshes, mesh_tensors_list, mesh_diameters: per object. Objects passing the same mesh_tensors dict are rendered in one call
+    @mesh_pack: MeshPack holding every mesh_tensors of mesh_tensors_list, all objects are then rendered in one call
+    @return: list of (N_i) score tensors, the raw logits are kept in self.last_logits_list
+    '''
+    if self.group_size is not None or self.max_mem_mb is not None:
+      # Memory bounded, every object runs its own tournament
+      scores_list = []
+      self.last_logits_list = []
+      for i in range(len(ob_in_cams_list)):
+        scores_list.append(self.predict(rgb=rgb, depth=depth, K=K, ob_in_cams=ob_in_cams_list[i], normal_map=normal_map, mesh=meshes[i], mesh_tensors=mesh_tensors_list[i], glctx=glctx, mesh_diameter=mesh_diameters[i])[0])
+        self.last_logits_list.append(self.last_logits)
+      return scores_list
+
+    if not self.cfg.use_normal:
+      normal_map = None
+
+    ob_in_cams_list = [torch.as_tensor(ob_in_cams, dtype=torch.float, device=self.device).reshape(-1,4,4) for ob_in_cams in ob_in_cams_list]
+    counts = [len(ob_in_cams) for ob_in_cams in ob_in_cams_list]
+    rgb = torch.as_tensor(rgb, device=self.device)
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+
+    render_groups = OrderedDict()
+    score_groups = OrderedDict()
+    for i in range(len(ob_in_cams_list)):
+      render_groups.setdefault(id(mesh_tensors_list[i]) if mesh_pack is None else 0, []).append(i)
+      score_groups.setdefault(counts[i], []).append(i)
+    logging.info(f'objects:{len(counts)}, hypotheses:{counts}, render groups:{len(render_groups)}, score groups:{len(score_groups)}')
+
+    pose_datas = [None]*len(ob_in_cams_list)
+    for ids in render_groups.values():
+      i = ids[0]
+      poses = torch.cat([ob_in_cams_list[j] for j in ids], dim=0)
+      mesh_tensors = mesh_tensors_list[i]
+      mesh_diameter = mesh_diameters[i]
+      if mesh_pack is not None:
+        mesh_tensors = mesh_pack.instances(np.concatenate([[mesh_pack.index(mesh_tensors_list[j])]*counts[j] for j in ids]))
+        mesh_diameter = torch.as_tensor(np.concatenate([[mesh_diameters[j]]*counts[j] for j in ids]), dtype=torch.float, device=self.device)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, poses, meshes[i], rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, device=self.device)
+      start = 0
+      for j in ids:
+        pose_datas[j] = pose_data.select_by_indices(torch.arange(start, start+counts[j], device=self.device))
+        start += counts[j]
+
+    scores_list = [None]*len(ob_in_cams_list)
+    self.last_logits_list = [None]*len(ob_in_cams_list)
+    for L, ids in score_groups.items():
+      pose_data = BatchPoseData.cat([pose_datas[j] for j in ids])
+      A = torch.cat([pose_data.rgbAs, pose_data.xyz_mapAs], dim=1).float()
+      B = torch.cat([pose_data.rgbBs, pose_data.xyz_mapBs], dim=1).float()
+      with torch.cuda.amp.autocast(enabled=self.amp):
+        output = self.model(A, B, L=L)
+      logits = output["score_logit"].float().reshape(len(ids), L)
+      for j, logits_cur in zip(ids, logits):
+        scores_list[j] = logits_cur + 100
+        self.last_logits_list[j] = logits_cur
+
+    if self.device.type=='cuda':
+      torch.cuda.empty_cache()
+    return scores_list
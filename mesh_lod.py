@@ -0,0 +1,75 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Decimated mesh levels for rendering hypotheses into small crops
+
+The crop window of a hypothesis is sized from the mesh diameter, so the object always spans about
+min(input_resize)/crop_ratio pixels whatever its distance. The level is picked once per object from that footprint.
+'''
+
+from Utils import *
+
+
+def decimate_mesh(mesh, n_faces):
+  '''Quadric decimation with vertex colors. Textures are baked into vertex colors first, since the decimation cannot keep uv seams
+  @mesh: trimesh
+  '''
+  if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
+    vertex_colors = mesh.visual.to_color().vertex_colors
+  else:
+    vertex_colors = mesh.visual.vertex_colors
+  o3d_mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(np.asarray(mesh.vertices, dtype=np.float64)), o3d.utility.Vector3iVector(np.asarray(mesh.faces, dtype=np.int32)))
+  if vertex_colors is not None:
+    o3d_mesh.vertex_colors = o3d.utility.Vector3dVector(np.asarray(vertex_colors)[:,:3].astype(np.float64)/255.0)
+  o3d_mesh = o3d_mesh.simplify_quadric_decimation(target_number_of_triangles=int(n_faces))
+  o3d_mesh.remove_unreferenced_vertices()
+  vertex_colors = None
+  if o3d_mesh.has_vertex_colors():
+    vertex_colors = (np.asarray(o3d_mesh.vertex_colors)*255).round().clip(0,255).astype(np.uint8)
+  out = trimesh.Trimesh(vertices=np.asarray(o3d_mesh.vertices), faces=np.asarray(o3d_mesh.triangles), vertex_colors=vertex_colors, process=False)
+  return out
+
+
+
+class MeshLOD:
+  '''Level 0 is the mesh itself, each further level keeps about 1/reduction of the faces of the previous one
+  '''
+  def __init__(self, mesh, reduction=4, min_faces=1000):
+    self.meshes = [mesh]
+    while len(self.meshes[-1].faces)//reduction>=min_faces:
+      self.meshes.append(decimate_mesh(mesh, len(self.meshes[-1].faces)//reduction))
+    self.edge_lengths = [float(m.edges_unique_length.mean()) for m in self.meshes]
+    self.mesh_tensors = {}
+    logging.info(f'mesh lod faces:{[len(m.faces) for m in self.meshes]}, mean edge lengths:{self.edge_lengths}')
+
+
+  def select(self, px_per_meter, max_edge_px=2.0):
+    '''
+    @px_per_meter: crop pixels per meter on the object
+    @return: coarsest level whose mean edge spans at most max_edge_px crop pixels
+    '''
+    level = 0
+    for i in range(1, len(self.meshes)):
+      if self.edge_lengths[i]*px_per_meter<=max_edge_px:
+        level = i
+    return level
+
+
+  def get_mesh_tensors(self, level, device='cuda'):
+    key = (level, str(device))
+    if key not in self.mesh_tensors:
+      self.mesh_tensors[key] = make_mesh_tensors(self.meshes[level], device=device)
+    return self.mesh_tensors[key]
+
+
+
+def crop_px_per_meter(diameter, predictors):
+  '''Finest crop resolution on the object among the refiner and scorer crops
+  '''
+  return max(min(p.cfg['input_resize'])/(p.cfg['crop_ratio']*diameter) for p in predictors if p is not None)
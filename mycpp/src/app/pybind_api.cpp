@@ -19,47 +19,232 @@ namespace py = pybind11;
 
 
 
+namespace
+{
+
+using CellMap = std::unordered_map<int64_t, std::vector<int>>;
+
+
+int64_t hashCell(const int *cell, int n)
+{
+  uint64_t h = 1469598103934665603ULL;
+  for (int i=0;i<n;i++)
+  {
+    h ^= (uint64_t)(int64_t)cell[i];
+    h *= 1099511628211ULL;
+  }
+  return (int64_t)h;
+}
+
+
+//@brief: Buckets clusters by translation with a spatial hash of cell size 2*dist_diff, and within a translation cell by the quaternion on a 4D grid.
+// Two rotations closer than radian_thres have quaternions (up to sign) closer than d=2*sin(radian_thres/4), so with cells of size 2*d every match
+// lies in the 2 cells per axis nearest to the query, 2^3 translation and 2^4 quaternion cells. Buckets only select candidates, the test itself is the one of the greedy loop
+class PoseBuckets
+{
+public:
+  PoseBuckets(float dist_diff, float radian_thres)
+  {
+    _trans_cell = 2*(dist_diff>0? dist_diff : 1);   // nothing matches otherwise, any cell works
+    _quat_cell = 2*(2*std::sin(std::min(radian_thres, float(M_PI))/4) + 1e-3);
+  }
+
+  void insert(int id, const Eigen::Matrix4f &pose)
+  {
+    int tcell[3];
+    transCell(pose, tcell);
+    CellMap &rot_cells = _cells[hashCell(tcell,3)];
+    const Eigen::Quaternionf q(Eigen::Matrix3f(pose.block(0,0,3,3)));
+    for (float sign: {1.0f, -1.0f})
+    {
+      int qcell[4];
+      quatCell(q.coeffs()*sign, qcell);
+      rot_cells[hashCell(qcell,4)].push_back(id);
+    }
+  }
+
+  //@R: query rotation, already multiplied by a symmetry
+  //@fn: called with the cluster ids of each candidate cell, the own cell first, returns true to stop
+  //@return: true if fn stopped the search
+  template<class Fn>
+  bool visit(const Eigen::Matrix3f &R, const Eigen::Vector3f &t, const Fn &fn) const
+  {
+    float tx[3], qx[4];
+    int tlo[3], thi[3], qlo[4], qhi[4];
+    for (int k=0;k<3;k++)
+    {
+      tx[k] = clampCoord(t(k)/_trans_cell);
+      cellRange(tx[k], tlo[k], thi[k]);
+    }
+    const Eigen::Quaternionf q(R);
+    for (int k=0;k<4;k++)
+    {
+      qx[k] = q.coeffs()(k)/_quat_cell;
+      cellRange(qx[k], qlo[k], qhi[k]);
+    }
+
+    int tc[3], qc[4];
+    for (int k=0;k<3;k++) tc[k] = int(std::floor(tx[k]));
+    for (int k=0;k<4;k++) qc[k] = int(std::floor(qx[k]));
+    const auto own = _cells.find(hashCell(tc,3));
+    if (own!=_cells.end())
+    {
+      const auto jt = own->second.find(hashCell(qc,4));
+      if (jt!=own->second.end() && fn(jt->second)) return true;
+    }
+
+    for (tc[0]=tlo[0];tc[0]<=thi[0];tc[0]++)
+    for (tc[1]=tlo[1];tc[1]<=thi[1];tc[1]++)
+    for (tc[2]=tlo[2];tc[2]<=thi[2];tc[2]++)
+    {
+      const auto it = _cells.find(hashCell(tc,3));
+      if (it==_cells.end()) continue;
+      for (qc[0]=qlo[0];qc[0]<=qhi[0];qc[0]++)
+      for (qc[1]=qlo[1];qc[1]<=qhi[1];qc[1]++)
+      for (qc[2]=qlo[2];qc[2]<=qhi[2];qc[2]++)
+      for (qc[3]=qlo[3];qc[3]<=qhi[3];qc[3]++)
+      {
+        const auto jt = it->second.find(hashCell(qc,4));
+        if (jt!=it->second.end() && fn(jt->second)) return true;
+      }
+    }
+    return false;
+  }
+
+private:
+  static float clampCoord(float x)
+  {
+    return std::max(std::min(x, 1e9f), -1e9f);
+  }
+
+  // Cells of everything closer than half a cell to x, with slack for rounding. Two cells per axis
+  static void cellRange(float x, int &lo, int &hi)
+  {
+    lo = int(std::floor(x-0.5001f));
+    hi = int(std::floor(x+0.5001f));
+  }
+
+  void transCell(const Eigen::Matrix4f &pose, int *cell) const
+  {
+    for (int k=0;k<3;k++)
+    {
+      cell[k] = int(std::floor(clampCoord(pose(k,3)/_trans_cell)));
+    }
+  }
+
+  void quatCell(const Eigen::Vector4f &q, int *cell) const
+  {
+    for (int k=0;k<4;k++)
+    {
+      cell[k] = int(std::floor(q(k)/_quat_cell));
+    }
+  }
+
+  float _trans_cell, _quat_cell;
+  std::unordered_map<int64_t, CellMap> _cells;
+};
+
+
+bool isCloseTranslation(const Eigen::Matrix4f &cur_pose, const Eigen::Matrix4f &cluster, float dist_diff)
+{
+  Eigen::Vector3f t0 = cluster.block(0,3,3,1);
+  Eigen::Vector3f t1 = cur_pose.block(0,3,3,1);
+  return (t0-t1).norm()<dist_diff;
+}
+
+
+bool isSamePose(const Eigen::Matrix4f &cur_pose, const Eigen::Matrix4f &cluster, float dist_diff, float radian_thres, const vectorMatrix4f &symmetry_tfs)
+{
+  if (!isCloseTranslation(cur_pose, cluster, dist_diff))
+  {
+    return false;
+  }
+  for (const auto &tf: symmetry_tfs)
+  {
+    Eigen::Matrix4f cur_pose_tmp = cur_pose*tf;
+    float rot_diff = Utils::rotationGeodesicDistance(cur_pose_tmp.block(0,0,3,3), cluster.block(0,0,3,3));
+    if (rot_diff < radian_thres)
+    {
+      return true;
+    }
+  }
+  return false;
+}
+
+} // namespace
+
+
+
 //@angle_diff: unit is degree
 //@dist_diff: unit is meter
-vectorMatrix4f cluster_poses(float angle_diff, float dist_diff, const vectorMatrix4f &poses_in, const vectorMatrix4f &symmetry_tfs)
+//@brief: Greedy clustering, a pose starts a new cluster unless an earlier cluster is within dist_diff and, after one of the symmetry_tfs, within angle_diff.
+// Poses are processed in blocks, each block is matched against the bucketed clusters of the previous blocks in parallel, then the unmatched
+// poses of the block are resolved in order against each other. The output is the same as comparing every pose against every cluster, see cluster_poses_numpy in Utils.py
+//@num_threads: <=0 uses the OpenMP default
+vectorMatrix4f cluster_poses(float angle_diff, float dist_diff, const vectorMatrix4f &poses_in, const vectorMatrix4f &symmetry_tfs, int block_size=256, int num_threads=0)
 {
   printf("num original candidates = %d\n",poses_in.size());
   vectorMatrix4f poses_out;
+  if (poses_in.size()==0) return poses_out;
   poses_out.push_back(poses_in[0]);
 
   const float radian_thres = angle_diff/180.0*M_PI;
+  const int n_threads = num_threads>0? num_threads : omp_get_max_threads();
+  block_size = std::max(block_size, 1);
 
-  for (int i=1;i<poses_in.size();i++)
-  {
-    bool isnew = true;
-    Eigen::Matrix4f cur_pose = poses_in[i];
-    for (const auto &cluster:poses_out)
-    {
-      Eigen::Vector3f t0 = cluster.block(0,3,3,1);
-      Eigen::Vector3f t1 = cur_pose.block(0,3,3,1);
+  PoseBuckets buckets(dist_diff, radian_thres);
+  buckets.insert(0, poses_in[0]);
 
-      if ((t0-t1).norm()>=dist_diff)
-      {
-        continue;
-      }
+  for (int b=1;b<poses_in.size();b+=block_size)
+  {
+    const int n = std::min(int(poses_in.size())-b, block_size);
+    std::vector<char> matched(n, 0);
 
+    #pragma omp parallel for schedule(dynamic) num_threads(n_threads)
+    for (int i=0;i<n;i++)
+    {
+      const Eigen::Matrix4f &cur_pose = poses_in[b+i];
       for (const auto &tf: symmetry_tfs)
       {
         Eigen::Matrix4f cur_pose_tmp = cur_pose*tf;
-        float rot_diff = Utils::rotationGeodesicDistance(cur_pose_tmp.block(0,0,3,3), cluster.block(0,0,3,3));
-        if (rot_diff < radian_thres)
+        const Eigen::Matrix3f R = cur_pose_tmp.block(0,0,3,3);
+        const bool found = buckets.visit(R, cur_pose.block(0,3,3,1), [&](const std::vector<int> &ids)
         {
-          isnew = false;
+          for (int id:ids)
+          {
+            const Eigen::Matrix4f &cluster = poses_out[id];
+            if (isCloseTranslation(cur_pose, cluster, dist_diff) && Utils::rotationGeodesicDistance(R, cluster.block(0,0,3,3)) < radian_thres)
+            {
+              return true;
+            }
+          }
+          return false;
+        });
+        if (found)
+        {
+          matched[i] = 1;
           break;
         }
       }
-
-      if (!isnew) break;
     }
 
-    if (isnew)
+    // New clusters of this block, in order, only against each other
+    const int n_old = poses_out.size();
+    for (int i=0;i<n;i++)
     {
-      poses_out.push_back(poses_in[i]);
+      if (matched[i]) continue;
+      bool isnew = true;
+      for (int j=n_old;j<poses_out.size();j++)
+      {
+        if (isSamePose(poses_in[b+i], poses_out[j], dist_diff, radian_thres, symmetry_tfs))
+        {
+          isnew = false;
+          break;
+        }
+      }
+      if (!isnew) continue;
+      buckets.insert(poses_out.size(), poses_in[b+i]);
+      poses_out.push_back(poses_in[b+i]);
     }
   }
 
@@ -73,5 +258,5 @@ vectorMatrix4f cluster_poses(float angle_diff, float dist_diff, const vectorMatr
 
 PYBIND11_MODULE(mycpp, m)
 {
-  m.def("cluster_poses", &cluster_poses, py::call_guard<py::gil_scoped_release>());
+  m.def("cluster_poses", &cluster_poses, py::arg("angle_diff"), py::arg("dist_diff"), py::arg("poses_in"), py::arg("symmetry_tfs"), py::arg("block_size")=256, py::arg("num_threads")=0, py::call_guard<py::gil_scoped_release>());
 }
\ No newline at end of file
@@ -0,0 +1,213 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Precompiled object packs: everything FoundationPose.reset_object derives from a mesh, in one content-hashed file
+
+Layout: 8-byte magic, uint64 header length, json header, then 64-byte aligned raw arrays that are memory-mapped on load.
+
+Usage: python object_pack.py --mesh_file demo_data/mustard0/mesh/textured_simple.obj --out_dir packs
+'''
+
+from Utils import *
+import json
+
+
+PACK_MAGIC = b'FPPACK01'
+PACK_ALIGN = 64
+PACK_VERSION = 2
+
+
+def make_object_assets(mesh, model_normals=None):
+  '''Per-mesh quantities used by FoundationPose, shared by reset_object and the pack builder
+  @mesh: trimesh in its original frame
+  @model_normals: (N,3) per-vertex normals used for the downsampled cloud, defaults to mesh.vertex_normals
+  '''
+  if model_normals is None:
+    model_normals = mesh.vertex_normals
+  max_xyz = mesh.vertices.max(axis=0)
+  min_xyz = mesh.vertices.min(axis=0)
+  model_center = (min_xyz+max_xyz)/2
+  mesh_ori = mesh.copy()
+  mesh = mesh.copy()
+  mesh.vertices = mesh.vertices - model_center.reshape(1,3)
+
+  diameter = compute_mesh_diameter(model_pts=mesh.vertices, method='auto')
+  vox_size = max(diameter/20.0, 0.003)
+  pcd = toOpen3dCloud(mesh.vertices, normals=model_normals)
+  pcd = pcd.voxel_down_sample(vox_size)
+  pts = np.asarray(pcd.points)
+  normals = np.asarray(pcd.normals)
+  normals = normals/np.linalg.norm(normals, axis=-1, keepdims=True).clip(1e-12)
+  return {
+    'model_center': model_center,
+    'mesh_ori': mesh_ori,
+    'mesh': mesh,
+    'diameter': float(diameter),
+    'vox_size': float(vox_size),
+    'pts': pts,
+    'normals': normals,
+  }
+
+
+def mesh_content_hash(mesh, model_normals=None):
+  arrays = [mesh.vertices, mesh.faces]
+  if model_normals is not None:
+    arrays.append(model_normals)
+  if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
+    arrays += [mesh.visual.uv, np.array(mesh.visual.material.image.convert('RGB'))]
+  elif mesh.visual.vertex_colors is not None:
+    arrays.append(mesh.visual.vertex_colors)
+  return hash_arrays(np.array([PACK_VERSION]), *arrays)
+
+
+def write_pack_file(path, arrays, meta):
+  header = {'meta': meta, 'arrays': {}}
+  offset = 0
+  for k in arrays:
+    arr = np.ascontiguousarray(arrays[k])
+    arrays[k] = arr
+    header['arrays'][k] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+    offset += int(np.ceil(arr.nbytes/PACK_ALIGN))*PACK_ALIGN
+  header_bytes = json.dumps(header).encode()
+  data_start = int(np.ceil((len(PACK_MAGIC)+8+len(header_bytes))/PACK_ALIGN))*PACK_ALIGN
+
+  tmp_path = f'{path}.{uuid.uuid4()}.tmp'
+  with open(tmp_path, 'wb') as ff:
+    ff.write(PACK_MAGIC)
+    ff.write(np.uint64(len(header_bytes)).tobytes())
+    ff.write(header_bytes)
+    for k in arrays:
+      ff.seek(data_start+header['arrays'][k]['offset'])
+      ff.write(arrays[k].tobytes())
+    ff.truncate(data_start+offset)
+  os.replace(tmp_path, path)
+
+
+def read_pack_file(path):
+  '''
+  @return: meta dict, dict of read-only memory-mapped arrays
+  '''
+  with open(path, 'rb') as ff:
+    magic = ff.read(len(PACK_MAGIC))
+    if magic!=PACK_MAGIC:
+      raise RuntimeError(f'{path} is not an object pack')
+    header_len = int(np.frombuffer(ff.read(8), dtype=np.uint64)[0])
+    header = json.loads(ff.read(header_len).decode())
+  data_start = int(np.ceil((len(PACK_MAGIC)+8+header_len)/PACK_ALIGN))*PACK_ALIGN
+  arrays = {}
+  for k, info in header['arrays'].items():
+    shape = tuple(info['shape'])
+    if np.prod(shape)==0:
+      arrays[k] = np.zeros(shape, dtype=info['dtype'])
+      continue
+    arrays[k] = np.memmap(path, dtype=info['dtype'], mode='r', offset=data_start+info['offset'], shape=shape)
+  return header['meta'], arrays
+
+
+def make_object_pack(mesh, model_normals=None, out_dir='.', max_tex_size=None):
+  '''Serialize the derived assets of a mesh, the file name is the content hash so existing packs are reused
+  @return: path of the pack
+  '''
+  key = mesh_content_hash(mesh, model_normals)
+  path = f'{out_dir}/{key[:16]}.fppack'
+  if os.path.exists(path):
+    logging.info(f'pack exists: {path}')
+    return path
+
+  assets = make_object_assets(mesh, model_normals)
+  mesh_centered = assets['mesh']
+  arrays = {
+    'model_center': assets['model_center'].astype(np.float64),
+    'vertices': mesh_centered.vertices.astype(np.float64),
+    'faces': mesh_centered.faces.astype(np.int64),
+    'vertex_normals': mesh_centered.vertex_normals.astype(np.float64),
+    'pts': assets['pts'].astype(np.float32),
+    'normals': assets['normals'].astype(np.float32),
+  }
+  if isinstance(mesh_centered.visual, trimesh.visual.texture.TextureVisuals):
+    img = np.array(mesh_centered.visual.material.image.convert('RGB'))[...,:3]
+    if max_tex_size is not None:
+      max_size = max(img.shape[0], img.shape[1])
+      if max_size>max_tex_size:
+        scale = 1/max_size * max_tex_size
+        img = cv2.resize(img, fx=scale, fy=scale, dsize=None)
+    arrays['tex'] = img.astype(np.uint8)
+    arrays['uv'] = np.asarray(mesh_centered.visual.uv, dtype=np.float64)
+  else:
+    if mesh_centered.visual.vertex_colors is None:
+      mesh_centered.visual.vertex_colors = np.tile(np.array([128,128,128]).reshape(1,3), (len(mesh_centered.vertices), 1))
+    arrays['vertex_color'] = np.asarray(mesh_centered.visual.vertex_colors, dtype=np.uint8)
+
+  meta = {'version': PACK_VERSION, 'key': key, 'diameter': assets['diameter'], 'vox_size': assets['vox_size']}
+  os.makedirs(out_dir, exist_ok=True)
+  write_pack_file(path, arrays, meta)
+  logging.info(f'pack saved to {path}')
+  return path
+
+
+
+class ObjectPack:
+  '''Memory-mapped object pack, hydrates the attributes reset_object would compute
+  '''
+  def __init__(self, path):
+    self.path = path
+    self.meta, self.arrays = read_pack_file(path)
+    if self.meta['version']!=PACK_VERSION:
+      raise RuntimeError(f"{path} has pack version {self.meta['version']}, expected {PACK_VERSION}")
+    self.key = self.meta['key']
+    self.diameter = self.meta['diameter']
+    self.vox_size = self.meta['vox_size']
+    self.model_center = np.array(self.arrays['model_center'])
+
+
+  def make_mesh(self):
+    '''
+    @return: centered mesh, mesh in its original frame
+    '''
+    A = self.arrays
+    if 'tex' in A:
+      visual = trimesh.visual.texture.TextureVisuals(uv=np.array(A['uv']), image=Image.fromarray(np.array(A['tex'])))
+    else:
+      visual = trimesh.visual.ColorVisuals(vertex_colors=np.array(A['vertex_color']))
+    mesh = trimesh.Trimesh(vertices=np.array(A['vertices']), faces=np.array(A['faces']), vertex_normals=np.array(A['vertex_normals']), visual=visual, process=False)
+    mesh_ori = mesh.copy()
+    mesh_ori.vertices = mesh_ori.vertices + self.model_center.reshape(1,3)
+    return mesh, mesh_ori
+
+
+  def make_mesh_tensors(self, device='cuda', tex_format=None):
+    '''Same content as make_mesh_tensors on the centered mesh, without going through trimesh
+    '''
+    A = self.arrays
+    mesh_tensors = {}
+    if 'tex' in A:
+      mesh_tensors.update(make_texture_tensors(np.array(A['tex']), np.array(A['uv']), np.array(A['faces']), np.array(A['vertices']), device=device, tex_format=tex_format))
+    else:
+      mesh_tensors['vertex_color'] = torch.as_tensor(np.array(A['vertex_color'])[...,:3], device=device, dtype=torch.float)/255.0
+    mesh_tensors.update({
+      'pos': torch.as_tensor(np.array(A['vertices']), device=device, dtype=torch.float),
+      'faces': torch.as_tensor(np.array(A['faces']), device=device, dtype=torch.int),
+      'vnormals': torch.as_tensor(np.array(A['vertex_normals']), device=device, dtype=torch.float),
+    })
+    return mesh_tensors
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  code_dir = os.path.dirname(os.path.realpath(__file__))
+  parser.add_argument('--mesh_file', type=str, nargs='+', required=True)
+  parser.add_argument('--out_dir', type=str, default=f'{code_dir}/cache/object_packs')
+  parser.add_argument('--max_tex_size', type=int, default=None)
+  args = parser.parse_args()
+
+  for mesh_file in args.mesh_file:
+    mesh = trimesh.load(mesh_file)
+    path = make_object_pack(mesh, model_normals=mesh.vertex_normals, out_dir=args.out_dir, max_tex_size=args.max_tex_size)
+    print(f'{mesh_file} -> {path}')
@@ -0,0 +1,595 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Renderers behind one interface, so hypotheses can be rendered without an nvdiffrast CUDA context
+
+Anywhere a glctx is passed around, a RenderBackend can be passed instead, see get_render_backend.
+'''
+
+from Utils import *
+
+
+class RenderBackend:
+  '''Same inputs and outputs as nvdiffrast_render: color (N,h,w,3) in [0,1], depth (N,h,w), normal map (N,h,w,3) or None,
+  and extra['xyz_map'] (N,h,w,3) in the camera frame. Images are y-down, background is 0
+  '''
+  name = None
+
+  def render(self, K, H, W, ob_in_cams, mesh_tensors, get_normal=False, output_size=None, bbox2d=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
+    '''
+    @mesh_tensors: from make_mesh_tensors, or MeshInstances to render each pose with its own mesh of a MeshPack
+    '''
+    raise NotImplementedError
+
+
+  def render_instances(self, K, H, W, ob_in_cams, instances, get_normal=False, output_size=None, bbox2d=None, use_light=False, extra={}, **kwargs):
+    '''Fallback for backends without a packed path, one render call per object
+    '''
+    if instances.occluder_poses is not None:
+      raise NotImplementedError(f'{self.name} backend does not render occluders')
+    ids = instances.instance_ids.to(ob_in_cams.device)
+    outs = [None]*3
+    xyz_map = None
+    for o in ids.unique().tolist():
+      sel = (ids==o).nonzero()[:,0]
+      extra_cur = {}
+      out = self.render(K, H, W, ob_in_cams[sel], instances.pack.mesh_tensors_list[o], get_normal=get_normal, output_size=output_size, bbox2d=bbox2d[sel] if bbox2d is not None else None, use_light=use_light, extra=extra_cur, **kwargs)
+      for k in range(3):
+        if out[k] is None:
+          continue
+        if outs[k] is None:
+          outs[k] = torch.zeros((len(ob_in_cams),)+out[k].shape[1:], dtype=out[k].dtype, device=out[k].device)
+        outs[k][sel] = out[k]
+      if xyz_map is None:
+        xyz_map = torch.zeros((len(ob_in_cams),)+extra_cur['xyz_map'].shape[1:], dtype=torch.float, device=ob_in_cams.device)
+      xyz_map[sel] = extra_cur['xyz_map']
+    extra['xyz_map'] = xyz_map
+    return tuple(outs)
+
+
+  def to(self, device):
+    return self
+
+
+
+class MeshPack:
+  '''Several meshes concatenated into one vertex and face buffer, so hypotheses of different objects are rasterized together.
+  Textures are stacked into one atlas, vertex colored meshes sample a black band of it and add their vertex colors
+  '''
+  def __init__(self, mesh_tensors_list):
+    self.mesh_tensors_list = list(mesh_tensors_list)
+    device = self.mesh_tensors_list[0]['pos'].device
+    n_verts = [len(m['pos']) for m in self.mesh_tensors_list]
+    n_faces = [len(m['faces']) for m in self.mesh_tensors_list]
+    self.vert_ranges = np.stack([np.cumsum([0]+n_verts)[:-1], n_verts], axis=-1)
+    self.face_ranges = np.stack([np.cumsum([0]+n_faces)[:-1], n_faces], axis=-1)
+    self.tensors = {
+      'pos': torch.cat([m['pos'] for m in self.mesh_tensors_list], dim=0),
+      'faces': torch.cat([m['faces']+int(v0) for m,(v0,_) in zip(self.mesh_tensors_list, self.vert_ranges)], dim=0).int(),
+      'vnormals': torch.cat([m['vnormals'] for m in self.mesh_tensors_list], dim=0),
+    }
+    vertex_colors = []
+    for m, n in zip(self.mesh_tensors_list, n_verts):
+      vertex_colors.append(m['vertex_color'] if 'vertex_color' in m else torch.zeros((n,3), dtype=torch.float, device=device))
+    self.tensors['vertex_color'] = torch.cat(vertex_colors, dim=0)
+
+    texs = [get_mesh_texture(m)[0] if has_mesh_texture(m) else None for m in self.mesh_tensors_list]
+    if any(tex is not None for tex in texs):
+      W_atlas = max(tex.shape[1] for tex in texs if tex is not None)
+      H_used = sum(tex.shape[0] for tex in texs if tex is not None)
+      H_atlas = H_used+2
+      atlas = torch.zeros((H_atlas,W_atlas,3), dtype=torch.float, device=device)
+      uvs = []
+      y_off = 0
+      for m, tex, n in zip(self.mesh_tensors_list, texs, n_verts):
+        if tex is None:
+          uvs.append(torch.tensor([[0.5, (H_used+1)/H_atlas]], dtype=torch.float, device=device).expand(n,2))
+          continue
+        h,w = tex.shape[:2]
+        atlas[y_off:y_off+h, :w] = tex
+        uv = m['uv'].clamp(0,1)
+        uvs.append(torch.stack([uv[:,0]*w/W_atlas, (y_off+uv[:,1]*h)/H_atlas], dim=-1))
+        y_off += h
+      self.tensors['tex'] = atlas[None]
+      self.tensors['uv'] = torch.cat(uvs, dim=0)
+      self.tensors['uv_idx'] = self.tensors['faces']
+    logging.info(f'packed meshes:{len(self.mesh_tensors_list)}, vertices:{len(self.tensors["pos"])}, faces:{len(self.tensors["faces"])}')
+
+
+  def index(self, mesh_tensors):
+    for i, m in enumerate(self.mesh_tensors_list):
+      if m is mesh_tensors:
+        return i
+    for i, m in enumerate(self.mesh_tensors_list):
+      if mesh_tensors_equal(m, mesh_tensors):
+        return i
+    raise RuntimeError('mesh_tensors not in the pack')
+
+
+  def instances(self, instance_ids, occluder_poses=None):
+    return MeshInstances(self, instance_ids, occluder_poses=occluder_poses)
+
+
+
+class MeshInstances:
+  '''Which mesh of a MeshPack each pose renders, passed in place of mesh_tensors
+  @instance_ids: (N) index into pack.mesh_tensors_list per pose
+  @occluder_poses: optional (n_mesh,4,4) poses of all packed objects, rendered around each pose for occlusion-aware crops
+  '''
+  def __init__(self, pack, instance_ids, occluder_poses=None):
+    self.pack = pack
+    self.instance_ids = torch.as_tensor(instance_ids, dtype=torch.long)
+    self.occluder_poses = occluder_poses
+
+
+  def __len__(self):
+    return len(self.instance_ids)
+
+
+  def __getitem__(self, ids):
+    return MeshInstances(self.pack, self.instance_ids[ids], occluder_poses=self.occluder_poses)
+
+
+
+def slice_mesh_tensors(mesh_tensors, start, end):
+  '''mesh_tensors for the poses start:end of a batch, only MeshInstances differ per pose
+  '''
+  if isinstance(mesh_tensors, MeshInstances):
+    return mesh_tensors[start:end]
+  return mesh_tensors
+
+
+
+class RenderSession:
+  '''nvdiffrast rendering bound to one (K, H, W, output_size, mesh_tensors), so repeated renders in the refine and score loops
+  reuse the projection, the homogeneous vertices and the transform buffers.
+  Clip space y is negated, so nvdiffrast writes rows top to bottom and the outputs need no flip
+  '''
+  def __init__(self, K, H, W, mesh_tensors, output_size=None, glctx=None, znear=0.001, zfar=100):
+    device = mesh_tensors['pos'].device
+    if glctx is None:
+      glctx = dr.RasterizeCudaContext(device)
+    if output_size is None:
+      output_size = np.asarray([H,W])
+    self.glctx = glctx
+    self.K = np.asarray(K, dtype=float).copy()
+    self.H = H
+    self.W = W
+    self.output_size = np.asarray(output_size).astype(int)
+    self.mesh_tensors = mesh_tensors
+    self.pos = mesh_tensors['pos']
+    projection_mat = projection_matrix_from_intrinsics(self.K, height=H, width=W, znear=znear, zfar=zfar)
+    self.proj_in_cvcam = torch.as_tensor(projection_mat@glcam_in_cvcam, device=device, dtype=torch.float)
+    self.pos_homo = to_homo_torch(mesh_tensors['pos'])
+    self.flip_y = torch.diag(torch.tensor([1,-1,1,1], device=device, dtype=torch.float))
+    self.buffers = {}
+
+
+  def matches(self, K, H, W, output_size, mesh_tensors):
+    if output_size is None:
+      output_size = np.asarray([H,W])
+    return mesh_tensors is self.mesh_tensors and mesh_tensors['pos'] is self.pos and H==self.H and W==self.W and np.array_equal(np.asarray(output_size).astype(int), self.output_size) and np.array_equal(np.asarray(K, dtype=float), self.K)
+
+
+  def get_buffers(self, N):
+    '''One set of transform buffers sized to the largest batch seen, smaller batches get [:N] views so memory does not grow with the number of distinct batch sizes
+    '''
+    buf = self.buffers
+    if len(buf)==0 or len(buf['tf'])<N or buf['tf'].is_inference()!=torch.is_inference_mode_enabled():
+      self.buffers = buf = {}   # release the old set before allocating the larger one
+      device = self.pos_homo.device
+      V = len(self.pos_homo)
+      buf['mtx'] = torch.empty((N,4,4), device=device, dtype=torch.float)
+      buf['tf'] = self.flip_y[None].repeat(N,1,1)
+      buf['clip_tf'] = torch.empty((N,4,4), device=device, dtype=torch.float)
+      buf['pos_clip'] = torch.empty((N,V,4), device=device, dtype=torch.float)
+      self.buffers = buf
+    return {k: v[:N] for k,v in buf.items()}
+
+
+  def get_clip_tf(self, ob_in_cams, bbox2d=None):
+    '''
+    @return: (N,4,4) right-multiplied on homogeneous object points gives clip space coordinates, ROI and y flip included
+    '''
+    H,W = self.H, self.W
+    buf = self.get_buffers(len(ob_in_cams))
+    torch.matmul(self.proj_in_cvcam, ob_in_cams, out=buf['mtx'])
+    if bbox2d is not None:
+      l = bbox2d[:,0]
+      t = H-bbox2d[:,1]
+      r = bbox2d[:,2]
+      b = H-bbox2d[:,3]
+      tf = buf['tf']
+      tf[:,0,0] = W/(r-l)
+      tf[:,1,1] = -H/(t-b)
+      tf[:,3,0] = (W-r-l)/(r-l)
+      tf[:,3,1] = -(H-t-b)/(t-b)
+    else:
+      tf = self.flip_y
+    return torch.matmul(buf['mtx'].transpose(1,2), tf, out=buf['clip_tf'])
+
+
+  def render(self, ob_in_cams, get_normal=False, bbox2d=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
+    '''Same as nvdiffrast_render
+    @ob_in_cams: (N,4,4) torch tensor, openCV camera
+    @bbox2d: (N,4) (umin,vmin,umax,vmax) if only roi need to render.
+    '''
+    mesh_tensors = self.mesh_tensors
+    N = len(ob_in_cams)
+    clip_tf = self.get_clip_tf(ob_in_cams, bbox2d)
+    pos_clip = torch.matmul(self.pos_homo, clip_tf, out=self.get_buffers(N)['pos_clip'])
+    pts_cam = transform_pts(mesh_tensors['pos'], ob_in_cams)
+    rast_out, _ = dr.rasterize(self.glctx, pos_clip, mesh_tensors['faces'], resolution=self.output_size)
+
+    tex = None
+    if has_mesh_texture(mesh_tensors):
+      tex = get_mesh_texture(mesh_tensors, get_render_px_per_meter(self.K, self.W, ob_in_cams, self.output_size, bbox2d))
+    vnormals_cam = None
+    if get_normal or use_light:
+      vnormals_cam = transform_dirs(mesh_tensors['vnormals'], ob_in_cams)
+    return self.shade(rast_out, mesh_tensors['faces'], pts_cam, vnormals_cam, uv=mesh_tensors.get('uv'), uv_idx=mesh_tensors.get('uv_idx'), tex=tex, vertex_color=mesh_tensors.get('vertex_color'), get_normal=get_normal, use_light=use_light, light_color=light_color, light_dir=light_dir, light_pos=light_pos, w_ambient=w_ambient, w_diffuse=w_diffuse, extra=extra)
+
+
+  def shade(self, rast_out, tri, pts_cam, vnormals_cam, uv=None, uv_idx=None, tex=None, vertex_color=None, get_normal=False, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
+    '''Interpolation, texturing and lighting of nvdiffrast_render on a rasterization. Attributes are per vertex in the layout tri indexes.
+    Color is the texture lookup plus the interpolated vertex_color, whichever are given
+    '''
+    device = rast_out.device
+    xyz_map, _ = dr.interpolate(pts_cam, rast_out, tri)
+    depth = xyz_map[...,2]
+    color = None
+    if tex is not None:
+      texc, _ = dr.interpolate(uv, rast_out, uv_idx)
+      color = dr.texture(tex, texc, filter_mode='linear')
+    if vertex_color is not None:
+      vertex_color_map, _ = dr.interpolate(vertex_color, rast_out, tri)
+      color = vertex_color_map if color is None else color+vertex_color_map
+
+    if use_light:
+      get_normal = True
+    if get_normal:
+      normal_map, _ = dr.interpolate(vnormals_cam, rast_out, tri)
+      normal_map = F.normalize(normal_map, dim=-1)
+    else:
+      normal_map = None
+
+    if use_light:
+      if light_dir is not None:
+        light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device=device)
+      else:
+        light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device=device) - pts_cam
+      diffuse_intensity = (F.normalize(vnormals_cam, dim=-1) * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
+      diffuse_intensity_map, _ = dr.interpolate(diffuse_intensity, rast_out, tri)  # (N_pose, H, W, 1)
+      if light_color is None:
+        light_color = color
+      else:
+        light_color = torch.as_tensor(light_color, device=device, dtype=torch.float)
+      color = color*w_ambient + diffuse_intensity_map*light_color*w_diffuse
+
+    color = color.clip_(0,1)
+    color.mul_(torch.clamp(rast_out[..., -1:], 0, 1))   # Mask out background using alpha
+    extra['xyz_map'] = xyz_map
+    return color, depth, normal_map
+
+
+  def render_instances(self, ob_in_cams, instances, get_normal=False, bbox2d=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
+    '''Render each pose with its own mesh of a MeshPack in one rasterization call. The session must be bound to instances.pack.tensors
+    Without occluders every pose gets its own vertex copy and triangle range (nvdiffrast range mode).
+    With instances.occluder_poses, every pose renders the whole scene, the other objects at their occluder poses, and only the pixels where its own object is visible are kept
+    @ob_in_cams: (N,4,4)
+    @instances: MeshInstances with N instance ids
+    '''
+    pack = instances.pack
+    tensors = pack.tensors
+    device = ob_in_cams.device
+    N = len(ob_in_cams)
+    ids = instances.instance_ids.data.cpu().numpy()
+    need_normal = get_normal or use_light
+    tex = tensors.get('tex')
+
+    if instances.occluder_poses is None:
+      clip_tf = self.get_clip_tf(ob_in_cams, bbox2d)
+      pos_clips, pts_cams, vnormals_cams, uvs, vertex_colors, tris = [], [], [], [], [], []
+      ranges = torch.zeros((N,2), dtype=torch.int32)
+      v_off = 0
+      t_off = 0
+      for o in np.unique(ids):
+        sel = np.nonzero(ids==o)[0]
+        sel_t = torch.as_tensor(sel, device=device)
+        n_o = len(sel)
+        v0, vc = pack.vert_ranges[o]
+        f0, fc = pack.face_ranges[o]
+        pos_clips.append(torch.matmul(self.pos_homo[v0:v0+vc], clip_tf[sel_t]).reshape(-1,4))
+        poses = ob_in_cams[sel_t]
+        pts_cams.append((tensors['pos'][v0:v0+vc]@poses[:,:3,:3].transpose(1,2) + poses[:,None,:3,3]).reshape(-1,3))
+        if need_normal:
+          vnormals_cams.append((tensors['vnormals'][v0:v0+vc]@poses[:,:3,:3].transpose(1,2)).reshape(-1,3))
+        if tex is not None:
+          uvs.append(tensors['uv'][v0:v0+vc].repeat(n_o,1))
+        vertex_colors.append(tensors['vertex_color'][v0:v0+vc].repeat(n_o,1))
+        faces_local = tensors['faces'][f0:f0+fc]-v0
+        tris.append((faces_local[None] + (v_off+torch.arange(n_o, device=device, dtype=torch.int32)*vc).reshape(-1,1,1)).reshape(-1,3))
+        ranges[sel,0] = torch.as_tensor(t_off+np.arange(n_o)*fc, dtype=torch.int32)
+        ranges[sel,1] = int(fc)
+        v_off += n_o*vc
+        t_off += n_o*fc
+      tri = torch.cat(tris, dim=0).int().contiguous()
+      rast_out, _ = dr.rasterize(self.glctx, torch.cat(pos_clips, dim=0).contiguous(), tri, resolution=self.output_size, ranges=ranges)
+      pts_cam = torch.cat(pts_cams, dim=0)
+      vnormals_cam = torch.cat(vnormals_cams, dim=0) if need_normal else None
+      uv = torch.cat(uvs, dim=0) if tex is not None else None
+      return self.shade(rast_out, tri, pts_cam, vnormals_cam, uv=uv, uv_idx=tri, tex=tex, vertex_color=torch.cat(vertex_colors, dim=0), get_normal=get_normal, use_light=use_light, light_color=light_color, light_dir=light_dir, light_pos=light_pos, w_ambient=w_ambient, w_diffuse=w_diffuse, extra=extra)
+
+    poses_all = torch.as_tensor(instances.occluder_poses, dtype=torch.float, device=device)[None].repeat(N,1,1,1)   #(N,n_obj,4,4)
+    ids_t = torch.as_tensor(ids, device=device)
+    poses_all[torch.arange(N, device=device), ids_t] = ob_in_cams
+    pos_clip = torch.empty((N,len(tensors['pos']),4), dtype=torch.float, device=device)
+    pts_cam = torch.empty((N,len(tensors['pos']),3), dtype=torch.float, device=device)
+    vnormals_cam = torch.empty((N,len(tensors['pos']),3), dtype=torch.float, device=device) if need_normal else None
+    for o in range(len(pack.mesh_tensors_list)):
+      v0, vc = pack.vert_ranges[o]
+      poses = poses_all[:,o]
+      pos_clip[:,v0:v0+vc] = torch.matmul(self.pos_homo[v0:v0+vc], self.get_clip_tf(poses, bbox2d))
+      pts_cam[:,v0:v0+vc] = tensors['pos'][v0:v0+vc]@poses[:,:3,:3].transpose(1,2) + poses[:,None,:3,3]
+      if need_normal:
+        vnormals_cam[:,v0:v0+vc] = tensors['vnormals'][v0:v0+vc]@poses[:,:3,:3].transpose(1,2)
+    rast_out, _ = dr.rasterize(self.glctx, pos_clip, tensors['faces'], resolution=self.output_size)
+    face_ranges = torch.as_tensor(pack.face_ranges, device=device)[ids_t]
+    tri_ids = rast_out[...,3].long()-1
+    own = (tri_ids>=face_ranges[:,0].reshape(N,1,1)) & (tri_ids<(face_ranges[:,0]+face_ranges[:,1]).reshape(N,1,1))
+    color, depth, normal_map = self.shade(rast_out, tensors['faces'], pts_cam, vnormals_cam, uv=tensors.get('uv'), uv_idx=tensors['faces'], tex=tex, vertex_color=tensors['vertex_color'], get_normal=get_normal, use_light=use_light, light_color=light_color, light_dir=light_dir, light_pos=light_pos, w_ambient=w_ambient, w_diffuse=w_diffuse, extra=extra)
+    own = own[...,None]
+    color = color*own
+    extra['xyz_map'] = extra['xyz_map']*own
+    depth = extra['xyz_map'][...,2]
+    if normal_map is not None:
+      normal_map = normal_map*own
+    return color, depth, normal_map
+
+
+
+class NvdiffrastBackend(RenderBackend):
+  '''Renders through RenderSession, keeping the most recently used sessions
+  '''
+  name = 'nvdiffrast'
+
+  def __init__(self, glctx=None, device='cuda', max_sessions=8):
+    if glctx is None:
+      glctx = dr.RasterizeCudaContext(device)
+    self.glctx = glctx
+    self.max_sessions = max_sessions
+    self.sessions = OrderedDict()
+
+
+  def get_session(self, K, H, W, output_size, mesh_tensors):
+    key = (id(mesh_tensors), H, W, tuple(np.asarray(output_size if output_size is not None else [H,W]).astype(int).tolist()), np.asarray(K, dtype=float).tobytes())
+    session = self.sessions.get(key)
+    if session is None or not session.matches(K, H, W, output_size, mesh_tensors):
+      session = RenderSession(K, H, W, mesh_tensors, output_size=output_size, glctx=self.glctx)
+      self.sessions[key] = session
+      while len(self.sessions)>self.max_sessions:
+        self.sessions.popitem(last=False)
+    self.sessions.move_to_end(key)
+    return session
+
+
+  def render(self, K, H, W, ob_in_cams, mesh_tensors, get_normal=False, output_size=None, bbox2d=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
+    if isinstance(mesh_tensors, MeshInstances):
+      session = self.get_session(K, H, W, output_size, mesh_tensors.pack.tensors)
+      return session.render_instances(ob_in_cams, mesh_tensors, get_normal=get_normal, bbox2d=bbox2d, use_light=use_light, light_color=light_color, light_dir=light_dir, light_pos=light_pos, w_ambient=w_ambient, w_diffuse=w_diffuse, extra=extra)
+    session = self.get_session(K, H, W, output_size, mesh_tensors)
+    return session.render(ob_in_cams, get_normal=get_normal, bbox2d=bbox2d, use_light=use_light, light_color=light_color, light_dir=light_dir, light_pos=light_pos, w_ambient=w_ambient, w_diffuse=w_diffuse, extra=extra)
+
+
+  def to(self, device):
+    if torch.device(device).type!='cuda':
+      return TorchRasterBackend()
+    return NvdiffrastBackend(device=device, max_sessions=self.max_sessions)
+
+
+
+class TorchRasterBackend(RenderBackend):
+  '''Batched z-buffer rasterizer in plain torch ops, runs on any device including CPU.
+  Pixel centers, ROI mapping, texture lookup and shading follow nvdiffrast_render.
+  Triangles with a vertex in front of the near plane are dropped instead of clipped
+  '''
+  name = 'torch'
+
+  def __init__(self, max_fragments=2**22, znear=0.001):
+    '''
+    @max_fragments: candidate pixels processed at once, bounds the memory
+    '''
+    self.max_fragments = max_fragments
+    self.znear = znear
+
+
+  def rasterize(self, pts_cam, faces, K, H, W, output_size, bbox2d=None):
+    '''
+    @pts_cam: (N,V,3) vertices in the camera frame
+    @faces: (F,3)
+    @return: face_ids (N,h,w) long, -1 for background, perspective-correct barycentrics (N,h,w,3)
+    '''
+    device = pts_cam.device
+    N = len(pts_cam)
+    h,w = int(output_size[0]), int(output_size[1])
+    K = torch.as_tensor(K, dtype=torch.float, device=device)
+    if bbox2d is None:
+      bbox2d = torch.as_tensor([0, 0, W, H], dtype=torch.float, device=device).reshape(1,4).expand(N,4)
+    bbox2d = torch.as_tensor(bbox2d, dtype=torch.float, device=device)
+
+    # Pixel (i,j) of the output samples the image at u=l+(r-l)*(j+0.5)/w, v=t+(b-t)*(i+0.5)/h, as nvdiffrast_render does
+    zs = pts_cam[...,2]
+    uvs = pts_cam@K.T
+    uvs = uvs[...,:2]/zs[...,None].clamp(min=self.znear)
+    xs = (uvs[...,0]-bbox2d[:,0:1])*w/(bbox2d[:,2:3]-bbox2d[:,0:1]) - 0.5
+    ys = (uvs[...,1]-bbox2d[:,1:2])*h/(bbox2d[:,3:4]-bbox2d[:,1:2]) - 0.5
+
+    faces = faces.long()
+    tri_x = xs[:,faces]   #(N,F,3)
+    tri_y = ys[:,faces]
+    tri_z = zs[:,faces]
+    x_min = tri_x.min(dim=-1)[0].ceil().clamp(min=0)
+    x_max = tri_x.max(dim=-1)[0].floor().clamp(max=w-1)
+    y_min = tri_y.min(dim=-1)[0].ceil().clamp(min=0)
+    y_max = tri_y.max(dim=-1)[0].floor().clamp(max=h-1)
+    area = (tri_x[...,1]-tri_x[...,0])*(tri_y[...,2]-tri_y[...,0]) - (tri_x[...,2]-tri_x[...,0])*(tri_y[...,1]-tri_y[...,0])
+    valid = (tri_z.min(dim=-1)[0]>=self.znear) & (x_max>=x_min) & (y_max>=y_min) & (area.abs()>1e-10)
+    pose_ids, face_ids = valid.nonzero(as_tuple=True)
+    x_min = x_min[pose_ids,face_ids].long()
+    y_min = y_min[pose_ids,face_ids].long()
+    box_w = x_max[pose_ids,face_ids].long()-x_min+1
+    counts = box_w*(y_max[pose_ids,face_ids].long()-y_min+1)
+    tri_x = tri_x[pose_ids,face_ids]
+    tri_y = tri_y[pose_ids,face_ids]
+    inv_z = 1/tri_z[pose_ids,face_ids]
+    area = area[pose_ids,face_ids]
+
+    # Split the triangles so that each chunk enumerates at most max_fragments candidate pixels
+    ends = torch.cumsum(counts, dim=0)
+    bounds = [0]
+    while bounds[-1]<len(counts):
+      start = int(ends[bounds[-1]-1]) if bounds[-1]>0 else 0
+      bounds.append(max(int(torch.searchsorted(ends, start+self.max_fragments, right=True)), bounds[-1]+1))
+
+    def fragments(a, b):
+      cnt = counts[a:b]
+      tri = torch.repeat_interleave(torch.arange(a, b, device=device), cnt)
+      offsets = torch.arange(len(tri), device=device) - (torch.cumsum(cnt, dim=0)-cnt).repeat_interleave(cnt)
+      px = x_min[tri] + offsets%box_w[tri]
+      py = y_min[tri] + torch.div(offsets, box_w[tri], rounding_mode='floor')
+      tx = tri_x[tri]
+      ty = tri_y[tri]
+      b0 = ((tx[:,1]-px)*(ty[:,2]-py) - (tx[:,2]-px)*(ty[:,1]-py))/area[tri]
+      b1 = ((tx[:,2]-px)*(ty[:,0]-py) - (tx[:,0]-px)*(ty[:,2]-py))/area[tri]
+      bary = torch.stack([b0, b1, 1-b0-b1], dim=-1)
+      inside = (bary>=-1e-6).all(dim=-1)
+      tri = tri[inside]
+      bary = bary[inside]*inv_z[tri]
+      z = 1/bary.sum(dim=-1)
+      keys = pose_ids[tri]*h*w + py[inside]*w + px[inside]
+      return tri, keys, z, bary*z[:,None]
+
+    zbuf = torch.full((N*h*w,), np.inf, dtype=torch.float, device=device)
+    for a,b in zip(bounds[:-1], bounds[1:]):
+      _, keys, z, _ = fragments(a, b)
+      zbuf.scatter_reduce_(0, keys, z, reduce='amin')
+    face_buf = torch.full((N*h*w,), -1, dtype=torch.long, device=device)
+    bary_buf = torch.zeros((N*h*w,3), dtype=torch.float, device=device)
+    for a,b in zip(bounds[:-1], bounds[1:]):
+      tri, keys, z, bary = fragments(a, b)
+      front = z==zbuf[keys]
+      face_buf[keys[front]] = face_ids[tri[front]]
+      bary_buf[keys[front]] = bary[front]
+    return face_buf.reshape(N,h,w), bary_buf.reshape(N,h,w,3)
+
+
+  def interpolate(self, attr, face_buf, bary_buf, tri_idx):
+    '''
+    @attr: (V,C) or (N,V,C) per-vertex attribute
+    @tri_idx: (F,3) vertex ids of each face into attr
+    @return: (N,h,w,C), 0 for background
+    '''
+    N,h,w = face_buf.shape
+    mask = face_buf>=0
+    out = torch.zeros((N,h,w,attr.shape[-1]), dtype=torch.float, device=face_buf.device)
+    pose_ids = torch.arange(N, device=face_buf.device).reshape(N,1,1).expand(N,h,w)[mask]
+    vert_ids = tri_idx.long()[face_buf[mask]]   #(M,3)
+    if attr.dim()==2:
+      vals = attr[vert_ids]
+    else:
+      vals = attr[pose_ids[:,None], vert_ids]
+    out[mask] = (vals*bary_buf[mask][...,None]).sum(dim=1)
+    return out
+
+
+  def render(self, K, H, W, ob_in_cams, mesh_tensors, get_normal=False, output_size=None, bbox2d=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
+    if isinstance(mesh_tensors, MeshInstances):
+      return self.render_instances(K, H, W, ob_in_cams, mesh_tensors, get_normal=get_normal, output_size=output_size, bbox2d=bbox2d, use_light=use_light, light_color=light_color, light_dir=light_dir, light_pos=light_pos, w_ambient=w_ambient, w_diffuse=w_diffuse, extra=extra)
+    device = ob_in_cams.device
+    pos = mesh_tensors['pos']
+    vnormals = mesh_tensors['vnormals']
+    pos_idx = mesh_tensors['faces']
+    has_tex = has_mesh_texture(mesh_tensors)
+    if output_size is None:
+      output_size = np.asarray([H,W])
+
+    pts_cam = transform_pts(pos, ob_in_cams)
+    face_buf, bary_buf = self.rasterize(pts_cam, pos_idx, K, H, W, output_size, bbox2d=bbox2d)
+    xyz_map = self.interpolate(pts_cam, face_buf, bary_buf, pos_idx)
+    depth = xyz_map[...,2]
+    if has_tex:
+      texc = self.interpolate(mesh_tensors['uv'], face_buf, bary_buf, mesh_tensors['uv_idx'])
+      N,h,w = face_buf.shape
+      tex = get_mesh_texture(mesh_tensors, get_render_px_per_meter(K, W, ob_in_cams, output_size, bbox2d)).permute(0,3,1,2).expand(N,-1,-1,-1)
+      color = F.grid_sample(tex, texc*2-1, mode='bilinear', padding_mode='border', align_corners=False).permute(0,2,3,1)
+    else:
+      color = self.interpolate(mesh_tensors['vertex_color'], face_buf, bary_buf, pos_idx)
+
+    if use_light:
+      get_normal = True
+    if get_normal:
+      vnormals_cam = transform_dirs(vnormals, ob_in_cams)
+      normal_map = F.normalize(self.interpolate(vnormals_cam, face_buf, bary_buf, pos_idx), dim=-1)
+    else:
+      normal_map = None
+
+    if use_light:
+      if light_dir is not None:
+        light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device=device)
+      else:
+        light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device=device).reshape(1,1,3) - pts_cam
+      diffuse_intensity = (F.normalize(vnormals_cam, dim=-1) * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
+      diffuse_intensity_map = self.interpolate(diffuse_intensity, face_buf, bary_buf, pos_idx)
+      if light_color is None:
+        light_color = color
+      else:
+        light_color = torch.as_tensor(light_color, device=device, dtype=torch.float)
+      color = color*w_ambient + diffuse_intensity_map*light_color*w_diffuse
+
+    color = color.clip(0,1)
+    color = color * (face_buf>=0)[...,None]
+    extra['xyz_map'] = xyz_map
+    return color, depth, normal_map
+
+
+
+RENDER_BACKENDS = {
+  'nvdiffrast': NvdiffrastBackend,
+  'torch': TorchRasterBackend,
+}
+
+
+def make_render_backend(name, device='cuda'):
+  if name not in RENDER_BACKENDS:
+    raise RuntimeError(f'unknown render backend {name}, choose from {list(RENDER_BACKENDS.keys())}')
+  if name=='nvdiffrast':
+    return NvdiffrastBackend(device=device)
+  return RENDER_BACKENDS[name]()
+
+
+_CONTEXT_BACKENDS = OrderedDict()
+
+
+def get_render_backend(glctx=None, device='cuda'):
+  '''
+  @glctx: a RenderBackend, an nvdiffrast context or None. None picks nvdiffrast on CUDA devices and the torch rasterizer otherwise.
+  The backend of an nvdiffrast context is kept, so its render sessions survive across calls
+  '''
+  if isinstance(glctx, RenderBackend):
+    return glctx
+  if glctx is None and torch.device(device).type!='cuda':
+    return TorchRasterBackend()
+  if glctx is None:
+    glctx = dr.RasterizeCudaContext(device)
+  key = id(glctx)
+  if key not in _CONTEXT_BACKENDS or _CONTEXT_BACKENDS[key].glctx is not glctx:
+    _CONTEXT_BACKENDS[key] = NvdiffrastBackend(glctx, device=device)
+    while len(_CONTEXT_BACKENDS)>4:
+      _CONTEXT_BACKENDS.popitem(last=False)
+  return _CONTEXT_BACKENDS[key]
@@ -17,6 +17,7 @@ import os
 import numpy as np
 from Utils import to_homo
 import json
+from frame_pipeline import *
 
 CAM_TAG_DEFAULT_DETECTION = Detection()
 CAM_TAG_DEFAULT_DETECTION.tag_family = b'tagStandard41h12'
@@ -57,6 +58,31 @@ def main():
     parser.add_argument('--map_to_table_frame', action='store_true', help='whether to map the object pose to the table frame')
     parser.add_argument('--use_all_masks', action='store_true', help='condition on masks at every timestep')
     parser.add_argument('--headless', action='store_true', help='do not show the visualization, good for running on a server')
+    parser.add_argument('--device', type=str, default='cuda', help='torch device to run estimation on, e.g. cuda, cuda:1 or cpu')
+    parser.add_argument('--prefilter', type=str, default=None, choices=['depth', 'silhouette'], help='rank rotation hypotheses with a cheap test before refinement instead of keeping every other one')
+    parser.add_argument('--prefilter_topk', type=int, default=None, help='number of hypotheses kept by --prefilter, defaults to half of them')
+    parser.add_argument('--score_group_size', type=int, default=None, help='score hypotheses in tournament groups of this size to bound memory')
+    parser.add_argument('--score_max_mem_mb', type=float, default=None, help='peak memory budget of the scorer, cuda only, use --score_group_size on cpu')
+    parser.add_argument('--refine_trans_tol', type=float, default=None, help='meter, freeze a hypothesis in refinement once its translation and rotation updates are below the tolerances')
+    parser.add_argument('--refine_rot_tol', type=float, default=None, help='degree, see --refine_trans_tol')
+    parser.add_argument('--reproj_trans_thres', type=float, default=None, help='meter, reproject the last rendering of a hypothesis instead of rendering again while its pose stays within the thresholds')
+    parser.add_argument('--reproj_rot_thres', type=float, default=None, help='degree, see --reproj_trans_thres')
+    parser.add_argument('--mesh_lod_px', type=float, default=None, help='render hypotheses with the coarsest decimated mesh whose mean edge spans at most this many crop pixels')
+    parser.add_argument('--tex_format', type=str, default=None, choices=['uint8', 'half'], help='store the object texture as a mip pyramid in this format instead of one float32 image')
+    parser.add_argument('--depth_roi_pad', type=float, default=None, help='filter the depth only inside the object mask box and the hypothesis crop windows, grown by this fraction of their size')
+    parser.add_argument('--template_bank_dir', type=str, default=None, help='cache the rendered crops of the rotation grid here and reproject them in the first register iteration instead of rendering')
+    parser.add_argument('--feature_cache_banks', type=int, default=0, help='with --template_bank_dir, keep the refiner encodings of the templates of this many objects and skip rendering and encoding them in the first register iteration')
+    parser.add_argument('--feature_cache_dir', type=str, default=None, help='also save the template encodings of --feature_cache_banks here')
+    parser.add_argument('--instanced_render', type=int, default=0, help='render the hypotheses of all objects in one rasterization call when registering them together')
+    parser.add_argument('--render_backend', type=str, default=None, choices=['nvdiffrast', 'torch'], help='defaults to nvdiffrast on CUDA devices and the torch rasterizer otherwise')
+    parser.add_argument('--reproj_hole_thres', type=float, default=0.05, help='render again when more than this fraction of the reprojected silhouette are holes')
+    parser.add_argument('--track_topk', type=int, default=1, help='track this many hypotheses of the last register and re-register automatically when tracking is lost, 1 tracks the best pose only')
+    parser.add_argument('--track_score_interval', type=int, default=5, help='frames between scoring the tracked hypotheses')
+    parser.add_argument('--track_score_thres', type=float, default=None, help='re-register when the best tracked score drops below this')
+    parser.add_argument('--track_trans_thres', type=float, default=None, help='meter, re-register when the refiner translation update exceeds this')
+    parser.add_argument('--track_rot_thres', type=float, default=None, help='degree, re-register when the refiner rotation update exceeds this')
+    parser.add_argument('--pipeline_depth', type=int, default=4, help='max frames queued between the read, estimate and write stages, 0 runs them serially')
+    parser.add_argument('--object_pack_dir', type=str, default=None, help='build or reuse a precompiled object pack of the mesh in this dir to speed up estimator initialization')
 
     args = parser.parse_args()
 
@@ -101,24 +127,89 @@ def main():
     for i in range(3):
         bbox_homo[i, i] *= -1
 
-    scorer = ScorePredictor()
-    refiner = PoseRefinePredictor()
-    glctx = dr.RasterizeCudaContext()
-    ests = [FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner,  debug=debug, glctx=glctx) for _ in range(len(args.prompts))]
+    scorer = ScorePredictor(device=args.device, group_size=args.score_group_size, max_mem_mb=args.score_max_mem_mb)
+    feature_cache = RefineFeatureCache(max_banks=args.feature_cache_banks, cache_dir=args.feature_cache_dir) if args.feature_cache_banks>0 else None
+    refiner = PoseRefinePredictor(device=args.device, trans_tol=args.refine_trans_tol, rot_tol=args.refine_rot_tol, reproj_trans_thres=args.reproj_trans_thres, reproj_rot_thres=args.reproj_rot_thres, reproj_hole_thres=args.reproj_hole_thres, feature_cache=feature_cache)
+    if args.render_backend is not None:
+        glctx = make_render_backend(args.render_backend, device=args.device)
+    else:
+        glctx = dr.RasterizeCudaContext(args.device) if torch.device(args.device).type=='cuda' else None
+    prefilter = None
+    if args.prefilter=='depth':
+        prefilter = DepthResidualPrefilter(topk=args.prefilter_topk)
+    elif args.prefilter=='silhouette':
+        prefilter = SilhouetteIoUPrefilter(topk=args.prefilter_topk)
+    object_pack = None
+    if args.object_pack_dir is not None:
+        object_pack = ObjectPack(make_object_pack(mesh, model_normals=mesh.vertex_normals, out_dir=args.object_pack_dir))
+    ests = [FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner,  debug=debug, glctx=glctx, device=args.device, prefilter=prefilter, object_pack=object_pack, mesh_lod_px=args.mesh_lod_px, tex_format=args.tex_format, template_bank_dir=args.template_bank_dir, depth_roi_pad=args.depth_roi_pad) for _ in range(len(args.prompts))]
+    mesh_pack = make_mesh_pack(ests) if args.instanced_render else None
     logging.info("estimator initialization done")
 
     reader = YcbineoatReader(video_dir=args.test_scene_dir, cam_num=args.cam_number, shorter_side=None, zfar=np.inf)
     stopped_tracking = [False, False, False]
     out_of_frame = [False, False, False]
-    for i in range(len(reader.color_files)):
+
+    def read_frame(i):
+        return i, reader.get_color(i), reader.get_depth(i)
+
+    latest_vis = {}
+    def write_frame(item):
+        i, color, poses, out_of_frame = item
+        transforms = {}
+        for j in range(len(ests)):
+            os.makedirs(f'{output_dirs[j]}', exist_ok=True)
+            cam2block = poses[j].reshape(4,4)
+            np.savetxt(f'{output_dirs[j]}/{reader.id_strs[i]}.txt', cam2block)
+
+            # also save 3D bounding box of the detected objects
+            center_pose = cam2block @ np.linalg.inv(to_origin)
+            bbox_cam_frame = (center_pose @ bbox_homo.T).T
+            np.savetxt(f'{output_dirs[j]}/{reader.id_strs[i]}_3d_bbox_cam_frame.txt', bbox_cam_frame)
+
+            if args.map_to_table_frame:
+                robot2block = ROBO2TAG @ np.linalg.inv(cam2tag) @ cam2block
+                np.savetxt(f'{output_dirs[j]}/{reader.id_strs[i]}_robot2block.txt', robot2block.reshape(4,4))
+
+                bbox_robot_frame = (ROBO2TAG @ np.linalg.inv(cam2tag) @ bbox_cam_frame.T).T
+                np.savetxt(f'{output_dirs[j]}/{reader.id_strs[i]}_3d_bbox_robot_frame.txt', bbox_cam_frame)
+
+                transforms[args.prompts[j]] = robot2block
+                # print(f"translation: {translation}")
+
+        if debug>=1:
+            vis = color.copy()
+            if args.map_to_table_frame:
+                add_translation_text(vis, transforms, [(0, 50), (0, 100), (0, 150)], i)
+            for j in range(len(ests)):
+                if out_of_frame[j]:
+                    continue
+                center_pose = poses[j]@np.linalg.inv(to_origin)
+                vis = draw_posed_3d_box(reader.K, img=vis, ob_in_cam=center_pose, bbox=bbox)
+                vis = draw_xyz_axis(vis, ob_in_cam=center_pose, scale=0.05, K=reader.K, thickness=2, transparency=0, is_input_rgb=True)
+                if args.map_to_table_frame:
+                    vis = vis_tag(vis, [detections["cam_tag"]["detection"]])
+            if not args.headless:
+                # cv2 windows have to be driven from the main thread, which shows the latest one
+                latest_vis['vis'] = vis
+
+
+        if debug>=2:
+            os.makedirs(f'{args.test_scene_dir}/track_vis', exist_ok=True)
+            path = f'{args.test_scene_dir}/track_vis/{reader.id_strs[i]}.png'
+            # imageio.imwrite(path, vis)
+            cv2.imwrite(path, cv2.cvtColor(vis, cv2.COLOR_RGB2BGR))  # if vis is RGB
+
+    # Decoding, estimation and writing overlap, each through a bounded queue
+    prefetcher = Prefetcher('read', read_frame, range(len(reader.color_files)), maxsize=args.pipeline_depth)
+    writer = AsyncWorker('write', write_frame, maxsize=args.pipeline_depth)
+    estimate_stats = StageStats('estimate')
+    for i, color, depth in prefetcher:
         logging.info(f'i:{i}')
-        color = reader.get_color(i)
-        depth = reader.get_depth(i)
+        begin = time.time()
         if i==0:
-            poses = []
-            for j in range(len(ests)):
-                mask = reader.get_mask(0, dirname="_masks_" + args.prompts[j]).astype(bool)
-                poses.append(ests[j].register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=args.est_refine_iter, init_rot_guess=args.init_rot_guess))
+            masks = [reader.get_mask(0, dirname="_masks_" + args.prompts[j]).astype(bool) for j in range(len(ests))]
+            poses = register_many(ests, K=reader.K, rgb=color, depth=depth, ob_masks=masks, iteration=args.est_refine_iter, init_rot_guess=args.init_rot_guess, mesh_pack=mesh_pack)
             if args.map_to_table_frame:
                 detections = get_april_tag(color, reader)
                 cam2tag = np.eye(4)
@@ -135,7 +226,8 @@ def main():
                 pcd = toOpen3dCloud(xyz_map[valid], color[valid])
                 o3d.io.write_point_cloud(f'{debug_dir}/scene_complete.ply', pcd)
         else:
-            poses = []
+            poses = [None]*len(ests)
+            to_register = {}
             for j in range(len(ests)):
                 img_key = f"{i}_{cam_name}"
                 obj_key = args.prompts[j].replace("_", " ")
@@ -152,66 +244,53 @@ def main():
                         # its a bounding box, reinit tracking w/ mask
                         mask = reader.get_mask(i, dirname="_masks_" + args.prompts[j]).astype(bool)
                         print("="*20 + "\nusing mask\n" + "="*20)
-                        poses.append(ests[j].register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=args.est_refine_iter, init_rot_guess=args.init_rot_guess))
+                        to_register[j] = mask
                         out_of_frame[j] = False
                         continue
                 if stopped_tracking[j]:
-                    poses.append(last_poses[j])
+                    poses[j] = last_poses[j]
                     continue
                 if out_of_frame[j]:
-                    poses.append(np.zeros_like(last_poses[j]))
+                    poses[j] = np.zeros_like(last_poses[j])
                     continue
                 if args.use_all_masks:
                     mask = reader.get_mask(i, dirname="_masks_" + args.prompts[j]).astype(bool)
                     print("="*20 + "\nusing mask\n" + "="*20)
-                    poses.append(ests[j].register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=args.est_refine_iter, init_rot_guess=args.init_rot_guess))
+                    to_register[j] = mask
                 else:
                     print("@"*20 + "\nno mask\n" + "@"*20)
-                    poses.append(ests[j].track_one(rgb=color, depth=depth, K=reader.K, iteration=args.track_refine_iter))
+                    if args.track_topk>1:
+                        get_mask = lambda i=i, j=j: get_mask_if_exists(reader, i, dirname="_masks_" + args.prompts[j])
+                        poses[j] = ests[j].track_multi_hypo(rgb=color, depth=depth, K=reader.K, iteration=args.track_refine_iter, ob_mask=get_mask, topk=args.track_topk, score_interval=args.track_score_interval, score_thres=args.track_score_thres, trans_thres=args.track_trans_thres, rot_thres=args.track_rot_thres, register_iteration=args.est_refine_iter)
+                    else:
+                        poses[j] = ests[j].track_one(rgb=color, depth=depth, K=reader.K, iteration=args.track_refine_iter)
+            if len(to_register)>0:
+                ids = list(to_register.keys())
+                registered = register_many([ests[j] for j in ids], K=reader.K, rgb=color, depth=depth, ob_masks=[to_register[j] for j in ids], iteration=args.est_refine_iter, init_rot_guess=args.init_rot_guess, mesh_pack=mesh_pack)
+                for j, pose in zip(ids, registered):
+                    poses[j] = pose
         last_poses = poses.copy()
-        transforms = {}
-        for j in range(len(ests)):
-            os.makedirs(f'{output_dirs[j]}', exist_ok=True)
-            cam2block = poses[j].reshape(4,4)
-            np.savetxt(f'{output_dirs[j]}/{reader.id_strs[i]}.txt', cam2block)
-
-            # also save 3D bounding box of the detected objects
-            center_pose = cam2block @ np.linalg.inv(to_origin)
-            bbox_cam_frame = (center_pose @ bbox_homo.T).T
-            np.savetxt(f'{output_dirs[j]}/{reader.id_strs[i]}_3d_bbox_cam_frame.txt', bbox_cam_frame)
-
-            if args.map_to_table_frame:
-                robot2block = ROBO2TAG @ np.linalg.inv(cam2tag) @ cam2block
-                np.savetxt(f'{output_dirs[j]}/{reader.id_strs[i]}_robot2block.txt', robot2block.reshape(4,4))
-
-                bbox_robot_frame = (ROBO2TAG @ np.linalg.inv(cam2tag) @ bbox_cam_frame.T).T
-                np.savetxt(f'{output_dirs[j]}/{reader.id_strs[i]}_3d_bbox_robot_frame.txt', bbox_cam_frame)
-
-                transforms[args.prompts[j]] = robot2block
-                # print(f"translation: {translation}")
-
-        if debug>=1:
-            vis = color.copy()
-            if args.map_to_table_frame:
-                add_translation_text(vis, transforms, [(0, 50), (0, 100), (0, 150)], i)
-            for j in range(len(ests)):
-                if out_of_frame[j]:
-                    continue
-                center_pose = poses[j]@np.linalg.inv(to_origin)
-                vis = draw_posed_3d_box(reader.K, img=vis, ob_in_cam=center_pose, bbox=bbox)
-                vis = draw_xyz_axis(vis, ob_in_cam=center_pose, scale=0.05, K=reader.K, thickness=2, transparency=0, is_input_rgb=True)
-                if args.map_to_table_frame:
-                    vis = vis_tag(vis, [detections["cam_tag"]["detection"]])
-            if not args.headless:
-                cv2.imshow('1', vis[...,::-1])
-                cv2.waitKey(1)
-
-
-        if debug>=2:
-            os.makedirs(f'{args.test_scene_dir}/track_vis', exist_ok=True)
-            path = f'{args.test_scene_dir}/track_vis/{reader.id_strs[i]}.png'
-            # imageio.imwrite(path, vis)
-            cv2.imwrite(path, cv2.cvtColor(vis, cv2.COLOR_RGB2BGR))  # if vis is RGB
+        estimate_stats.add(time.time()-begin)
+        writer.put((i, color, poses, out_of_frame.copy()))
+        vis = latest_vis.pop('vis', None)
+        if vis is not None:
+            cv2.imshow('1', vis[...,::-1])
+            cv2.waitKey(1)
+
+    writer.close()
+    log_pipeline_stats([prefetcher, estimate_stats, writer])
+    if args.reproj_trans_thres is not None or args.reproj_rot_thres is not None or args.template_bank_dir is not None:
+        logging.info(f'refiner renders avoided by reprojection: {refiner.n_renders_avoided}')
+    if refiner.feature_cache is not None:
+        logging.info(f'refiner feature cache stats: {refiner.feature_cache.stats}')
+
+
+def get_mask_if_exists(reader, i, dirname):
+    mask_file = os.path.join(os.path.dirname(reader.color_files[i]) + dirname, os.path.basename(reader.color_files[i]))
+    if not os.path.exists(mask_file):
+        logging.info(f'no mask at {mask_file}')
+        return None
+    return reader.get_mask(i, dirname=dirname).astype(bool)
 
 
 def add_translation_text(vis, translations, locations, frame_index):
@@ -0,0 +1,142 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Rendered-template bank: the refiner crops of every rotation grid entry, rendered once at a canonical translation
+
+Register places all rotations at the same guessed translation and the box_3d crop follows the object, so the rendered crops barely depend on
+the translation. The first refiner iteration reprojects the bank crops to the hypotheses instead of rasterizing them, see PoseRefinePredictor.make_template_crop_data.
+The bank is stored in the object pack file format, keyed by the mesh, the rotation grid and the crop settings.
+
+Usage: python template_bank.py --mesh_file demo_data/mustard0/mesh/textured_simple.obj --out_dir cache/template_bank
+'''
+
+from Utils import *
+from render_backend import *
+from object_pack import write_pack_file, read_pack_file, mesh_content_hash
+import argparse
+
+
+TEMPLATE_BANK_VERSION = 1
+
+
+def make_template_bank_arrays(rot_grid, mesh_tensors, mesh_diameter, cfg, distance_ratio=5, glctx=None, device='cuda'):
+  '''Render every rotation at (0,0,distance_ratio*mesh_diameter) with the refiner crop. The intrinsics are synthetic, reprojection only needs the rendered xyz
+  @rot_grid: (N,4,4) tensor
+  @cfg: refiner cfg with input_resize and crop_ratio
+  @return: dict of np arrays, rgbAs (N,3,h,w) uint8 and xyz_mapAs (N,3,h,w) float16 in the camera frame of poses
+  '''
+  render_size = cfg['input_resize']
+  distance = distance_ratio*mesh_diameter
+  f = max(render_size)*distance_ratio/cfg['crop_ratio']
+  H = W = int(2*max(render_size))
+  K = np.array([[f,0,W/2],[0,f,H/2],[0,0,1]])
+  poses = torch.as_tensor(rot_grid, dtype=torch.float, device=device).clone()
+  poses[:,:3,3] = torch.tensor([0,0,distance], dtype=torch.float, device=device)
+  tf_to_crops = compute_crop_window_tf_batch(H=H, W=W, poses=poses, K=K, crop_ratio=cfg['crop_ratio'], out_size=(render_size[1], render_size[0]), method='box_3d', mesh_diameter=mesh_diameter)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, render_size[0]-1, render_size[1]-1]).reshape(2,2), device=device, dtype=torch.float)
+  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
+
+  render_backend = get_render_backend(glctx, device)
+  bs = 512
+  rgbAs = []
+  xyz_mapAs = []
+  for b in range(0,len(poses),bs):
+    extra = {}
+    rgb_r, _, _ = render_backend.render(K=K, H=H, W=W, ob_in_cams=poses[b:b+bs], mesh_tensors=mesh_tensors, output_size=render_size, bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
+    rgbAs.append((rgb_r*255).round().clip(0,255).to(torch.uint8).permute(0,3,1,2).data.cpu().numpy())
+    xyz_mapAs.append(extra['xyz_map'].permute(0,3,1,2).half().data.cpu().numpy())
+  return {
+    'poses': poses.data.cpu().numpy(),
+    'rgbAs': np.concatenate(rgbAs, axis=0),
+    'xyz_mapAs': np.concatenate(xyz_mapAs, axis=0),
+  }
+
+
+
+class TemplateBank:
+  '''Bank crops on the device, looked up by rotation
+  '''
+  def __init__(self, arrays, meta, device='cuda'):
+    self.meta = meta
+    self.key = meta['key']
+    self.input_resize = tuple(meta['input_resize'])
+    self.arrays = arrays
+    self.to(device)
+
+
+  def to(self, device):
+    self.device = torch.device(device)
+    self.poses = torch.as_tensor(np.array(self.arrays['poses']), dtype=torch.float, device=self.device)
+    self.rgbAs = torch.as_tensor(np.array(self.arrays['rgbAs']), device=self.device)
+    self.xyz_mapAs = torch.as_tensor(np.array(self.arrays['xyz_mapAs']), device=self.device)
+    return self
+
+
+  def lookup(self, poses, rot_tol=0.1):
+    '''
+    @poses: (B,4,4) tensor
+    @rot_tol: degree
+    @return: (B) long, bank index of the rotation of each pose, -1 if no bank rotation is within rot_tol
+    '''
+    R = poses[:,:3,:3].reshape(-1,9)
+    traces = R@self.poses[:,:3,:3].reshape(-1,9).T   # trace(R_bank^T R)
+    best_trace, ids = traces.max(dim=1)
+    ids[best_trace<1+2*np.cos(np.deg2rad(rot_tol))] = -1
+    return ids
+
+
+  def get(self, ids):
+    '''
+    @return: rgbAs (B,3,h,w) float in [0,255], xyz_mapAs (B,3,h,w) float, poses (B,4,4) the crops were rendered at
+    '''
+    return self.rgbAs[ids].float(), self.xyz_mapAs[ids].float(), self.poses[ids]
+
+
+
+def template_bank_key(mesh, rot_grid, cfg, distance_ratio=5, extra_key=''):
+  '''
+  @mesh: trimesh rendered into the bank, its geometry, texture and vertex colors are part of the key
+  @extra_key: str, anything else changing the renderings, e.g. the mesh lod level and texture format
+  '''
+  return hash_arrays(np.array([TEMPLATE_BANK_VERSION, cfg['input_resize'][0], cfg['input_resize'][1], cfg['crop_ratio'], distance_ratio]), np.array([extra_key, mesh_content_hash(mesh)]),
+                     np.asarray(rot_grid))
+
+
+def load_or_make_template_bank(key, rot_grid, mesh_tensors, mesh_diameter, cfg, out_dir, distance_ratio=5, glctx=None, device='cuda'):
+  '''Load the bank with this key from out_dir, render and save it first if missing
+  '''
+  path = f'{out_dir}/{key[:16]}.fpbank'
+  if not os.path.exists(path):
+    begin = time.time()
+    arrays = make_template_bank_arrays(rot_grid, mesh_tensors, mesh_diameter, cfg, distance_ratio=distance_ratio, glctx=glctx, device=device)
+    meta = {'version': TEMPLATE_BANK_VERSION, 'key': key, 'input_resize': list(cfg['input_resize']), 'crop_ratio': float(cfg['crop_ratio']), 'distance_ratio': float(distance_ratio)}
+    os.makedirs(out_dir, exist_ok=True)
+    write_pack_file(path, arrays, meta)
+    logging.info(f'template bank of {len(arrays["poses"])} rotations rendered in {time.time()-begin:.2f}s, saved to {path}')
+  meta, arrays = read_pack_file(path)
+  if meta['version']!=TEMPLATE_BANK_VERSION or meta['key']!=key:
+    raise RuntimeError(f'{path} is not the template bank {key}')
+  return TemplateBank(arrays, meta, device=device)
+
+
+
+if __name__=='__main__':
+  from estimater import FoundationPose
+  parser = argparse.ArgumentParser()
+  code_dir = os.path.dirname(os.path.realpath(__file__))
+  parser.add_argument('--mesh_file', type=str, nargs='+', required=True)
+  parser.add_argument('--out_dir', type=str, default=f'{code_dir}/cache/template_bank')
+  parser.add_argument('--device', type=str, default='cuda')
+  args = parser.parse_args()
+
+  set_logging_format()
+  for mesh_file in args.mesh_file:
+    mesh = trimesh.load(mesh_file)
+    est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, device=args.device, template_bank_dir=args.out_dir)
+    print(f'{mesh_file} -> {est.template_bank.key[:16]}.fpbank')
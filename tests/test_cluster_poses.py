@@ -0,0 +1,89 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import pytest
+pytest.importorskip('Utils')
+from Utils import *
+
+
+def cluster_poses_reference(angle_diff, dist_diff, poses, symmetry_tfs):
+  '''The original greedy loop of mycpp cluster_poses, every pose against every cluster and symmetry, in float32
+  '''
+  radian_thres = np.float32(angle_diff/180.0*np.pi)
+  clusters = [poses[0]]
+  for pose in poses[1:]:
+    cluster_poses_ = np.asarray(clusters)
+    close = np.linalg.norm(cluster_poses_[:,:3,3]-pose[:3,3], axis=-1)<dist_diff
+    Rs = pose[None,:3,:3]@symmetry_tfs[:,:3,:3]   #(S,3,3)
+    traces = np.einsum('sij,cij->cs', Rs, cluster_poses_[:,:3,:3])
+    rot_diffs = np.arccos(np.clip((traces-1)/np.float32(2), -1, 1))
+    if not (close[:,None] & (rot_diffs<radian_thres)).any():
+      clusters.append(pose)
+  return np.asarray(clusters)
+
+
+def make_poses(n_poses, translation_range, seed):
+  rng = np.random.default_rng(seed)
+  poses = np.tile(np.eye(4), (n_poses,1,1))
+  poses[:,:3,:3] = R.random(n_poses, random_state=seed).as_matrix()
+  poses[:,:3,3] = rng.random((n_poses,3))*translation_range
+  return poses.astype(np.float32)
+
+
+def make_symmetry_tfs(name):
+  tfs = np.tile(np.eye(4), (1,1,1))
+  if name=='z8':
+    tfs = np.tile(np.eye(4), (8,1,1))
+    tfs[:,:3,:3] = R.from_euler('z', (np.arange(8)*2*np.pi/8)[:,None]).as_matrix()
+  elif name=='box':
+    tfs = np.tile(np.eye(4), (4,1,1))
+    tfs[1:,:3,:3] = [R.from_euler(axis, np.pi).as_matrix() for axis in 'xyz']
+  return tfs.astype(np.float32)
+
+
+SETTINGS = [
+  # angle_diff, dist_diff, translation_range
+  (30, 99999, 0),
+  (20, 0.05, 0.2),
+  (10, 0.1, 0.3),
+]
+
+
+@pytest.mark.parametrize('symmetry', ['none', 'z8', 'box'])
+@pytest.mark.parametrize('setting', SETTINGS)
+@pytest.mark.parametrize('block_size', [1, 7, 256])
+def test_cluster_poses_numpy_matches_all_pairs(symmetry, setting, block_size):
+  angle_diff, dist_diff, translation_range = setting
+  poses = make_poses(400, translation_range, seed=block_size)
+  symmetry_tfs = make_symmetry_tfs(symmetry)
+  expected = cluster_poses_reference(angle_diff, dist_diff, poses, symmetry_tfs)
+  assert 1<len(expected)<len(poses)
+  out = cluster_poses_numpy(angle_diff, dist_diff, poses, symmetry_tfs, block_size=block_size)
+  np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.skipif(mycpp is None, reason='mycpp is not built')
+@pytest.mark.parametrize('symmetry', ['none', 'z8', 'box'])
+@pytest.mark.parametrize('setting', SETTINGS)
+@pytest.mark.parametrize('block_size', [1, 7, 256])
+@pytest.mark.parametrize('num_threads', [1, 0])
+def test_mycpp_cluster_poses_matches_numpy(symmetry, setting, block_size, num_threads):
+  angle_diff, dist_diff, translation_range = setting
+  poses = make_poses(400, translation_range, seed=block_size)
+  symmetry_tfs = make_symmetry_tfs(symmetry)
+  expected = cluster_poses_reference(angle_diff, dist_diff, poses, symmetry_tfs)
+  out = np.asarray(mycpp.cluster_poses(angle_diff, dist_diff, poses, symmetry_tfs, block_size=block_size, num_threads=num_threads))
+  np.testing.assert_array_equal(out, expected)
+  np.testing.assert_array_equal(out, cluster_poses_numpy(angle_diff, dist_diff, poses, symmetry_tfs))
+
+
+def test_cluster_poses_without_mycpp_uses_numpy():
+  poses = make_poses(50, 0, seed=0)
+  symmetry_tfs = make_symmetry_tfs('none')
+  np.testing.assert_array_equal(np.asarray(cluster_poses(30, 99999, poses, symmetry_tfs)), cluster_poses_reference(30, 99999, poses, symmetry_tfs))
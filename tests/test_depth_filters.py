@@ -0,0 +1,130 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import pytest
+pytest.importorskip('Utils')
+from Utils import *
+
+
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+BACKENDS = ['torch', 'warp']
+
+
+def make_depth(H, W, seed):
+  '''Two slanted planes with a depth edge, sensor noise, missing pixels and far outliers
+  '''
+  rng = np.random.default_rng(seed)
+  vs, us = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
+  depth = 0.6+0.0002*us+0.0001*vs
+  depth[:, W//2:] -= 0.15
+  depth += 0.0002*rng.standard_normal((H,W))
+  depth[rng.random((H,W))<0.1] = 0
+  depth[rng.random((H,W))<0.01] = 150
+  depth[H//3:H//3+4, W//4:W//4+5] = 0
+  return depth.astype(np.float32)
+
+
+def erode_depth_reference(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100):
+  '''Per-pixel loop of erode_depth_kernel
+  '''
+  H,W = depth.shape
+  out = np.zeros_like(depth)
+  for h in range(H):
+    for w in range(W):
+      d_ori = depth[h,w]
+      bad_cnt = 0
+      total = 0
+      for u in range(max(w-radius,0), min(w+radius+1,W)):
+        for v in range(max(h-radius,0), min(h+radius+1,H)):
+          cur = depth[v,u]
+          total += 1
+          if cur<0.001 or cur>=zfar or abs(cur-d_ori)>depth_diff_thres:
+            bad_cnt += 1
+      out[h,w] = 0 if np.float32(bad_cnt)/np.float32(total)>ratio_thres else d_ori
+  return out
+
+
+def bilateral_filter_depth_reference(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000):
+  '''Per-pixel loop of bilateral_filter_depth_kernel
+  '''
+  H,W = depth.shape
+  out = np.zeros_like(depth)
+  for h in range(H):
+    for w in range(W):
+      window = [(u,v) for u in range(max(w-radius,0), min(w+radius+1,W)) for v in range(max(h-radius,0), min(h+radius+1,H))]
+      valid = [depth[v,u] for u,v in window if 0.001<=depth[v,u]<zfar]
+      if len(valid)==0:
+        continue
+      mean_depth = np.float32(np.sum(valid, dtype=np.float32)/np.float32(len(valid)))
+      sum_weight = 0.0
+      total = 0.0
+      for u,v in window:
+        cur = depth[v,u]
+        if 0.001<=cur<zfar and abs(cur-mean_depth)<0.01:
+          weight = np.exp(-((u-w)**2+(v-h)**2)/(2.0*sigmaD**2) - (float(depth[h,w])-float(cur))**2/(2.0*sigmaR**2))
+          sum_weight += weight
+          total += weight*cur
+      if sum_weight>0:
+        out[h,w] = total/sum_weight
+  return out
+
+
+def run_filter(fn, depth, device, backend):
+  if backend=='warp' and wp is None:
+    pytest.skip('warp is not installed')
+  out = fn(torch.as_tensor(depth, device=device), radius=2, device=device, backend=backend)
+  return torch.as_tensor(out).data.cpu().numpy()
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('seed', [0, 1])
+def test_erode_depth_matches_reference(device, backend, seed):
+  depth = make_depth(24, 32, seed)
+  out = run_filter(erode_depth, depth, device, backend)
+  np.testing.assert_allclose(out, erode_depth_reference(depth), atol=1e-6)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('seed', [0, 1])
+def test_bilateral_filter_depth_matches_reference(device, backend, seed):
+  depth = make_depth(24, 32, seed)
+  out = run_filter(bilateral_filter_depth, depth, device, backend)
+  np.testing.assert_allclose(out, bilateral_filter_depth_reference(depth), atol=1e-5)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_filter_backends_agree(device, backend):
+  if backend=='warp' and wp is None:
+    pytest.skip('warp is not installed')
+  depth = make_depth(120, 160, 2)
+  for fn in [erode_depth, bilateral_filter_depth]:
+    out = run_filter(fn, depth, device, backend)
+    expected = run_filter(fn, depth, 'cpu', 'torch')
+    np.testing.assert_allclose(out, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('roi', [(10,8,90,70), (0,0,40,30), (130,100,160,120), None])
+def test_preprocess_depth_roi_matches_full_frame(device, roi):
+  depth = make_depth(120, 160, 3)
+  H,W = depth.shape
+  K = np.array([[200,0,W/2],[0,200,H/2],[0,0,1]])
+  full = bilateral_filter_depth(erode_depth(torch.as_tensor(depth, device=device), radius=2, device=device), radius=2, device=device).data.cpu().numpy()
+  full_xyz = depth2xyzmap(full, K)
+  depth_roi, xyz_roi = preprocess_depth_roi(depth, K, roi, radius=2, device=device)
+
+  x0,y0,x1,y1 = (0,0,W,H) if roi is None else roi
+  inside = np.zeros((H,W), dtype=bool)
+  inside[y0:y1, x0:x1] = True
+  np.testing.assert_allclose(depth_roi[inside], full[inside], atol=1e-6)
+  np.testing.assert_allclose(xyz_roi[inside], full_xyz[inside], atol=1e-6)
+  assert (depth_roi[~inside]==0).all() and (xyz_roi[~inside]==0).all()
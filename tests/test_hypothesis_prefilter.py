@@ -0,0 +1,88 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import types
+import pytest
+pytest.importorskip('Utils')
+from Utils import *
+from hypothesis_prefilter import *
+
+
+def box_surface(lo, hi, step):
+  '''Grid points and outward normals on the faces of an axis aligned box
+  '''
+  pts = []
+  normals = []
+  for axis in range(3):
+    others = [a for a in range(3) if a!=axis]
+    grids = np.meshgrid(*[np.arange(lo[a], hi[a]+1e-9, step) for a in others], indexing='ij')
+    for side, value in [(-1, lo[axis]), (1, hi[axis])]:
+      face = np.zeros((grids[0].size,3))
+      face[:,others[0]] = grids[0].reshape(-1)
+      face[:,others[1]] = grids[1].reshape(-1)
+      face[:,axis] = value
+      normal = np.zeros((len(face),3))
+      normal[:,axis] = side
+      pts.append(face)
+      normals.append(normal)
+  return np.concatenate(pts), np.concatenate(normals)
+
+
+def make_object(step=0.002):
+  '''An L shaped object, a long box with a block on one end, so no 180 degree flip maps it onto itself
+  '''
+  pts0, normals0 = box_surface(np.array([-0.06,-0.03,-0.02]), np.array([0.06,0.03,0.02]), step)
+  pts1, normals1 = box_surface(np.array([0.02,-0.03,0.02]), np.array([0.06,0.03,0.06]), step)
+  keep0 = ~((pts0[:,0]>0.02) & (pts0[:,2]>=0.02))
+  keep1 = pts1[:,2]>0.02
+  pts = np.concatenate([pts0[keep0], pts1[keep1]])
+  normals = np.concatenate([normals0[keep0], normals1[keep1]])
+  return pts-pts.mean(axis=0), normals
+
+
+def render_depth(pts, pose, K, H, W):
+  '''Z-buffered depth of the posed points
+  '''
+  pts_cam = pts@pose[:3,:3].T+pose[:3,3]
+  uvs = pts_cam@K.T
+  us = np.round(uvs[:,0]/uvs[:,2]).astype(int)
+  vs = np.round(uvs[:,1]/uvs[:,2]).astype(int)
+  inside = (us>=0) & (us<W) & (vs>=0) & (vs<H)
+  depth = np.full((H,W), np.inf)
+  np.minimum.at(depth, (vs[inside], us[inside]), pts_cam[inside,2])
+  depth[np.isinf(depth)] = 0
+  return depth
+
+
+def test_depth_residual_prefilter_ranks_true_rotation_first():
+  pts, normals = make_object()
+  H, W = 240, 320
+  K = np.array([[400,0,W/2],[0,400,H/2],[0,0,1]])
+  pose = np.eye(4)
+  pose[:3,:3] = R.from_euler('xyz', [0.5,-0.4,0.3]).as_matrix()
+  pose[:3,3] = [0.01, -0.02, 0.5]
+  dense_pts, _ = make_object(step=0.0005)
+  depth = render_depth(dense_pts, pose, K, H, W)
+  ob_mask = depth>0
+
+  est = types.SimpleNamespace(pts=torch.as_tensor(pts, dtype=torch.float), normals=torch.as_tensor(normals, dtype=torch.float), vox_size=0.004)
+  vs, us = np.where(ob_mask)
+  zc = np.median(depth[ob_mask])
+  center = np.linalg.inv(K)@np.array([(us.min()+us.max())/2, (vs.min()+vs.max())/2, 1])*zc   # as FoundationPose.guess_translation
+  flips = [np.eye(3)] + [R.from_euler(axis, np.pi).as_matrix() for axis in 'xyz']
+  poses = np.tile(np.eye(4), (len(flips),1,1))
+  for i, flip in enumerate(flips):
+    poses[i,:3,:3] = pose[:3,:3]@flip
+    poses[i,:3,3] = center
+  poses = torch.as_tensor(poses, dtype=torch.float)
+
+  scores = DepthResidualPrefilter().score(est, poses, K, depth, ob_mask)
+  assert scores[0]>scores[1:].max()+0.1, scores
+  _, ids, _ = DepthResidualPrefilter(topk=1).select(est, poses, K, depth, ob_mask)
+  assert ids.tolist()==[0]
@@ -0,0 +1,97 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import pytest
+pytest.importorskip('Utils')
+kornia = pytest.importorskip('kornia')
+from Utils import *
+
+
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+H, W = 48, 64
+DSIZE = (20, 24)
+
+
+def make_image(dtype, channels, seed):
+  rng = np.random.default_rng(seed)
+  shape = (H,W) if channels is None else (H,W,channels)
+  if dtype=='uint8':
+    return rng.integers(0, 256, size=shape).astype(np.uint8)
+  return rng.random(shape).astype(np.float32)
+
+
+def make_tf_to_crops(device):
+  '''Scale and translate windows like compute_crop_window_tf_batch: inside the frame, past the left/top border, past the right/bottom border,
+  one covering the whole frame, and a small in-plane rotation
+  '''
+  windows = [  # x0, y0, crop width in original pixels
+    (10.3, 7.9, 29.7),
+    (-13.1, -6.6, 33.3),
+    (45.2, 31.7, 37.9),
+    (-20.4, -24.2, 110.6),
+  ]
+  tfs = []
+  for x0, y0, size in windows:
+    tf = np.eye(3)
+    tf[:2,2] = [-x0, -y0]
+    tf = np.diag([DSIZE[1]/size, DSIZE[0]/size, 1])@tf
+    tfs.append(tf)
+  rot = np.eye(3)
+  rot[:2,:2] = R.from_euler('z', 13, degrees=True).as_matrix()[:2,:2]
+  tfs.append(tfs[0]@rot)
+  return torch.as_tensor(np.stack(tfs), dtype=torch.float, device=device)
+
+
+def kornia_reference(img, tf_to_crops, mode):
+  img = torch.as_tensor(img, device=tf_to_crops.device).float()
+  if img.ndim==2:
+    img = img[...,None]
+  img = img.permute(2,0,1)[None].expand(len(tf_to_crops),-1,-1,-1)
+  return kornia.geometry.transform.warp_perspective(img, tf_to_crops, dsize=DSIZE, mode=mode, padding_mode='zeros', align_corners=False)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('dtype', ['uint8', 'float32'])
+@pytest.mark.parametrize('channels', [None, 3])
+def test_nearest_matches_kornia(device, dtype, channels):
+  img = make_image(dtype, channels, seed=0)
+  tf_to_crops = make_tf_to_crops(device)
+  out = warp_crop_batch(img, tf_to_crops, DSIZE, mode='nearest')
+  ref = kornia_reference(img, tf_to_crops, mode='nearest')
+  assert out.shape==ref.shape
+  assert out.dtype==torch.float
+  assert torch.equal(out, ref)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('dtype', ['uint8', 'float32'])
+@pytest.mark.parametrize('channels', [None, 3])
+def test_bilinear_matches_kornia(device, dtype, channels):
+  img = make_image(dtype, channels, seed=1)
+  tf_to_crops = make_tf_to_crops(device)
+  out = warp_crop_batch(img, tf_to_crops, DSIZE, mode='bilinear')
+  ref = kornia_reference(img, tf_to_crops, mode='bilinear')
+  assert out.shape==ref.shape
+  scale = 255 if dtype=='uint8' else 1
+  assert (out-ref).abs().max().item()/scale<2e-3
+
+
+@pytest.mark.parametrize('mode', ['nearest', 'bilinear'])
+def test_windows_past_border_are_zero_padded(mode):
+  img = make_image('float32', 3, seed=2)+1
+  tf_to_crops = make_tf_to_crops('cpu')
+  out = warp_crop_batch(img, tf_to_crops, DSIZE, mode=mode)
+  assert (out[0]>0).all()
+  for i in [1,2,3]:
+    assert (out[i]==0).any() and (out[i]>0).any()
+
+
+def test_unknown_mode():
+  with pytest.raises(RuntimeError):
+    warp_crop_batch(make_image('float32', 3, seed=3), make_tf_to_crops('cpu'), DSIZE, mode='bicubic')